@@ -0,0 +1,186 @@
+# '''
+# Behavioural analysis of the Long-Range Agreement task.
+#
+# Scores every main run at once (one result file per run: when a run was
+# restarted, the fullest, then latest, attempt): the logged KEY
+# ('left'/'right') is mapped to a true/false answer through the run's hand
+# mapping (right hand = true, or left hand = true with --invert_hands) and
+# compared with the stimulus CSV 'probe' column. Accuracy, d' and RT
+# distributions are then computed by any combination of trial factors.
+#
+# Scored trials are cached per result file (keyed by the size/mtime of the
+# file and of its stimulus CSV, and by the source of the scoring code), so
+# after a session only the new run is read.
+#
+# Usage: python Code/analysis.py [--by condition modality] [--out summary.csv]
+#
+# Project: Long-Range Agreement Pilot
+# '''
+
+import sys
+import json
+import pickle
+import hashlib
+import inspect
+import argparse
+from pathlib import Path
+from statistics import NormalDist
+import numpy as np
+import pandas as pd
+
+from results_io import (PROJECT_ROOT, read_xpd, run_identity, stimulus_csv, experiment_info_flag,
+                        main_run_results, file_signature)
+from results_store import trial_rows
+from schedule import compile_schedule
+
+CACHE_DIR = PROJECT_ROOT / ".cache" / "analysis"
+DEFAULT_FACTORS = [['condition'], ['structure'], ['interference'], ['modality']]
+RT_QUANTILES = [0.1, 0.25, 0.5, 0.75, 0.9]
+
+
+def score_trials(trials, invert_hands):
+    """Add answered/response_true/correct/hit/false_alarm columns (vectorized).
+
+    `invert_hands` is a bool or a boolean array aligned with `trials`.
+    """
+    key = trials['key'].to_numpy(dtype=object)
+    true_label = np.where(np.asarray(invert_hands, dtype=bool), 'left', 'right')
+    answered = np.isin(key, ['left', 'right'])
+    response_true = answered & (key == true_label)
+    probe = trials['probe'].fillna(0).to_numpy(dtype=bool)
+    scored = trials.copy()
+    scored['answered'] = answered
+    scored['response_true'] = response_true
+    scored['correct'] = answered & (response_true == probe)
+    scored['hit'] = answered & probe & response_true
+    scored['false_alarm'] = answered & ~probe & response_true
+    scored['signal'] = answered & probe
+    scored['noise'] = answered & ~probe
+    return scored
+
+
+def scoring_code_hash():
+    """Hash of the code that builds and scores trial rows; a change to it invalidates the cache."""
+    digest = hashlib.sha1()
+    for function in (trial_rows, compile_schedule, score_trials):
+        digest.update(inspect.getsource(function).encode())
+    return digest.hexdigest()
+
+
+def _cache_path(path, cache_dir):
+    return Path(cache_dir) / (hashlib.sha1(str(Path(path).resolve()).encode('utf-8')).hexdigest() + ".pkl")
+
+
+def load_scored_file(path, stimuli_root=None, cache_dir=CACHE_DIR, invert_overrides=None):
+    """Scored trials of one result file, from the cache when its inputs are unchanged."""
+    info, _df = read_xpd(path)
+    identity = run_identity(path, info)
+    if identity is None:
+        return pd.DataFrame()
+    invert_hands = experiment_info_flag(info, 'invert_hands')
+    if invert_overrides and identity[0] in invert_overrides:
+        invert_hands = invert_overrides[identity[0]]
+    signature = json.dumps([file_signature(path), file_signature(stimulus_csv(*identity, stimuli_root)), invert_hands,
+                            scoring_code_hash()])
+
+    cache_file = _cache_path(path, cache_dir)
+    if cache_file.is_file():
+        with open(cache_file, 'rb') as f:
+            cached_signature, cached = pickle.load(f)
+        if cached_signature == signature:
+            return cached
+
+    trials = trial_rows(path, stimuli_root)
+    if not trials.empty:
+        if invert_hands is None:
+            print(f"Warning: No hand mapping recorded in {path}; assuming right hand = true.")
+            invert_hands = False
+        trials['invert_hands'] = invert_hands
+        trials = score_trials(trials, invert_hands)
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    with open(cache_file, 'wb') as f:
+        pickle.dump((signature, trials), f)
+    return trials
+
+
+def load_all(project_root=PROJECT_ROOT, stimuli_root=None, cache_dir=CACHE_DIR, invert_overrides=None):
+    frames = [load_scored_file(p, stimuli_root, cache_dir, invert_overrides) for p in main_run_results(project_root).values()]
+    frames = [f for f in frames if not f.empty]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def d_prime(hits, signal, false_alarms, noise):
+    """d' with the log-linear correction (Hautus, 1995), vectorized over groups."""
+    inv_cdf = np.frompyfunc(NormalDist().inv_cdf, 1, 1)
+    hit_rate = (np.asarray(hits) + 0.5) / (np.asarray(signal) + 1.0)
+    fa_rate = (np.asarray(false_alarms) + 0.5) / (np.asarray(noise) + 1.0)
+    return (inv_cdf(hit_rate) - inv_cdf(fa_rate)).astype(float)
+
+
+def summarize(scored, factors):
+    """Accuracy, d' and RT distribution per group of `factors`."""
+    grouped = scored.groupby(list(factors), dropna=False)
+    summary = grouped.agg(
+        n=('trial_number', 'size'),
+        answered=('answered', 'sum'),
+        correct=('correct', 'sum'),
+        hits=('hit', 'sum'),
+        false_alarms=('false_alarm', 'sum'),
+        signal=('signal', 'sum'),
+        noise=('noise', 'sum'),
+    )
+    summary['timeouts'] = summary['n'] - summary['answered']
+    summary['accuracy'] = summary['correct'] / summary['answered'].replace(0, np.nan)
+    summary['d_prime'] = d_prime(summary['hits'], summary['signal'], summary['false_alarms'], summary['noise'])
+
+    rts = scored[scored['answered'] & scored['correct']].groupby(list(factors), dropna=False)['rt_ms']
+    summary['rt_mean'] = rts.mean()
+    summary['rt_sd'] = rts.std()
+    quantiles = rts.quantile(RT_QUANTILES).unstack()
+    for q in RT_QUANTILES:
+        summary[f"rt_q{int(q * 100)}"] = quantiles[q] if q in quantiles.columns else np.nan
+    return summary.reset_index()
+
+
+def parse_invert_overrides(values):
+    """'02,04' style list of subjects run with --invert_hands."""
+    if not values:
+        return None
+    return {s.strip(): True for s in values.split(',') if s.strip()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score all runs and summarise accuracy, d' and RT.")
+    parser.add_argument("--project_root", type=str, default=str(PROJECT_ROOT))
+    parser.add_argument("--by", nargs='+', default=None,
+                        help="Trial columns to group by (default: condition, structure, interference and modality separately)")
+    parser.add_argument("--invert_hands_subjects", type=str, default=None,
+                        help="Comma-separated subject IDs run with --invert_hands, for files without the header entry")
+    parser.add_argument("--out", type=str, default=None, help="Write the summary (or summaries) to this CSV")
+    args = parser.parse_args()
+
+    project_root = Path(args.project_root)
+    scored = load_all(project_root, cache_dir=project_root / ".cache" / "analysis",
+                      invert_overrides=parse_invert_overrides(args.invert_hands_subjects))
+    if scored.empty:
+        print("No scored trials found; nothing to summarise.")
+        return
+    print(f"Scored {len(scored)} trials from {scored['source'].nunique()} runs")
+
+    factor_sets = [args.by] if args.by else DEFAULT_FACTORS
+    summaries = []
+    for factors in factor_sets:
+        missing = [f for f in factors if f not in scored.columns]
+        if missing:
+            print(f"Error: Unknown trial column(s): {missing}")
+            sys.exit(1)
+        summary = summarize(scored, factors)
+        print("\n" + summary.to_string(index=False, float_format=lambda v: f"{v:.3f}"))
+        summaries.append(summary.assign(grouping="+".join(factors)))
+    if args.out:
+        pd.concat(summaries, ignore_index=True).to_csv(args.out, index=False)
+        print(f"\nSummary written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# '''
+# Low-latency audio output for long_range.py.
+#
+# Audio.play() picks a free mixer channel, registers quit callbacks and
+# formats a log line before returning, and after a silence the sound device
+# may have gone idle, so the first sound of a block can start late.
+# AudioOutput instead:
+#   - reserves one mixer channel each for sentences and probes (so play never
+#     searches for or steals a channel),
+#   - keeps the output stream warm by looping a silent sound on a third
+#     reserved channel for the whole run,
+#   - plays a preloaded stimulus directly on its channel and measures the
+#     software-side scheduling latency of the call (perf_counter, in ms),
+#     logged to the event file as "Stimulus,played,<file>,<channel>,<latency>".
+#
+# The device buffer size (the other part of the output latency) is set with
+# set_buffer_size() before control.initialize(). Without an initialised
+# mixer, play() falls back to Audio.play().
+#
+# Project: Long-Range Agreement Pilot
+# '''
+
+import time
+import pygame
+from expyriment import control
+
+CHANNELS = ("sentence", "probe")
+KEEPALIVE_CHANNEL = len(CHANNELS) # Reserved channel looping silence
+SILENCE_MS = 100
+
+
+def set_buffer_size(buffer_size):
+    """Mixer buffer size in samples (a power of two); must be called before control.initialize()."""
+    if buffer_size:
+        control.defaults.audiosystem_buffer_size = buffer_size
+
+
+class AudioOutput:
+    """Reserved, pre-warmed mixer channels with per-play latency measurement."""
+
+    def __init__(self, exp):
+        self.exp = exp
+        self.latencies = {name: [] for name in CHANNELS}
+        self.channels = {}
+        self._keepalive = None
+        mixer = pygame.mixer.get_init()
+        if mixer is None:
+            return
+        frequency, sample_format, n_channels = mixer
+        pygame.mixer.set_reserved(len(CHANNELS) + 1)
+        self.channels = {name: pygame.mixer.Channel(i) for i, name in enumerate(CHANNELS)}
+        # The output stream stays busy (and the device awake) between stimuli
+        n_bytes = int(frequency * SILENCE_MS / 1000) * n_channels * (abs(sample_format) // 8)
+        self._keepalive = pygame.mixer.Sound(buffer=bytes(n_bytes))
+        pygame.mixer.Channel(KEEPALIVE_CHANNEL).play(self._keepalive, loops=-1)
+        self.buffer_ms = 1000.0 * control.defaults.audiosystem_buffer_size / frequency
+
+    def play(self, stim, channel="sentence"):
+        """Start a preloaded Audio on its reserved channel; returns the scheduling latency in ms."""
+        if channel not in self.channels or stim._file is None:
+            start = time.perf_counter()
+            stim.play()
+            return (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        self.channels[channel].play(stim._file)
+        latency = (time.perf_counter() - start) * 1000
+        stim._channel = self.channels[channel] # Keeps Audio.is_playing/stop() consistent
+        self.latencies[channel].append(latency)
+        self.exp._event_file_log(f"Stimulus,played,{stim.filename},{channel},{latency:.3f}", 1)
+        return latency
+
+    def summary(self):
+        """Per-channel latency summary, printable."""
+        lines = []
+        for name, values in self.latencies.items():
+            if values:
+                values = sorted(values)
+                lines.append(f"Audio {name}: {len(values)} plays, scheduling latency median "
+                             f"{values[len(values) // 2]:.3f} ms, max {values[-1]:.3f} ms")
+        if self._keepalive is not None:
+            lines.append(f"Mixer buffer: {control.defaults.audiosystem_buffer_size} samples ({self.buffer_ms:.1f} ms)")
+        return "\n".join(lines)
+
+    def close(self):
+        if self._keepalive is not None:
+            self._keepalive.stop()
@@ -0,0 +1,282 @@
+# '''
+# Delta deploy of the experiment to the stimulus PC.
+#
+# Builds a content-hash manifest (SHA-1 per file) of the code, stimuli and
+# localizer, compares it with the manifest left in the target by the previous
+# deploy, and copies only new or changed files (hashing and copying run in a
+# thread pool). Source hashes are cached by size/mtime in .cache/, so
+# re-deploying after a stimulus tweak only re-hashes the tweaked files.
+# Files at the target that the previous deploy wrote and that are gone from
+# the source are removed with --delete; anything else at the target (Logs,
+# results) is never touched.
+#
+# The deployed tree is then verified the way the experiment will load it:
+# every run folder (one sub_XX_run_Y.csv, required columns, wavs/ for each
+# auditory trial), the instruction/cue images and fonts, and the localizer
+# tables against localizer/audio/sound_files. Absolute paths left in the
+# deployed scripts are reported as well.
+#
+# With --packed, the wavs/ folders covered by a stimulus pack (see
+# stimulus_pack.py) are not copied; the run folders are verified against the
+# pack's index instead. Every deployed pack is decoded and checked against
+# the WAVs deployed next to it, so a WAV edited after the pack was built is
+# reported.
+#
+#     python Code/deploy.py /media/stimpc/Long_Range_Pilot [--delete] [--dry_run]
+#     python Code/deploy.py /media/stimpc/Long_Range_Pilot --verify_only
+#
+# Project: Long-Range Agreement Pilot
+# '''
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from schedule import find_run_csvs
+from stimulus_pack import PACK_NAME, find_pack, read_index, verify_pack
+
+PROJECT_ROOT = Path(__file__).parent.resolve().parent
+DEPLOY_PATHS = ("Code", "Stimuli", "localizer", "README.md", "requirements.txt")
+EXCLUDED_DIRS = {"__pycache__", ".ipynb_checkpoints", "data", "events"} # Outputs written at the scanner
+MANIFEST_NAME = ".deploy_manifest.json"
+SOURCE_CACHE = PROJECT_ROOT / ".cache" / "deploy_manifest.json"
+CHUNK = 1 << 20
+
+RUN_COLUMNS = ['sentence', 'structure', 'probe_word', 'modality', 'rest_duration']
+IMAGES = ("instructions.png", "instructions_invert-hands.png", "visual_cue.png", "auditory_cue.png")
+FONTS = ("Inconsolata-Regular.ttf",)
+ABSOLUTE_PATH = re.compile(r"""["'](/home/|/Users/|[A-Za-z]:\\\\)[^"']*["']""")
+
+
+def sha1_file(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def list_files(root, paths=DEPLOY_PATHS, skip_packed=False):
+    """Relative POSIX paths of every file to deploy under `root` (without packed wavs/ if skip_packed)."""
+    files = []
+    for top in paths:
+        top_path = Path(root) / top
+        if top_path.is_file():
+            files.append(top)
+            continue
+        for dirpath, dirnames, filenames in os.walk(top_path):
+            dirnames[:] = sorted(d for d in dirnames if d not in EXCLUDED_DIRS)
+            if skip_packed and Path(dirpath).name == "wavs" and find_pack(Path(dirpath).parent):
+                dirnames[:] = []
+                continue
+            rel = Path(dirpath).relative_to(root)
+            files.extend((rel / name).as_posix() for name in sorted(filenames))
+    return files
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest, path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)
+
+
+def build_manifest(root, files, previous=None, jobs=None):
+    """{relpath: [size, mtime_ns, sha1]}; files whose size and mtime match `previous` are not re-hashed."""
+    previous = previous or {}
+    manifest, to_hash = {}, []
+    for rel in files:
+        st = os.stat(Path(root) / rel)
+        old = previous.get(rel)
+        if old and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+            manifest[rel] = old
+        else:
+            manifest[rel] = [st.st_size, st.st_mtime_ns, None]
+            to_hash.append(rel)
+    with ThreadPoolExecutor(max_workers=jobs) as executor: # hashlib releases the GIL on large reads
+        for rel, digest in zip(to_hash, executor.map(lambda r: sha1_file(Path(root) / r), to_hash)):
+            manifest[rel][2] = digest
+    return manifest, len(to_hash)
+
+
+def plan(source, target):
+    """Files to copy (new or changed content) and to delete (deployed before, gone from the source)."""
+    copy = [rel for rel, entry in source.items() if rel not in target or target[rel][2] != entry[2]]
+    delete = [rel for rel in target if rel not in source]
+    return copy, delete
+
+
+def copy_file(source_root, target_root, rel):
+    """Copy one file atomically (temporary name, then rename); returns its target mtime_ns."""
+    src, dst = Path(source_root) / rel, Path(target_root) / rel
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(dst.name + ".deploying")
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+    return os.stat(dst).st_mtime_ns
+
+
+def verify_run_folder(csv_path):
+    """Problems long_range.py would hit loading this run folder."""
+    run_dir = csv_path.parent
+    problems = []
+    csvs = list(run_dir.glob('*.csv'))
+    if len(csvs) > 1:
+        problems.append(f"{len(csvs)} CSV files (long_range.py uses the first one found)")
+    try:
+        df = pd.read_csv(csv_path)
+    except (OSError, pd.errors.ParserError) as e:
+        return problems + [f"unreadable CSV: {e}"]
+    missing = [col for col in RUN_COLUMNS if col not in df.columns]
+    if missing:
+        return problems + [f"missing columns {missing}"]
+    modality = df['modality'].str.lower()
+    if not modality.isin(['visual', 'auditory']).all():
+        problems.append(f"invalid modality values {sorted(set(modality) - {'visual', 'auditory'})}")
+    auditory = df[modality == 'auditory']
+    if len(auditory) and 'trial' not in df.columns:
+        problems.append("auditory trials but no 'trial' column")
+    elif len(auditory):
+        present = {p.name for p in (run_dir / "wavs").glob("*.wav")}
+        pack_path = find_pack(run_dir)
+        if pack_path:
+            prefix = run_dir.relative_to(pack_path.parent).as_posix()
+            prefix = "wavs/" if prefix == "." else f"{prefix}/wavs/"
+            present |= {rel[len(prefix):] for rel in read_index(pack_path)['files'] if rel.startswith(prefix)}
+        for trial in auditory['trial']:
+            for name in (f"{trial}.wav", f"{trial}_probe.wav"):
+                if name not in present:
+                    problems.append(f"missing wavs/{name}")
+    return problems
+
+
+def verify_localizer(root):
+    """Problems in the audio localizer tables (every fname must be in sound_files)."""
+    audio_dir = Path(root) / "localizer" / "audio"
+    if not audio_dir.is_dir():
+        return {}
+    present = {p.name for p in (audio_dir / "sound_files").glob("*.wav")}
+    results = {}
+    for csv_path in sorted((audio_dir / "stim").glob("long-range_localizer_sub*.csv")):
+        fnames = pd.read_csv(csv_path, usecols=['fname'])['fname'].dropna()
+        missing = sorted(set(fnames) - present)
+        results[csv_path.relative_to(root).as_posix()] = [f"missing sound_files/{name}" for name in missing]
+    return results
+
+
+def absolute_paths(root):
+    """Hard-coded absolute paths in the deployed scripts, as (file, line number, literal)."""
+    found = []
+    for path in sorted((Path(root)).glob("**/*.py")):
+        if EXCLUDED_DIRS & set(path.relative_to(root).parts):
+            continue
+        for n, line in enumerate(path.read_text(encoding='utf-8', errors='replace').splitlines(), 1):
+            code = line.split('#', 1)[0]
+            for match in ABSOLUTE_PATH.finditer(code):
+                found.append((path.relative_to(root).as_posix(), n, match.group(0)))
+    return found
+
+
+def verify_tree(root):
+    """{item: [problems]} for everything the experiment loads from `root`."""
+    root = Path(root)
+    results = {}
+    for _subject, _run, csv_path in find_run_csvs(root / "Stimuli"):
+        results[csv_path.parent.relative_to(root).as_posix()] = verify_run_folder(csv_path)
+    for name in IMAGES:
+        if not (root / "Stimuli" / "Input_Images" / name).is_file():
+            results[f"Stimuli/Input_Images/{name}"] = ["missing"]
+    for name in FONTS:
+        if not (root / "Code" / name).is_file():
+            results[f"Code/{name}"] = ["missing"]
+    for pack_path in sorted((root / "Stimuli").glob(f"**/{PACK_NAME}")):
+        results[pack_path.relative_to(root).as_posix()] = verify_pack(pack_path)
+    results.update(verify_localizer(root))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy only changed files to the stimulus PC and verify the run folders.")
+    parser.add_argument("target", type=str, help="Project folder on the stimulus PC (created if needed)")
+    parser.add_argument("--source", type=str, default=str(PROJECT_ROOT), help="Project folder to deploy (default: this one)")
+    parser.add_argument("--delete", action="store_true", help="Remove files deployed before that no longer exist in the source")
+    parser.add_argument("--dry_run", action="store_true", help="Only report what would be copied/deleted")
+    parser.add_argument("--packed", action="store_true", help="Deploy stimulus packs instead of the wavs/ folders they cover")
+    parser.add_argument("--verify_only", action="store_true", help="Skip the sync, only verify the target")
+    parser.add_argument("--jobs", type=int, default=8, help="Hashing/copying threads (default 8)")
+    args = parser.parse_args()
+
+    source_root, target_root = Path(args.source).resolve(), Path(args.target).resolve()
+    if not source_root.is_dir():
+        print(f"Error: Source folder not found at {source_root}")
+        sys.exit(1)
+    if source_root == target_root:
+        print("Error: Target is the source folder")
+        sys.exit(1)
+
+    if not args.verify_only:
+        start = time.perf_counter()
+        cache_path = SOURCE_CACHE if source_root == PROJECT_ROOT else source_root / ".cache" / "deploy_manifest.json"
+        source, n_hashed = build_manifest(source_root, list_files(source_root, skip_packed=args.packed),
+                                           load_manifest(cache_path), args.jobs)
+        save_manifest(source, cache_path)
+        # The target manifest is only trusted for files whose size and mtime are unchanged since the last deploy
+        target_manifest_path = target_root / MANIFEST_NAME
+        previous_target = load_manifest(target_manifest_path)
+        deployed = [rel for rel in previous_target if (target_root / rel).is_file()]
+        target, n_rehashed = build_manifest(target_root, deployed, previous_target, args.jobs)
+        copy, delete = plan(source, target)
+        if not args.delete:
+            delete = []
+        print(f"{len(source)} files in source ({n_hashed} hashed), {len(target)} deployed ({n_rehashed} re-hashed): "
+              f"{len(copy)} to copy ({sum(source[r][0] for r in copy) / 1e6:.1f} MB), {len(delete)} to delete")
+        if args.dry_run:
+            for rel in copy:
+                print(f"  copy   {rel}")
+            for rel in delete:
+                print(f"  delete {rel}")
+            return
+
+        target_root.mkdir(parents=True, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            mtimes = list(executor.map(lambda rel: copy_file(source_root, target_root, rel), copy))
+        for rel, mtime in zip(copy, mtimes):
+            target[rel] = [source[rel][0], mtime, source[rel][2]]
+        for rel in delete:
+            (target_root / rel).unlink(missing_ok=True)
+            target.pop(rel, None)
+        save_manifest(target, target_manifest_path)
+        print(f"Synced in {time.perf_counter() - start:.1f} s")
+
+    results = verify_tree(target_root)
+    failed = {item: problems for item, problems in results.items() if problems}
+    for item, problems in sorted(failed.items()):
+        print(f"  {item}: {len(problems)} problem(s)")
+        for problem in problems[:10]:
+            print(f"      {problem}")
+    for rel, n, literal in absolute_paths(target_root):
+        print(f"  Warning: absolute path in {rel}:{n}: {literal}")
+    print(f"Verified {len(results)} run folders/files at {target_root}: {len(failed)} with problems")
+    if failed:
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# '''
+# fMRI design matrices for the Long-Range Agreement runs.
+#
+# For every run with a result file, builds HRF-convolved regressors (one per
+# condition x modality for the sentence phase, plus cue, probe and response
+# regressors) from the logged trial onsets. A run attempted several times is
+# built from its fullest, then latest, result file. With --word_regressors, visual
+# sentences are additionally split into one regressor per word position using
+# the scheduled word onsets (STIMULUS_ONTIME + STIMULUS_ITI apart).
+#
+# Boxcars are laid on a fine time grid and convolved with the SPM canonical
+# HRF in one FFT per run, then sampled at every TR. Matrices are cached per
+# run as .npz files keyed by the inputs, so only new runs are rebuilt.
+#
+# Usage: python Code/design_matrix.py [--tr 1.5] [--n_scans N] [--out design]
+#
+# Project: Long-Range Agreement Pilot
+# '''
+
+import json
+import argparse
+from math import gamma
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from results_io import PROJECT_ROOT, read_xpd, run_identity, stimulus_csv, read_stimulus_csv, main_run_results, file_signature
+from schedule import compile_schedule, CUE_DURATION, SOA_PROBE, PROBE_DURATION, STIMULUS_ONTIME, STIMULUS_ITI, FINAL_WAIT
+
+DEFAULT_TR = 1.5   # s
+OVERSAMPLING = 0.01  # s, resolution of the regressor time grid
+HRF_LENGTH = 32.0  # s
+
+
+def spm_hrf(dt, length=HRF_LENGTH):
+    """SPM canonical double-gamma HRF sampled every `dt` seconds (peak 6 s, undershoot 16 s)."""
+    t = np.arange(0, length, dt)
+    peak = t ** 5 * np.exp(-t) / gamma(6)
+    undershoot = t ** 15 * np.exp(-t) / gamma(16)
+    hrf = peak - undershoot / 6.0
+    return hrf / hrf.sum()
+
+
+def trial_phases(results, stim_df, word_regressors=False):
+    """Long table of (regressor, onset_s, duration_s) for one run."""
+    schedule = compile_schedule(stim_df)
+    trials = results.merge(stim_df, on='TrialNumber', how='left')
+    idx = trials['TrialNumber'].to_numpy() - 1
+    cue_shown = schedule['cue_shown'].to_numpy()[idx]
+    planned = schedule['stim_duration'].to_numpy()[idx]
+    onset = trials['TrialOnset_ms'].to_numpy(dtype=float)
+    sentence_onset = onset + cue_shown * 2 * CUE_DURATION
+    logged = trials['StimulusDuration_ms'].to_numpy(dtype=float)
+    duration = np.where(logged > 0, logged, planned)
+    probe_onset = sentence_onset + duration + SOA_PROBE
+    rt = pd.to_numeric(trials['RT_ms'], errors='coerce').to_numpy(dtype=float)
+    answered = trials['KEY'].isin(['left', 'right']).to_numpy() & (rt >= 0)
+    modality = trials['Modality'].str.lower().to_numpy()
+    condition = trials['condition'].astype(str).to_numpy()
+
+    frames = [
+        pd.DataFrame({'regressor': 'sentence_' + condition + '_' + modality, 'onset': sentence_onset, 'duration': duration}),
+        pd.DataFrame({'regressor': 'cue', 'onset': onset[cue_shown], 'duration': float(CUE_DURATION)}),
+        pd.DataFrame({'regressor': 'probe_' + modality, 'onset': probe_onset, 'duration': float(PROBE_DURATION)}),
+        pd.DataFrame({'regressor': 'response', 'onset': (probe_onset + PROBE_DURATION + rt)[answered], 'duration': 0.0}),
+    ]
+    if word_regressors:
+        visual = modality == 'visual'
+        n_words = schedule['word_count'].to_numpy()[idx][visual]
+        trial_of_word = np.repeat(np.arange(visual.sum()), n_words)
+        position = np.arange(n_words.sum()) - np.repeat(np.cumsum(n_words) - n_words, n_words)
+        word_onset = sentence_onset[visual][trial_of_word] + position * (STIMULUS_ONTIME + STIMULUS_ITI)
+        frames.append(pd.DataFrame({'regressor': 'word_' + (position + 1).astype(str),
+                                    'onset': word_onset, 'duration': float(STIMULUS_ONTIME)}))
+    phases = pd.concat(frames, ignore_index=True)
+    phases[['onset', 'duration']] /= 1000.0
+    return phases
+
+
+def build_design(phases, n_scans, tr=DEFAULT_TR, dt=OVERSAMPLING):
+    """HRF-convolved regressors sampled at scan times; returns (names, matrix n_scans x n_regressors)."""
+    names = sorted(phases['regressor'].unique())
+    n_fine = int(np.ceil(n_scans * tr / dt))
+    column = pd.Categorical(phases['regressor'], categories=names).codes
+    start = np.clip(np.round(phases['onset'].to_numpy() / dt).astype(int), 0, n_fine)
+    # Zero-duration events (responses) still get one grid step
+    stop = np.clip(np.maximum(start + 1, np.round((phases['onset'] + phases['duration']).to_numpy() / dt).astype(int)), 0, n_fine)
+
+    # Boxcars via +1/-1 edges and a cumulative sum, all regressors at once
+    edges = np.zeros((n_fine + 1, len(names)))
+    np.add.at(edges, (start, column), 1.0)
+    np.add.at(edges, (stop, column), -1.0)
+    boxcars = np.cumsum(edges[:-1], axis=0)
+
+    hrf = spm_hrf(dt)
+    n_fft = 1 << int(np.ceil(np.log2(n_fine + len(hrf))))
+    convolved = np.fft.irfft(np.fft.rfft(boxcars, n_fft, axis=0) * np.fft.rfft(hrf, n_fft)[:, None], n_fft, axis=0)[:n_fine]
+    scan_idx = np.minimum(np.round(np.arange(n_scans) * tr / dt).astype(int), n_fine - 1)
+    return names, convolved[scan_idx]
+
+
+def run_n_scans(stim_df, tr):
+    """Scans needed to cover the scheduled run (expected duration / TR)."""
+    schedule = compile_schedule(stim_df)
+    return int(np.ceil((schedule['next_onset'].iloc[-1] + FINAL_WAIT) / 1000.0 / tr))
+
+
+def build_run(path, out_dir, tr=DEFAULT_TR, n_scans=None, word_regressors=False, stimuli_root=None):
+    """Design matrix of one result file, cached as <out_dir>/sub-XX_run-N_design.npz."""
+    info, results = read_xpd(path)
+    identity = run_identity(path, info)
+    if identity is None or results.empty:
+        return None
+    subject_id, run_number = identity
+    target = Path(out_dir) / f"sub-{subject_id}_run-{run_number}_design.npz"
+    signature = json.dumps([str(path), file_signature(path), file_signature(stimulus_csv(subject_id, run_number, stimuli_root)),
+                            tr, n_scans, word_regressors, OVERSAMPLING])
+    if target.is_file():
+        with np.load(target, allow_pickle=False) as cached:
+            if str(cached['signature']) == signature:
+                return target, False
+
+    stim_df = read_stimulus_csv(subject_id, run_number, stimuli_root)
+    phases = trial_phases(results, stim_df, word_regressors)
+    names, matrix = build_design(phases, n_scans or run_n_scans(stim_df, tr), tr)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    np.savez(target, matrix=matrix, names=np.array(names), frame_times=np.arange(len(matrix)) * tr, signature=signature)
+    return target, True
+
+
+def load_design(npz_path):
+    """Design matrix as a DataFrame indexed by frame time (s)."""
+    with np.load(npz_path, allow_pickle=False) as data:
+        return pd.DataFrame(data['matrix'], columns=[str(n) for n in data['names']], index=pd.Index(data['frame_times'], name='time'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build HRF-convolved design matrices for every run.")
+    parser.add_argument("--project_root", type=str, default=str(PROJECT_ROOT))
+    parser.add_argument("--tr", type=float, default=DEFAULT_TR, help=f"Repetition time in s (default {DEFAULT_TR})")
+    parser.add_argument("--n_scans", type=int, default=None, help="Scans per run (default: scheduled run duration / TR)")
+    parser.add_argument("--word_regressors", action="store_true", help="Add one regressor per visual word position")
+    parser.add_argument("--out", type=str, default=None, help="Output folder (default: <project_root>/design)")
+    args = parser.parse_args()
+
+    project_root = Path(args.project_root)
+    out_dir = Path(args.out) if args.out else project_root / "design"
+    built = cached = 0
+    for path in main_run_results(project_root).values():
+        try:
+            result = build_run(path, out_dir, args.tr, args.n_scans, args.word_regressors, project_root / "Stimuli")
+        except (OSError, KeyError, ValueError) as e:
+            print(f"Error building design for {path}: {e}")
+            continue
+        if result is None:
+            continue
+        target, rebuilt = result
+        built += rebuilt
+        cached += not rebuilt
+        if rebuilt:
+            print(f"{path} -> {target}")
+    if built + cached == 0:
+        print("No main-run results found; no design matrices to build.")
+        return
+    print(f"{built} design matrices built, {cached} up to date")
+
+
+if __name__ == "__main__":
+    main()
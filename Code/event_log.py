@@ -0,0 +1,127 @@
+# '''
+# Buffered event logging for Expyriment runs.
+#
+# Expyriment formats and appends an .xpe line for every present, play and key
+# event as it happens, with the full path of every sound and picture.
+# BufferedEventLog stands in for exp.events: log() only reads the clock and
+# keeps (time, event, tag) in memory; warn() is buffered the same way.
+# flush() (called during the ITI and at the end of the run) writes the
+# pending lines to the real event file in the standard "time,Type,Event,Value"
+# format. File paths are replaced by compact IDs (@1, @2, ...), each listed
+# once in a "# @N = path" comment line, which read_xpe and other .xpe readers
+# skip.
+#
+# The detail logged per phase of a trial (cue, sentence, probe, response,
+# iti) is set with log levels (0 = off, 1 = default, 2 = extensive), e.g.
+# parse_levels("sentence=0,response=2").
+#
+# Project: Long-Range Agreement Pilot
+# '''
+
+import os
+import atexit
+
+PHASES = ("cue", "sentence", "probe", "response", "iti")
+DEFAULT_LEVEL = 1 # Expyriment's default event_logging
+
+
+def parse_levels(spec):
+    """'sentence=0,response=2' -> {'sentence': 0, 'response': 2}; raises ValueError on unknown phases."""
+    levels = {}
+    for part in (spec or "").split(','):
+        if not part.strip():
+            continue
+        phase, _, level = part.partition('=')
+        phase = phase.strip().lower()
+        if phase not in PHASES:
+            raise ValueError(f"unknown phase '{phase}' (expected one of {', '.join(PHASES)})")
+        levels[phase] = int(level)
+    return levels
+
+
+def _path_value(value):
+    """The file path in an event's Value field (e.g. b'/x/y.wav' or /x/y.png), or None."""
+    if value[:2] in ("b'", 'b"') and value[-1:] == value[1]:
+        value = value[2:-1]
+    return value if os.sep in value else None
+
+
+class BufferedEventLog:
+    """Stands in for exp.events; events are written to the event file on flush() only."""
+
+    def __init__(self, exp, levels=None):
+        self.exp = exp
+        self.levels = {phase: DEFAULT_LEVEL for phase in PHASES}
+        self.levels.update(levels or {})
+        self._file = exp.events # The real EventFile; everything else is delegated to it
+        self._clock = self._file.clock
+        self._pending = []
+        self._path_ids = {}
+        self.current_phase = None
+
+    def install(self):
+        """Route Expyriment's event logging through this buffer."""
+        self.exp._events = self
+        atexit.register(self.flush) # Runs before Expyriment's own atexit save (registered earlier)
+        return self
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def log(self, event, log_event_tag=None):
+        """Called by Expyriment for every event; only timestamps and keeps it."""
+        log_time = self._clock.time
+        if not isinstance(event, (str, bytes)): # As EventFile.log does
+            event = str(event)
+        self._pending.append((log_time, event, log_event_tag))
+        return log_time
+
+    def warn(self, message):
+        """Keep a warning line (written as EventFile.warn would, on flush())."""
+        self._pending.append((None, "WARNING: " + message, None))
+
+    def phase(self, name):
+        """Enter a trial phase: sets the experiment's log level for it."""
+        if name != self.current_phase:
+            self.current_phase = name
+            self.exp.set_log_level(self.levels[name])
+
+    def _compact(self, event):
+        """Replace a file path in the Value field by its compact ID (first use is listed as a comment)."""
+        fields = event.split(',', 3)
+        if len(fields) < 3:
+            return event
+        path = _path_value(fields[2])
+        if path is None:
+            return event
+        if path not in self._path_ids:
+            self._path_ids[path] = f"@{len(self._path_ids) + 1}"
+            self._file.write_comment(f"{self._path_ids[path]} = {path}")
+        fields[2] = self._path_ids[path]
+        return ','.join(fields)
+
+    def _add_interval(self, tag, log_time):
+        # Compatibility point: EventFile.log() records tagged events in its private
+        # _inter_event_intervall_log (summarised at exit) and has no public way to
+        # add an event without writing it, so the buffer feeds that log here only.
+        self._file._inter_event_intervall_log.add_event(tag, log_time)
+
+    def flush(self):
+        """Write the pending events to the event file and save it; returns the number written."""
+        pending, self._pending = self._pending, []
+        delimiter = self._file.delimiter
+        for log_time, event, tag in pending:
+            if isinstance(event, bytes):
+                event = event.decode('utf-8', 'replace')
+            if log_time is None: # A warning
+                self._file.write_line(event)
+                continue
+            self._file.write_line(repr(log_time) + delimiter + self._compact(event))
+            if tag is not None:
+                self._add_interval(tag, log_time)
+        self._file.save()
+        return len(pending)
+
+    def save(self):
+        # control.end() saves exp.events; make sure the buffer goes with it
+        self.flush()
@@ -0,0 +1,243 @@
+# '''
+# Batch exporter of BIDS-style events.tsv files.
+#
+# Converts every main-experiment result (data/*.xpd, Logs/subject_XX_LRA_N.csv,
+# with the matching events/*.xpe) and every localizer data file into
+#
+#     <out>/sub-XX/func/sub-XX_task-lra_run-N_events.tsv
+#     <out>/sub-XX/func/sub-XX_task-localizer_events.tsv
+#
+# with one row per phase (cue, sentence, probe, response) and the stimulus CSV
+# columns (condition, violation, viol_loc, ...) joined back on TrialNumber.
+# When acoustics/trial_acoustics.csv exists (python Code/speech_onsets.py),
+# auditory trials also get speech_onset_ms and critical_onset_ms (ms from the
+# start of the sentence WAV).
+# Files are converted in parallel, and a manifest in <out> records what each
+# output was built from so only new or changed results are re-exported.
+#
+# Usage: python Code/export_bids_events.py [--out bids] [--jobs N] [--force]
+#
+# Project: Long-Range Agreement Pilot
+# '''
+
+import os
+import sys
+import json
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from results_io import (PROJECT_ROOT, read_xpd, read_xpe, stimulus_csv, read_stimulus_csv,
+                        main_run_results, find_localizer_results, matching_event_file, file_signature)
+from schedule import compile_schedule, CUE_DURATION, SOA_PROBE, PROBE_DURATION
+from speech_onsets import load_trial_acoustics
+
+MANIFEST_NAME = ".events_manifest.json"
+STIMULUS_COLUMNS = ['trial', 'condition', 'structure', 'violation', 'congruency', 'interference',
+                    'viol_loc', 'probe_word', 'probe']
+TRIGGER_KEYS = {'t', '116'}
+RESPONSE_KEYS = {'y': 'left', '121': 'left', 'f': 'right', '102': 'right'}
+
+
+def bids_label(value):
+    return "".join(ch for ch in str(value) if ch.isalnum())
+
+
+def main_run_target(out_dir, subject_id, run_number):
+    sub = bids_label(subject_id)
+    return Path(out_dir) / f"sub-{sub}" / "func" / f"sub-{sub}_task-lra_run-{run_number}_events.tsv"
+
+
+def localizer_target(out_dir, subject_id):
+    sub = bids_label(subject_id)
+    return Path(out_dir) / f"sub-{sub}" / "func" / f"sub-{sub}_task-localizer_events.tsv"
+
+
+def main_run_events(results, stim_df, xpe=None, acoustics=None):
+    """Phase events (onsets in s from scanner sync) for one main-experiment run.
+
+    `acoustics` holds this run's rows of trial_acoustics.csv, if available.
+    """
+    schedule = compile_schedule(stim_df)
+    trials = results.merge(stim_df[['TrialNumber'] + [c for c in STIMULUS_COLUMNS if c in stim_df.columns]],
+                           on='TrialNumber', how='left')
+    idx = trials['TrialNumber'].to_numpy() - 1
+    cue_shown = schedule['cue_shown'].to_numpy()[idx]
+    planned_duration = schedule['stim_duration'].to_numpy()[idx]
+
+    onset = trials['TrialOnset_ms'].to_numpy(dtype=float)
+    sentence_onset = onset + cue_shown * 2 * CUE_DURATION
+    logged_duration = trials['StimulusDuration_ms'].to_numpy(dtype=float)
+    sentence_duration = np.where(logged_duration > 0, logged_duration, planned_duration)
+    probe_onset = sentence_onset + sentence_duration + SOA_PROBE
+    rt = pd.to_numeric(trials['RT_ms'], errors='coerce').to_numpy(dtype=float)
+    answered = trials['KEY'].isin(['left', 'right']).to_numpy() & (rt >= 0)
+
+    # The stimulus CSV is authoritative for the trial metadata; the log adds key and RT
+    meta = trials.drop(columns=['TrialOnset_ms', 'StimulusDuration_ms', 'subject_id', 'Structure'], errors='ignore')
+    meta = meta.rename(columns={'TrialNumber': 'trial_number', 'Sentence': 'sentence',
+                                'Modality': 'modality', 'KEY': 'key', 'RT_ms': 'response_time_ms'})
+    if acoustics is not None and not acoustics.empty:
+        meta = meta.merge(acoustics[['trial_number', 'speech_onset_ms', 'critical_onset_ms']], on='trial_number', how='left')
+    phases = [
+        ('cue', onset, np.full(len(trials), CUE_DURATION, dtype=float), cue_shown),
+        ('sentence', sentence_onset, sentence_duration, np.ones(len(trials), dtype=bool)),
+        ('probe', probe_onset, np.full(len(trials), PROBE_DURATION, dtype=float), np.ones(len(trials), dtype=bool)),
+        ('response', probe_onset + PROBE_DURATION + np.where(answered, rt, 0), np.zeros(len(trials)), answered),
+    ]
+    frames = []
+    for trial_type, phase_onset, duration, mask in phases:
+        frame = meta[mask].copy()
+        frame.insert(0, 'onset', phase_onset[mask] / 1000.0)
+        frame.insert(1, 'duration', duration[mask] / 1000.0)
+        frame.insert(2, 'trial_type', trial_type)
+        frames.append(frame)
+
+    if xpe is not None:
+        frames.append(button_press_events(xpe))
+    events = pd.concat(frames, ignore_index=True)
+    for column in ('trial_number', 'viol_loc'):
+        if column in events.columns:
+            events[column] = events[column].astype('Int64') # Integers with n/a for button presses / no violation
+    return events.sort_values(['onset', 'trial_type'], kind='stable').reset_index(drop=True)
+
+
+def button_press_events(xpe):
+    """Every response-button press in an .xpe, relative to the last scanner trigger."""
+    keys = xpe[(xpe['Type'] == 'Keyboard') & (xpe['Event'] == 'received')]
+    triggers = keys[keys['Value'].isin(TRIGGER_KEYS)]
+    if triggers.empty:
+        return pd.DataFrame(columns=['onset', 'duration', 'trial_type'])
+    sync = triggers['Time'].iloc[-1]
+    presses = keys[(keys['Time'] > sync) & keys['Value'].isin(RESPONSE_KEYS.keys())]
+    return pd.DataFrame({
+        'onset': (presses['Time'].to_numpy() - sync) / 1000.0,
+        'duration': 0.0,
+        'trial_type': 'button_press',
+        'key': presses['Value'].map(RESPONSE_KEYS).to_numpy(),
+    })
+
+
+def localizer_events(df):
+    """Sentence events of a localizer run (onsets in s from the localizer clock start)."""
+    if 'real_sentence_onset_before' in df.columns:
+        onset = df['real_sentence_onset_before']
+        onset_error = df['real_sentence_onset_before'] - df['sent_onset']
+    else:
+        onset = df['real_sentence_onset'] # Older files (training script) log a single onset
+        onset_error = df['real_sentence_onset'] - df['sent_onset']
+    events = pd.DataFrame({
+        'onset': onset.to_numpy(dtype=float) / 1000.0,
+        'duration': (df['sent_dur'].to_numpy(dtype=float) / 1000.0 if 'sent_dur' in df.columns else np.nan),
+        'trial_type': df['langue'].to_numpy(),
+        'block': df['nbloc'].to_numpy(),
+        'planned_onset': df['sent_onset'].to_numpy(dtype=float) / 1000.0,
+        'onset_error_ms': onset_error.to_numpy(dtype=float),
+        'stim_file': df['filename'].to_numpy() if 'filename' in df.columns else '',
+    })
+    return events.sort_values('onset', kind='stable').reset_index(drop=True)
+
+
+def export_job(job):
+    """Convert one result file; runs in a worker process."""
+    kind, source, target, subject_id, run_number, stimuli_root = job
+    try:
+        _info, df = read_xpd(source)
+        if kind == 'main':
+            xpe_path = matching_event_file(source)
+            xpe = read_xpe(xpe_path) if xpe_path else None
+            acoustics = load_trial_acoustics(acoustics_dir(stimuli_root))
+            if acoustics is not None:
+                acoustics = acoustics[(acoustics['subject_id'] == str(subject_id)) & (acoustics['run_number'] == int(run_number))]
+            events = main_run_events(df, read_stimulus_csv(subject_id, run_number, stimuli_root), xpe, acoustics)
+        else:
+            events = localizer_events(df)
+        Path(target).parent.mkdir(parents=True, exist_ok=True)
+        events[['onset', 'duration']] = events[['onset', 'duration']].round(3)
+        events.to_csv(target, sep='\t', index=False, na_rep='n/a')
+        return source, target, len(events), None
+    except Exception as e:
+        return source, target, 0, str(e)
+
+
+def collect_jobs(project_root, out_dir, stimuli_root):
+    """One job per output file; when a run was attempted several times, keep the fullest (then latest) file."""
+    jobs = [('main', str(path), str(main_run_target(out_dir, *identity)), identity[0], identity[1], stimuli_root)
+            for identity, path in main_run_results(project_root).items()]
+    candidates = {}
+    for path in find_localizer_results(project_root):
+        _info, df = read_xpd(path)
+        if df.empty or 'subj' not in df.columns:
+            continue
+        subject_id = f"{int(df['subj'].iloc[0]):02d}"
+        target = localizer_target(out_dir, subject_id)
+        rank = (len(df), path.stat().st_mtime_ns)
+        if target not in candidates or rank > candidates[target][0]:
+            candidates[target] = (rank, ('localizer', str(path), str(target), subject_id, None, stimuli_root))
+    return jobs + [job for _rank, job in candidates.values()]
+
+
+def acoustics_dir(stimuli_root):
+    """acoustics/ folder next to the Stimuli folder."""
+    return Path(stimuli_root).parent / "acoustics"
+
+
+def job_signature(job):
+    kind, source, target, subject_id, run_number, stimuli_root = job
+    inputs = [source]
+    if kind == 'main':
+        inputs.append(str(stimulus_csv(subject_id, run_number, stimuli_root)))
+        trial_acoustics = acoustics_dir(stimuli_root) / "trial_acoustics.csv"
+        if trial_acoustics.is_file():
+            inputs.append(str(trial_acoustics))
+        xpe = matching_event_file(source)
+        if xpe:
+            inputs.append(str(xpe))
+    return {p: file_signature(p) for p in inputs}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export BIDS-style events.tsv files for all runs and localizers.")
+    parser.add_argument("--project_root", type=str, default=str(PROJECT_ROOT), help="Folder holding data/, events/, Logs/ and localizer/")
+    parser.add_argument("--stimuli_root", type=str, default=None, help="Stimuli folder (default: <project_root>/Stimuli)")
+    parser.add_argument("--out", type=str, default=None, help="Output folder (default: <project_root>/bids)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument("--force", action="store_true", help="Re-export everything, ignoring the manifest")
+    args = parser.parse_args()
+
+    project_root = Path(args.project_root).resolve()
+    stimuli_root = args.stimuli_root or str(project_root / "Stimuli")
+    out_dir = Path(args.out) if args.out else project_root / "bids"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = out_dir / MANIFEST_NAME
+    manifest = {} if args.force or not manifest_path.is_file() else json.loads(manifest_path.read_text())
+
+    jobs = collect_jobs(project_root, out_dir, stimuli_root)
+    todo = []
+    for job in jobs:
+        target = job[2]
+        signature = job_signature(job)
+        if manifest.get(target) != signature or not Path(target).is_file():
+            todo.append((job, signature))
+    print(f"{len(jobs)} outputs, {len(jobs) - len(todo)} up to date, {len(todo)} to export")
+
+    errors = 0
+    if todo:
+        with ProcessPoolExecutor(max_workers=max(1, min(args.jobs or 1, len(todo)))) as pool:
+            for (job, signature), (source, target, n_events, error) in zip(todo, pool.map(export_job, [j for j, _s in todo])):
+                if error:
+                    errors += 1
+                    print(f"Error exporting {source}: {error}")
+                    manifest.pop(target, None)
+                else:
+                    manifest[target] = signature
+                    print(f"{source} -> {target} ({n_events} events)")
+    manifest_path.write_text(json.dumps(manifest, indent=1, sort_keys=True))
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+# '''
+# Golden-timeline regression corpus for long_range.py.
+#
+# Every run CSV under Stimuli/ is replayed through the unmodified
+# long_range.py without a display or sound card: expyriment (and pygame) are
+# replaced, inside worker processes only, by a simulated backend with a
+# virtual clock. Waits advance the clock instead of sleeping, the scanner and
+# experimenter keys arrive immediately and every response window times out.
+# Each present/play/stop is recorded with its trial number, trial phase (as
+# set through event_log.phase) and onset relative to scanner sync, which
+# gives the run's per-phase timeline.
+#
+#     python Code/golden_timeline.py record     # (re)write golden_timelines/
+#     python Code/golden_timeline.py check      # replay the current code and diff
+#
+# check reports every event whose onset moved by more than --tolerance ms
+# (and the first event where the sequence itself differs), and exits with 2
+# if any run changed. Intended timing changes are accepted by re-recording.
+#
+# Project: Long-Range Agreement Pilot
+# '''
+
+import io
+import sys
+import time
+import types
+import argparse
+import contextlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from schedule import find_run_csvs
+
+CODE_DIR = Path(__file__).parent.resolve()
+PROJECT_ROOT = CODE_DIR.parent
+EXPERIMENT_SCRIPT = CODE_DIR / "long_range.py"
+GOLDEN_DIR = PROJECT_ROOT / "golden_timelines"
+TIMELINE_COLUMNS = ['seq', 'trial', 'phase', 'action', 'stimulus', 'onset_ms']
+CLOCK_TICK = 0.01 # ms the virtual clock advances per read, so spin-waits terminate
+DEFAULT_TOLERANCE = 1.0 # ms
+
+
+class VirtualClock:
+    """Stands in for exp.clock: time only advances when read or slept on."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    @property
+    def time(self):
+        self.now += CLOCK_TICK
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds * 1000.0
+
+    def wait(self, ms, *args, **kwargs):
+        self.now += ms
+
+
+class Recorder:
+    """Collects the timeline events of one replay."""
+
+    def __init__(self, clock, script_globals):
+        self.clock = clock
+        self.script_globals = script_globals # long_range.py's namespace (trial number, event_log phase)
+        self.events = []
+
+    def record(self, action, stimulus):
+        event_log = self.script_globals.get('event_log')
+        phase = getattr(event_log, 'current_phase', None) or 'setup'
+        self.events.append((self.script_globals.get('trial_id_one_based', 0), phase, action, stimulus, self.clock.now))
+
+
+def simulated_modules(clock, recorder):
+    """Module objects replacing expyriment and pygame in a replay worker."""
+
+    class Stimulus:
+        _id_counter = 0
+
+        def __init__(self, label):
+            self.label = label
+            self.id = Stimulus._id_counter
+            Stimulus._id_counter += 1
+            self._file = None
+            self._logging = True
+            self.surface_size = (0, 0)
+
+        def preload(self):
+            pass
+
+        def unload(self):
+            pass
+
+        def set_logging(self, onoff):
+            self._logging = onoff
+
+        def scale_to_fullscreen(self):
+            pass
+
+        def present(self, clear=True, update=True, *args, **kwargs):
+            if update: # Back-buffer draws (present latency calibration) are never shown
+                recorder.record('present', self.label)
+
+    class Audio(Stimulus):
+        def __init__(self, filename):
+            super().__init__(Path(filename).name)
+            self.filename = filename
+
+        def play(self, *args, **kwargs):
+            recorder.record('play', self.label)
+
+        def stop(self):
+            recorder.record('stop', self.label)
+
+    class Keyboard:
+        def check(self, keys=None, *args, **kwargs):
+            return None
+
+        def wait(self, keys=None, duration=None, *args, **kwargs):
+            # Scanner/experimenter keys arrive at once; response windows time out
+            if duration is not None:
+                clock.wait(duration)
+                return None, None
+            return keys, 0
+
+    class EventFile:
+        delimiter = ','
+        _inter_event_intervall_log = types.SimpleNamespace(add_event=lambda tag, log_time: None)
+
+        def __init__(self):
+            self.clock = clock
+
+        def log(self, event, log_event_tag=None):
+            return clock.now
+
+        def write_line(self, content):
+            pass
+
+        def write_comment(self, comment):
+            pass
+
+        def save(self):
+            pass
+
+    class DataFile:
+        def __init__(self, *args, **kwargs):
+            self.rows = []
+
+        def add(self, row):
+            self.rows.append(row)
+
+        def add_experiment_info(self, text):
+            pass
+
+        def save(self):
+            pass
+
+    class Experiment:
+        def __init__(self, name=None, *args, **kwargs):
+            self.name = name
+            self.clock = clock
+            self.keyboard = Keyboard()
+            self.data = DataFile()
+            self.data_variable_names = []
+            self._events = EventFile()
+
+        @property
+        def events(self):
+            return self._events
+
+        def add_experiment_info(self, text):
+            pass
+
+        def set_log_level(self, loglevel):
+            pass
+
+    def end(*args, **kwargs):
+        recorder.record('end', 'run')
+        recorder.experiment.events.save()
+
+    def initialize(exp):
+        recorder.experiment = exp
+        return exp
+
+    expyriment = types.ModuleType('expyriment')
+    expyriment.design = types.SimpleNamespace(Experiment=Experiment)
+    expyriment.control = types.SimpleNamespace(
+        defaults=types.SimpleNamespace(), set_develop_mode=lambda *a, **k: None,
+        initialize=initialize, start=lambda *a, **k: None, end=end)
+    expyriment.stimuli = types.SimpleNamespace(
+        Audio=Audio, Picture=lambda path: Stimulus(Path(path).name), TextLine=lambda text, **k: Stimulus(text),
+        TextScreen=lambda heading, text, **k: Stimulus(heading), FixCross=lambda **k: Stimulus('fixation'),
+        BlankScreen=lambda **k: Stimulus('blank'))
+    expyriment.misc = types.SimpleNamespace(constants=types.SimpleNamespace(
+        K_y=ord('y'), K_f=ord('f'), K_t=ord('t'), K_SPACE=ord(' '), K_ESCAPE=27))
+    expyriment.io = types.SimpleNamespace(DataFile=DataFile)
+    pygame = types.ModuleType('pygame')
+    pygame.mixer = types.SimpleNamespace(get_init=lambda: None,
+                                         Sound=lambda file=None, buffer=None: types.SimpleNamespace(get_length=lambda: 0.0))
+    pygame.sndarray = types.SimpleNamespace(array=lambda sound: None)
+    return {'expyriment': expyriment, 'pygame': pygame}
+
+
+# Modules of Code/ that import expyriment and must be re-imported against the simulated backend
+_EXPERIMENT_MODULES = ('trial_runtime', 'stimulus_store', 'event_log', 'audio_output', 'live_monitor', 'schedule')
+
+
+def replay_run(run_folder):
+    """Worker: run long_range.py on `run_folder` with the simulated backend; returns (timeline, end_ms, output).
+
+    end_ms is the time of control.end(), i.e. the length of the run.
+    """
+    clock = VirtualClock()
+    script_globals = {'__name__': '__main__', '__file__': str(EXPERIMENT_SCRIPT)}
+    recorder = Recorder(clock, script_globals)
+    saved = {name: sys.modules.get(name) for name in ('expyriment', 'pygame') + _EXPERIMENT_MODULES}
+    saved_argv, saved_sleep = sys.argv, time.sleep
+    sys.modules.update(simulated_modules(clock, recorder))
+    for name in _EXPERIMENT_MODULES:
+        sys.modules.pop(name, None)
+    sys.path.insert(0, str(CODE_DIR))
+    sys.argv = [str(EXPERIMENT_SCRIPT), str(run_folder)]
+    time.sleep = clock.sleep # trial_runtime sleeps between escape-key polls
+    output = io.StringIO()
+    try:
+        code = compile(EXPERIMENT_SCRIPT.read_text(encoding='utf-8'), str(EXPERIMENT_SCRIPT), 'exec')
+        with contextlib.redirect_stdout(output):
+            try:
+                exec(code, script_globals)
+            except SystemExit as e:
+                if e.code not in (None, 0):
+                    raise RuntimeError(f"long_range.py exited with {e.code}")
+    except Exception as e:
+        return None, None, f"{output.getvalue()}\n{type(e).__name__}: {e}"
+    finally:
+        time.sleep, sys.argv = saved_sleep, saved_argv
+        sys.path.remove(str(CODE_DIR))
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    start = script_globals['runtime'].start_time
+    timeline = pd.DataFrame(recorder.events, columns=TIMELINE_COLUMNS[1:])
+    timeline.insert(0, 'seq', range(len(timeline)))
+    timeline['onset_ms'] = (timeline['onset_ms'] - start).round(2)
+    return timeline, timeline['onset_ms'].iloc[-1], output.getvalue()
+
+
+def golden_path(golden_dir, subject_id, run_number):
+    return Path(golden_dir) / f"sub_{subject_id}_run_{run_number}_timeline.csv"
+
+
+def replay_all(runs, jobs):
+    """Replay every run in worker processes (the simulated backend never enters this process)."""
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(replay_run, [csv_path.parent for _s, _r, csv_path in runs]))
+
+
+def diff_timelines(golden, current, tolerance):
+    """List of differences between two timelines of a run (empty when equivalent)."""
+    keys = ['trial', 'phase', 'action', 'stimulus']
+    n = min(len(golden), len(current))
+    g, c = golden.iloc[:n].reset_index(drop=True), current.iloc[:n].reset_index(drop=True)
+    same = (g[keys].astype(str) == c[keys].astype(str)).all(axis=1)
+    problems = []
+    if not same.all() or len(golden) != len(current):
+        first = int((~same).idxmax()) if not same.all() else n
+        want = ' '.join(map(str, golden.iloc[first][keys])) if first < len(golden) else "end of run"
+        got = ' '.join(map(str, current.iloc[first][keys])) if first < len(current) else "end of run"
+        problems.append(f"event sequence differs at #{first}: golden '{want}', now '{got}' "
+                        f"({len(golden)} vs {len(current)} events)")
+        n = first
+    moved = (c['onset_ms'].iloc[:n] - g['onset_ms'].iloc[:n]).abs() > tolerance
+    for i in moved[moved].index:
+        problems.append(f"trial {g.at[i, 'trial']} {g.at[i, 'phase']} {g.at[i, 'action']} {g.at[i, 'stimulus']}: "
+                        f"{g.at[i, 'onset_ms']:.2f} -> {c.at[i, 'onset_ms']:.2f} ms "
+                        f"({c.at[i, 'onset_ms'] - g.at[i, 'onset_ms']:+.2f})")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record or check golden per-phase timelines of every run.")
+    parser.add_argument("command", choices=["record", "check"])
+    parser.add_argument("--stimuli_root", type=str, default=str(PROJECT_ROOT / "Stimuli"),
+                        help="Folder searched recursively for sub_XX_run_Y.csv files (default: ../Stimuli)")
+    parser.add_argument("--golden", type=str, default=str(GOLDEN_DIR), help="Golden timeline folder")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help=f"Largest onset change (ms) not reported (default {DEFAULT_TOLERANCE})")
+    parser.add_argument("--max_report", type=int, default=10, help="Differences printed per run")
+    parser.add_argument("--jobs", type=int, default=None, help="Worker processes")
+    args = parser.parse_args()
+
+    runs = find_run_csvs(args.stimuli_root)
+    if not runs:
+        print(f"Error: No run CSV found under {args.stimuli_root}")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    results = replay_all(runs, args.jobs)
+    elapsed = time.perf_counter() - start
+
+    failed = changed = 0
+    Path(args.golden).mkdir(parents=True, exist_ok=True)
+    for (subject_id, run_number, _csv), (timeline, end_ms, output) in zip(runs, results):
+        name = f"sub_{subject_id}_run_{run_number}"
+        if timeline is None:
+            failed += 1
+            print(f"{name}: replay failed\n{output.strip()}")
+            continue
+        path = golden_path(args.golden, subject_id, run_number)
+        if args.command == "record":
+            timeline.to_csv(path, index=False)
+            print(f"{name}: {len(timeline)} events, ends at {end_ms / 1000.0:.2f} s -> {path.name}")
+            continue
+        if not path.is_file():
+            changed += 1
+            print(f"{name}: no golden timeline ({path.name}); run 'record' first")
+            continue
+        problems = diff_timelines(pd.read_csv(path, keep_default_na=False), timeline, args.tolerance)
+        if problems:
+            changed += 1
+            print(f"{name}: {len(problems)} difference(s)")
+            for line in problems[:args.max_report]:
+                print(f"    {line}")
+            if len(problems) > args.max_report:
+                print(f"    ... {len(problems) - args.max_report} more")
+    print(f"Replayed {len(runs)} runs in {elapsed:.1f} s"
+          + ("" if args.command == "record" else f": {changed} changed, {failed} failed"))
+    if failed:
+        sys.exit(1)
+    if changed:
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
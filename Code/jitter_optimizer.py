@@ -0,0 +1,188 @@
+# '''
+# Rest-duration jitter and trial-order optimizer for run CSVs.
+#
+# For each run CSV, draws thousands of candidate runs: trial order shuffled
+# within each modality block (so the cue structure is unchanged) and the
+# run's rest_duration values redistributed across trials. Candidates only
+# permute the run's own trials and rests, so every candidate has the run's
+# total length by construction (a run over its 478 s / 130 s budget is
+# reported as such; schedule.py checks the budgets). Each
+# candidate's design matrix (sentence condition x modality and probe
+# regressors, HRF-convolved, sampled at the TR) is built under the
+# long_range.py timing model, and candidates are scored by design efficiency
+# 1 / trace((X'X)^-1) with batched linear algebra. Batches are spread over a
+# process pool.
+#
+# Usage:
+#     python Code/jitter_optimizer.py Stimuli/subject_04/sub_04_run_*/sub_04_run_*.csv [--candidates 5000] [--write]
+#
+# Project: Long-Range Agreement Pilot
+# '''
+
+import os
+import sys
+import time
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from schedule import (compile_schedule, expected_total_duration, run_budget, RUN_CSV_PATTERN, INITIAL_WAIT,
+                      CUE_DURATION, SOA_PROBE, PROBE_DURATION)
+from design_matrix import spm_hrf, DEFAULT_TR, OVERSAMPLING
+
+BATCH_SIZE = 64   # candidates evaluated together per array operation
+
+
+class RunTemplate:
+    """Arrays describing one run CSV, shared by every candidate."""
+
+    def __init__(self, csv_path, tr):
+        self.csv_path = Path(csv_path)
+        self.df = pd.read_csv(csv_path)
+        self.tr = tr
+        schedule = compile_schedule(self.df)
+        self.n = len(self.df)
+        self.cue_shown = schedule['cue_shown'].to_numpy()
+        self.stim_duration = schedule['stim_duration'].to_numpy(dtype=float)
+        self.rest = schedule['rest_ms'].to_numpy(dtype=float)
+        modality = schedule['modality'].to_numpy()
+        # Contiguous modality blocks: trials are only shuffled within their block
+        self.block_id = np.cumsum(self.cue_shown) - 1
+        regressors = ('sentence_' + self.df['condition'].astype(str) + '_' + modality).to_numpy()
+        self.names = sorted(set(regressors)) + ['probe_auditory', 'probe_visual']
+        code = {name: i for i, name in enumerate(self.names)}
+        self.sentence_code = np.array([code[name] for name in regressors])
+        self.probe_code = np.where(modality == 'visual', code['probe_visual'], code['probe_auditory'])
+        match = RUN_CSV_PATTERN.match(self.csv_path.name)
+        self.budget = run_budget(match.group(1) if match else '')
+        self.duration = float(expected_total_duration(schedule).iloc[0])
+        self.n_scans = int(np.ceil(self.duration / 1000.0 / tr))
+
+
+def draw_candidates(template, n_candidates, rng):
+    """Trial orders (within modality blocks) and rest permutations, as (n_candidates x n_trials) arrays."""
+    keys = rng.random((n_candidates, template.n)) + template.block_id[None, :]
+    order = np.argsort(keys, axis=1)
+    rests = rng.permuted(np.tile(template.rest, (n_candidates, 1)), axis=1)
+    return order, rests
+
+
+def candidate_onsets(template, order, rests):
+    """Sentence and probe onsets (ms) of every candidate under the long_range.py timing model."""
+    duration = template.stim_duration[order]
+    block = template.cue_shown * CUE_DURATION + duration + SOA_PROBE + PROBE_DURATION + rests
+    onset = INITIAL_WAIT + np.cumsum(block, axis=1) - block
+    sentence_onset = onset + template.cue_shown * 2 * CUE_DURATION
+    probe_onset = sentence_onset + duration + SOA_PROBE
+    return sentence_onset, duration, probe_onset
+
+
+def design_efficiency(template, order, rests, hrf_integral):
+    """Efficiency 1 / trace((X'X)^-1) over the condition regressors, per candidate.
+
+    A boxcar convolved with the HRF equals the difference of the integrated
+    HRF at its two edges, so X is evaluated directly at the scan times
+    without building a fine-grid signal.
+    """
+    n_cand = len(order)
+    k = len(template.names)
+    sentence_onset, duration, probe_onset = candidate_onsets(template, order, rests)
+    starts = np.concatenate([sentence_onset, probe_onset], axis=1) / 1000.0
+    stops = np.concatenate([sentence_onset + duration, probe_onset + PROBE_DURATION], axis=1) / 1000.0
+    codes = np.concatenate([template.sentence_code[order], template.probe_code[order]], axis=1)
+
+    scan_times = np.arange(template.n_scans) * template.tr
+    def integrated(lag):
+        idx = np.clip(np.round(lag / OVERSAMPLING).astype(int), 0, len(hrf_integral) - 1)
+        return hrf_integral[idx]
+    response = integrated(scan_times[None, None, :] - starts[:, :, None]) - integrated(scan_times[None, None, :] - stops[:, :, None])
+    one_hot = np.eye(k)[codes]
+    X = response.transpose(0, 2, 1) @ one_hot
+    X = np.concatenate([X - X.mean(axis=1, keepdims=True), np.ones((n_cand, template.n_scans, 1))], axis=2)
+
+    xtx = X.transpose(0, 2, 1) @ X
+    cov = np.linalg.pinv(xtx)
+    return 1.0 / np.trace(cov[:, :k, :k], axis1=1, axis2=2)
+
+
+def hrf_integral():
+    """Cumulative SPM HRF on the design_matrix.py grid (0 before onset, 1 after the HRF ends)."""
+    return np.concatenate([[0.0], np.cumsum(spm_hrf(OVERSAMPLING))])
+
+
+def search_chunk(task):
+    """Worker: evaluate `n_candidates` candidates of one run, return the best."""
+    csv_path, tr, n_candidates, seed = task
+    template = RunTemplate(csv_path, tr)
+    rng = np.random.default_rng(seed)
+    hrf_cum = hrf_integral()
+    best = (-np.inf, None, None)
+    for start in range(0, n_candidates, BATCH_SIZE):
+        order, rests = draw_candidates(template, min(BATCH_SIZE, n_candidates - start), rng)
+        efficiency = design_efficiency(template, order, rests, hrf_cum)
+        i = int(np.argmax(efficiency))
+        if efficiency[i] > best[0]:
+            best = (float(efficiency[i]), order[i], rests[i])
+    return csv_path, best
+
+
+def optimize(csv_paths, n_candidates=5000, tr=DEFAULT_TR, seed=None, jobs=None):
+    """Best (efficiency, order, rests) per run CSV, searched in parallel."""
+    jobs = jobs or os.cpu_count() or 1
+    seeds = np.random.SeedSequence(seed)
+    chunks_per_run = max(1, min(jobs, n_candidates // BATCH_SIZE))
+    tasks = []
+    for csv_path, run_seed in zip(csv_paths, seeds.spawn(len(csv_paths))):
+        for chunk_seed in run_seed.spawn(chunks_per_run):
+            tasks.append((str(csv_path), tr, int(np.ceil(n_candidates / chunks_per_run)), chunk_seed))
+    best = {}
+    with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as executor:
+        for csv_path, result in executor.map(search_chunk, tasks):
+            if csv_path not in best or result[0] > best[csv_path][0]:
+                best[csv_path] = result
+    return best
+
+
+def apply_candidate(df, order, rests):
+    """Reordered copy of a run CSV with the new rest durations."""
+    new_df = df.iloc[order].reset_index(drop=True)
+    new_df['rest_duration'] = rests / 1000.0
+    return new_df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search trial orders and rest-duration jitter for design efficiency.")
+    parser.add_argument("csv_paths", nargs='+', help="Run CSV files (sub_XX_run_Y.csv)")
+    parser.add_argument("--candidates", type=int, default=5000, help="Candidates per run (default 5000)")
+    parser.add_argument("--tr", type=float, default=DEFAULT_TR, help=f"Repetition time in s (default {DEFAULT_TR})")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for a reproducible search")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument("--write", action="store_true", help="Overwrite each CSV with its best candidate")
+    args = parser.parse_args()
+
+    for csv_path in args.csv_paths:
+        if not Path(csv_path).is_file():
+            print(f"Error: Run CSV not found: {csv_path}")
+            sys.exit(1)
+
+    start = time.perf_counter()
+    best = optimize(args.csv_paths, args.candidates, args.tr, args.seed, args.jobs)
+    print(f"Searched {args.candidates} candidates x {len(args.csv_paths)} runs in {time.perf_counter() - start:.1f} s")
+
+    hrf_cum = hrf_integral()
+    for csv_path in args.csv_paths:
+        efficiency, order, rests = best[str(csv_path)]
+        template = RunTemplate(csv_path, args.tr)
+        current = design_efficiency(template, np.arange(template.n)[None, :], template.rest[None, :], hrf_cum)[0]
+        over = template.duration > template.budget
+        print(f"{csv_path}: efficiency {current:.4f} -> {efficiency:.4f} ({template.duration / 1000.0:.2f} s run"
+              + (f", over the {template.budget / 1000.0:.0f} s budget)" if over else ")"))
+        if args.write:
+            apply_candidate(template.df, order, rests).to_csv(csv_path, index=False)
+            print(f"  written to {csv_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# '''
+# Live monitoring of a running Long-Range Agreement session.
+#
+# The experiment publishes one small JSON record per trial (timing delta,
+# overrun, response, RT, accuracy) as a UDP datagram to localhost. Sending is
+# non-blocking and fire-and-forget: if no monitor is listening the datagram is
+# simply dropped, so the presentation process never waits on the display.
+#
+# The monitor runs in a separate terminal and redraws a summary view:
+#
+#     python Code/live_monitor.py [--port 5005]
+#
+# Project: Long-Range Agreement Pilot
+# '''
+
+import sys
+import json
+import time
+import socket
+import select
+import argparse
+from collections import defaultdict
+
+MONITOR_HOST = "127.0.0.1"
+MONITOR_PORT = 5005
+DELTA_WARN_MS = 25 # Same threshold as the "!!!" warning printed by long_range.py
+TIMEOUT_KEYS = ("TIMEOUT", "None") # No response in the window (long_range.py logs TIMEOUT)
+
+
+class MonitorPublisher:
+    """Fire-and-forget sender used inside the experiment process."""
+
+    def __init__(self, port=MONITOR_PORT, host=MONITOR_HOST):
+        self._address = (host, port)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+
+    def publish(self, kind, **fields):
+        fields['kind'] = kind
+        try:
+            self._sock.sendto(json.dumps(fields).encode('utf-8'), self._address)
+        except OSError:
+            pass # Never let monitoring interfere with the experiment
+
+    def close(self):
+        self._sock.close()
+
+
+class NullPublisher:
+    """Stands in for MonitorPublisher when monitoring is disabled."""
+
+    def publish(self, kind, **fields):
+        pass
+
+    def close(self):
+        pass
+
+
+# --- Monitor side ---
+
+class SessionView:
+    """Accumulates records and renders them as a text table."""
+
+    def __init__(self):
+        self.session = {}
+        self.trials = []
+        self.last_seen = None
+
+    def add(self, record):
+        self.last_seen = time.time()
+        kind = record.get('kind')
+        if kind == 'session':
+            # A new run started: reset the trial history
+            self.session = record
+            self.trials = []
+        elif kind == 'trial':
+            self.trials.append(record)
+        elif kind == 'end':
+            self.session['ended'] = True
+
+    def _group_lines(self, key):
+        groups = defaultdict(lambda: [0, 0, 0, [], 0]) # n, answered, correct, rts, timeouts
+        for t in self.trials:
+            g = groups[str(t.get(key))]
+            g[0] += 1
+            if t.get('rt', -1) is not None and t.get('rt', -1) >= 0:
+                g[1] += 1
+                g[3].append(t['rt'])
+                if t.get('correct'):
+                    g[2] += 1
+            elif str(t.get('key')) in TIMEOUT_KEYS:
+                g[4] += 1
+        lines = []
+        for name in sorted(groups):
+            n, answered, correct, rts, timeouts = groups[name]
+            acc = f"{100.0 * correct / answered:5.1f}%" if answered else "    -"
+            mean_rt = f"{sum(rts) / len(rts):7.1f}" if rts else "      -"
+            # Neither answered nor timed out: error codes (ERROR, NO_PROBE_AUDIO, ...)
+            lines.append(f"  {name:<12} n={n:<3} answered={answered:<3} acc={acc} RT={mean_rt} ms "
+                         f"timeouts={timeouts} errors={n - answered - timeouts}")
+        return lines
+
+    def render(self):
+        out = []
+        s = self.session
+        title = f"Subject {s.get('subject_id', '?')}  Run {s.get('run_number', '?')}"
+        if s.get('ended'):
+            title += "  (ended)"
+        out.append(title)
+        out.append(f"Trials: {len(self.trials)}/{s.get('num_trials', '?')}   "
+                   f"Expected duration: {s.get('expected_total_duration', 0) / 1000.0:.2f} s")
+        if self.trials:
+            deltas = [t.get('delta', 0) for t in self.trials]
+            overruns = sum(1 for t in self.trials if t.get('overrun'))
+            late = sum(1 for d in deltas if d > DELTA_WARN_MS)
+            out.append(f"Onset delta (ms): last={deltas[-1]:.1f} mean={sum(deltas) / len(deltas):.1f} "
+                       f"max={max(deltas):.1f}  >{DELTA_WARN_MS}ms: {late}  ITI overruns: {overruns}")
+            out.append("")
+            out.append("Recent trials:")
+            for t in self.trials[-8:]:
+                warn = " !!!" if t.get('delta', 0) > DELTA_WARN_MS else ""
+                out.append(f"  {t.get('trial'):>3} {t.get('modality', ''):<9} {t.get('condition', ''):<6} "
+                           f"delta={t.get('delta', 0):6.1f} key={t.get('key', ''):<8} rt={t.get('rt', -1):>6}{warn}")
+            out.append("")
+            out.append("By condition:")
+            out.extend(self._group_lines('condition'))
+            out.append("By modality:")
+            out.extend(self._group_lines('modality'))
+        else:
+            out.append("Waiting for trials...")
+        return "\n".join(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Live view of a running long_range.py session.")
+    parser.add_argument("--port", type=int, default=MONITOR_PORT, help=f"UDP port to listen on (default {MONITOR_PORT})")
+    parser.add_argument("--refresh", type=float, default=0.5, help="Screen refresh interval in seconds")
+    args = parser.parse_args()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((MONITOR_HOST, args.port))
+    view = SessionView()
+    print(f"Listening on {MONITOR_HOST}:{args.port}...")
+    dirty = True
+    next_draw = 0
+    try:
+        while True:
+            ready, _, _ = select.select([sock], [], [], args.refresh)
+            while ready:
+                data, _addr = sock.recvfrom(65536)
+                try:
+                    view.add(json.loads(data.decode('utf-8')))
+                    dirty = True
+                except ValueError:
+                    pass # Ignore malformed datagrams
+                ready, _, _ = select.select([sock], [], [], 0)
+            if dirty and time.time() >= next_draw:
+                sys.stdout.write("\033[2J\033[H" + view.render() + "\n")
+                sys.stdout.flush()
+                dirty = False
+                next_draw = time.time() + args.refresh
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -11,11 +11,22 @@
 
 import sys
 import re
+import shutil
 from pathlib import Path
 import pandas as pd
-from expyriment import design, control, stimuli, misc, io
+from expyriment import design, control, stimuli, misc
 import argparse
 import random # Import random explicitly
+from stimulus_store import StimulusStore
+from trial_runtime import TrialRuntime, TrialLog
+from event_log import BufferedEventLog, parse_levels, PHASES
+from audio_output import AudioOutput, set_buffer_size
+from stimulus_pack import open_pack
+from present_timing import calibrate, PresentScheduler
+from live_monitor import MonitorPublisher, NullPublisher, MONITOR_PORT
+from schedule import (INITIAL_WAIT, FINAL_WAIT, STIMULUS_ONTIME, STIMULUS_ITI, SOA_PROBE, CUE_DURATION,
+                      PROBE_DURATION, RESPONSE_DURATION, AUDIO_DURATION, split_words, compile_schedule,
+                      expected_total_duration as compute_expected_total_duration)
 
 script_dir = Path(__file__).parent.resolve()
 
@@ -35,7 +46,41 @@ parser.add_argument(
     action="store_true",
     help="Use inverted hands instruction image."
 )
+parser.add_argument(
+    "--monitor",
+    action="store_true",
+    help="Publish per-trial records to a live monitor (python Code/live_monitor.py) instead of printing them."
+)
+parser.add_argument(
+    "--memory_budget_mb",
+    type=float,
+    default=None,
+    help="Estimated preload memory budget in MB. When preloading every trial would exceed it,\nonly the trials that fit are preloaded and the rest are loaded during the ITIs."
+)
+parser.add_argument(
+    "--event_log_levels",
+    type=str,
+    default="",
+    help=f"Event file detail per trial phase ({', '.join(PHASES)}), 0 = off, 1 = default, 2 = extensive,\ne.g. 'sentence=0,response=2'. Events are buffered and written during the ITIs."
+)
+parser.add_argument(
+    "--audio_buffer",
+    type=int,
+    default=None,
+    help="Mixer buffer size in samples (power of two; Expyriment's default is 512). Smaller lowers the\naudio output latency; too small crackles on slow sound cards."
+)
+parser.add_argument(
+    "--monitor_port",
+    type=int,
+    default=MONITOR_PORT,
+    help=f"UDP port of the live monitor (default {MONITOR_PORT})."
+)
 args = parser.parse_args() # Parse arguments at the beginning
+try:
+    event_log_levels = parse_levels(args.event_log_levels)
+except ValueError as e:
+    print(f"Error: Invalid --event_log_levels: {e}")
+    sys.exit(1)
 
 # --- Use parsed arguments ---
 # run_folder_path is now taken from the parsed arguments.
@@ -45,8 +90,6 @@ run_folder_path = Path(args.run_folder_path).resolve()
 
 # Experiment Parameters
 DEBUG = False  # Set to False for fullscreen, True for development mode
-INITIAL_WAIT = 2000  # ms, Wait time after instructions before first trigger/trial
-FINAL_WAIT = 10000   # ms, Wait time at the end of the experiment
 TEXT_SIZE = 50 
 TEXT_FONT =  str(script_dir / 'Inconsolata-Regular.ttf')  # Font for sentence presentation
 PROBE_SIZE = 50
@@ -57,15 +100,7 @@ TRIGGER_KEY = misc.constants.K_t# fMRI trigger key
 NUM_TRIGGERS = 3 # Number of triggers to wait for
 ESCAPE_KEY = misc.constants.K_ESCAPE # Key to exit the experiment
 CONTROLLER_KEY = misc.constants.K_SPACE # Key for experimenter to start after instructions
-
-# Timing Parameters (modify as needed)
-STIMULUS_ONTIME = 200           # ms, Duration each word is shown (visual) (like params.stimulus_ontime)
-STIMULUS_ITI = 200              # ms, Duration of the inter-stimulus interval (like params.stimulus_iti)
-SOA_PROBE = 1000                # ms, Fixation duration AFTER sentence BEFORE probe for both modalities (added to last ITI for integer reasons...)
-CUE_DURATION = 1000             # ms, Duration of the input modality cues (visual/auditory)
-PROBE_DURATION = 1000           # ms, Duration of the probe (based on 'Neural Populations' paper)
-RESPONSE_DURATION = 2000        # ms, Within rest period, how long to wait for a response AFTER probe
-AUDIO_DURATION = 4000           # ms, Duration of the audio stimulus (like params.audio_duration)
+# Timing Parameters live in schedule.py (shared with the batch schedule compiler)
 # ----------------------------------------
 
 # Determine modality and base paths
@@ -135,6 +170,12 @@ print(f"Stimulus File: {stim_file_path}")
 print(f"Stimuli Base Directory: {stimuli_base_dir}")
 print(f"Log Directory: {log_dir}")
 
+# --- Stimulus Pack ---
+# If the run (or subject) folder has a wavs.pack, its WAVs are decoded in background threads from here on,
+# while Expyriment initialises; the preload below then takes them from memory instead of wavs/.
+# With --memory_budget_mb they are decoded only as trials enter the load window, so the budget holds.
+stimulus_pack = open_pack(run_folder_path, eager=not args.memory_budget_mb)
+
 # --- Load Stimuli ---
 try:
     # stim_df = pd.read_csv(stim_file_path) # Already loaded above to get modality
@@ -155,10 +196,17 @@ num_trials = len(stim_df)
 
 # --- Expyriment Setup ---
 exp = design.Experiment(name=f"Long-Range Agreement - Sub {subject_id} Run {run_number})", text_size=TEXT_SIZE)
+# Record the run folder and hand mapping in the data file header (needed to score the responses offline)
+exp.add_experiment_info([f"run_folder: {run_folder_path}", f"invert_hands: {args.invert_hands}"])
 control.defaults.initialize_delay = 0 # Avoids initial pause screen
 if DEBUG:
     control.set_develop_mode(on=True, window_size=(800, 600))
+set_buffer_size(args.audio_buffer)
 control.initialize(exp)
+# Events are kept in memory (paths as compact IDs) and written to the .xpe file during the ITIs
+event_log = BufferedEventLog(exp, event_log_levels).install()
+# Sentences and probes play on their own reserved, already running mixer channels
+audio_output = AudioOutput(exp)
 
 # --- Prepare Stimuli Objects ---
 fixation_cross = stimuli.FixCross(size=(50, 50), line_width=4)
@@ -167,8 +215,12 @@ ready_text = "Waiting for scanner sync (or press \'t\')"
 end_text = f"Fin de cette partie. Merci!"
 
 # --- Preload Static Stimuli ---
+# The stimulus store also keeps the memory footprint of everything preloaded (see footprint_table())
+stimulus_store = StimulusStore()
 fixation_cross.preload()
 blank_screen.preload()
+stimulus_store.account(fixation_cross, 'fixation')
+stimulus_store.account(blank_screen, 'blank')
 
 # Preload instruction/feedback text screens
 # Instructions
@@ -177,6 +229,7 @@ instruction_image_path = Path(image_dir) / ("instructions_invert-hands.png" if a
 instructions = stimuli.Picture(str(instruction_image_path))
 instructions.scale_to_fullscreen()
 instructions.preload()
+stimulus_store.account(instructions, 'picture')
 
 # Preload modality cues
 visual_cue_path = Path(image_dir) / "visual_cue.png"
@@ -185,6 +238,8 @@ visual_cue = stimuli.Picture(str(visual_cue_path))
 auditory_cue = stimuli.Picture(str(auditory_cue_path))
 visual_cue.preload()
 auditory_cue.preload()
+stimulus_store.account(visual_cue, 'picture')
+stimulus_store.account(auditory_cue, 'picture')
 modality_cues = {'visual': visual_cue, 'auditory': auditory_cue} # Store cues in a dict
 
 # Preload ready and end text screens
@@ -192,11 +247,32 @@ stimuli.TextLine(ready_text).preload()
 stimuli.TextScreen("Fin", end_text).preload()
 
 # --- Preload Trial Stimuli ---
+# Identical stimuli (same WAV bytes, same word/font/size) are loaded once and shared across trials
 preloaded_stimuli = {} # Dictionary to hold preloaded stimuli for each trial
+preloaded_probes = {} # Dictionary to hold preloaded visual probe words for each trial
 preloaded_word_counts = {} # Dictionary to hold word counts for visual trials
-preloaded_rest_durations = {} # Dictionary to hold trial durations
 
-for index, trial_data in stim_df.iterrows():
+def acquire_audio(path):
+    # From the stimulus pack when it has this WAV (unchanged since the pack was built), else from the file
+    if stimulus_pack.has(path):
+        return stimulus_store.acquire_audio_data(stimulus_pack.key(path), lambda: stimulus_pack.get(path), path.name)
+    return stimulus_store.acquire_audio(path)
+
+def release_trial(trial_id):
+    # Drop a trial's references (also for skipped trials); shared stimuli stay loaded until their last trial
+    stimulus_store.release_all(preloaded_stimuli.get(trial_id) or ()) # Word list (visual) or (sentence, probe) audio tuple
+    stimulus_store.release(preloaded_probes.get(trial_id))
+
+def load_window(index):
+    # Windowed loading, in the ITI of trial `index` (0-based) once its stimuli are released: load the next trial
+    # and as many upcoming ones as fit in the memory budget
+    global next_trial_to_load
+    while windowed_loading and next_trial_to_load < num_trials and (
+            next_trial_to_load <= index + 1 or stimulus_store.resident_bytes < memory_budget):
+        preload_trial(next_trial_to_load, stim_df.iloc[next_trial_to_load])
+        next_trial_to_load += 1
+
+def preload_trial(index, trial_data):
     # Use 1-based index for trial ID and filename, matching row number
     trial_id_one_based = index + 1
     sentence = trial_data['sentence']
@@ -205,15 +281,15 @@ for index, trial_data in stim_df.iterrows():
     # Preload the trial duration (ITI)
     if current_modality == 'visual':
         # ... existing visual preload ...
-        sentence_text = sentence.rstrip('.') # Remove trailing period
-        words = re.findall(r"[\w'-]+|[.,!?;:]", sentence_text) # Split words and punctuation
+        words = split_words(sentence) # Split words and punctuation (trailing period removed)
         preloaded_word_counts[trial_id_one_based] = len(words) # Store word count
         trial_stim_list = []
         for word in words:
-            stim = stimuli.TextLine(word, text_size=TEXT_SIZE, text_font=TEXT_FONT)
-            stim.preload()
+            stim = stimulus_store.acquire_text(word, TEXT_SIZE, TEXT_FONT)
             trial_stim_list.append(stim)
         preloaded_stimuli[trial_id_one_based] = trial_stim_list # Use 1-based index as key
+        # Probe is shown in uppercase to differentiate low-level perceptions
+        preloaded_probes[trial_id_one_based] = stimulus_store.acquire_text(trial_data['probe_word'].upper(), PROBE_SIZE, PROBE_FONT)
 
     elif current_modality == 'auditory':
         # --- Use the 'trial' column value for the filename ---
@@ -221,7 +297,7 @@ for index, trial_data in stim_df.iterrows():
             print(f"Error: 'trial' column missing in input CSV for row index {index}. Cannot determine audio filenames.")
             preloaded_stimuli[trial_id_one_based] = (None, None) # Store tuple indicating failure
             preloaded_word_counts[trial_id_one_based] = 0
-            continue # Skip to next iteration
+            return # Skip to next trial
 
         trial_identifier = trial_data['trial'] # Get value like 'trial_1'
         wav_filename = f"{trial_identifier}.wav" # Construct sentence filename
@@ -235,10 +311,9 @@ for index, trial_data in stim_df.iterrows():
 
         # Preload Sentence Audio
         audio_stim = None
-        if wav_path.is_file():
+        if wav_path.is_file() or stimulus_pack.has(wav_path):
             try:
-                audio_stim = stimuli.Audio(str(wav_path))
-                audio_stim.preload()
+                audio_stim = acquire_audio(wav_path)
             except Exception as e:
                 print(f"Warning: Could not preload sentence audio file {wav_path}: {e}")
                 audio_stim = None # Mark as failed preload
@@ -248,10 +323,9 @@ for index, trial_data in stim_df.iterrows():
 
         # Preload Probe Audio
         probe_audio_stim = None
-        if probe_wav_path.is_file():
+        if probe_wav_path.is_file() or stimulus_pack.has(probe_wav_path):
             try:
-                probe_audio_stim = stimuli.Audio(str(probe_wav_path))
-                probe_audio_stim.preload()
+                probe_audio_stim = acquire_audio(probe_wav_path)
             except Exception as e:
                 print(f"Warning: Could not preload probe audio file {probe_wav_path}: {e}")
                 probe_audio_stim = None # Mark as failed preload
@@ -262,79 +336,92 @@ for index, trial_data in stim_df.iterrows():
         preloaded_stimuli[trial_id_one_based] = (audio_stim, probe_audio_stim) # Store tuple of preloaded objects (or None)
         preloaded_word_counts[trial_id_one_based] = 0 # Store 0 for auditory trials
 
-# --- Calculate Trial Timings and Total Duration ---
-expected_total_duration = INITIAL_WAIT
-target_onset_times = {}
-current_target_onset = INITIAL_WAIT # Target start for the first trial block
-previous_modality_for_timing = None
-
+# Preload trials in order until the memory budget (if any) is reached; the rest are loaded during the ITIs
+memory_budget = args.memory_budget_mb * 1024 * 1024 if args.memory_budget_mb else None
+next_trial_to_load = 0 # 0-based index of the first trial not preloaded yet
 for index, trial_data in stim_df.iterrows():
-    trial_id_one_based = index + 1
-    current_modality = trial_data['modality'].lower()
-
-    # Store the target onset for the START of this trial's block
-    target_onset_times[trial_id_one_based] = current_target_onset
-
-    # Calculate duration of potential cue/fixation for THIS trial
-    cue_fix_duration = 0
-    if index == 0 or current_modality != previous_modality_for_timing:
-        cue_fix_duration = CUE_DURATION
-
-    # Calculate the duration of the stimulus presentation + probe + response window
-    word_count = preloaded_word_counts.get(trial_id_one_based, 0)
-    if current_modality == 'visual':
-        trial_stim_probe_duration = (word_count * STIMULUS_ONTIME) + (word_count * STIMULUS_ITI) + SOA_PROBE + PROBE_DURATION
-    elif current_modality == 'auditory':
-        trial_stim_probe_duration = AUDIO_DURATION + SOA_PROBE + PROBE_DURATION
-    else:
-        trial_stim_probe_duration = 0 # Should not happen
-
-    preloaded_rest_durations[trial_id_one_based] = trial_data['rest_duration'] * 1000 # Get the trial duration from the CSV
-    
-    # Get ITI for this trial (assigned rest duration)
-    current_iti = preloaded_rest_durations[trial_id_one_based]
-
-    # Calculate the start time for the next trial's block
-    # Add this trial's cue/fix duration, stim/probe duration, and ITI
-    current_target_onset += cue_fix_duration + trial_stim_probe_duration + current_iti
+    if memory_budget is not None and index > 0 and stimulus_store.resident_bytes >= memory_budget:
+        break
+    preload_trial(index, trial_data)
+    next_trial_to_load = index + 1
+windowed_loading = next_trial_to_load < num_trials
+if windowed_loading:
+    print(f"Memory budget of {args.memory_budget_mb:.0f} MB reached after {next_trial_to_load} trials: "
+          f"remaining trials are loaded during the ITIs")
+
+print(stimulus_store.summary())
+print(stimulus_pack.summary())
+print(stimulus_store.footprint_table())
 
-    # Update modality for next iteration's cue_fix_duration calculation
-    previous_modality_for_timing = current_modality
+# --- Calculate Trial Timings and Total Duration ---
+# Block onsets (cue/fixation + stimulus + probe + rest) come from the shared timing model in schedule.py
+trial_schedule = compile_schedule(stim_df)
+target_onset_times = dict(zip(trial_schedule['trial_number'], trial_schedule['onset']))
+preloaded_rest_durations = dict(zip(trial_schedule['trial_number'], trial_schedule['rest_ms'])) # Rest duration from the CSV (ms)
 
-# Adjust expected total duration calculation
-# The last 'current_target_onset' is the start time of the hypothetical trial AFTER the last one.
-# So, it represents the end of the last trial's ITI.
-expected_total_duration = current_target_onset + FINAL_WAIT # Add final wait buffer
+# The end of the last trial's rest plus the final wait buffer
+expected_total_duration = compute_expected_total_duration(trial_schedule).iloc[0]
 
 print(f"Subject ID: {subject_id}")
 print(f"Run Number: {run_number}")
 print(f"Total number of trials: {num_trials}")
 print(f"Expected Total duration: {expected_total_duration / 1000.0:.2f} s")
 
+# --- Live Monitor ---
+# Per-trial records go to the monitor process; stdout prints are skipped so no display work happens here
+monitor = MonitorPublisher(args.monitor_port) if args.monitor else NullPublisher()
+VERBOSE = not args.monitor
+monitor.publish('session', subject_id=subject_id, run_number=run_number, num_trials=num_trials,
+                expected_total_duration=expected_total_duration, invert_hands=args.invert_hands)
+TRUE_KEY_LABEL = 'left' if args.invert_hands else 'right' # Right hand is 'true' unless hands are inverted
+
 # --- Experiment Flow ---
 control.start(skip_ready_screen=True)
 
 # Display instructions
 instructions.present()
+
+# Measure present() latency per stimulus type while the instructions are shown (nothing visible changes);
+# deadlines below are met by presenting early by these latencies
+calibration_words = [stim for stims in preloaded_stimuli.values() if isinstance(stims, list) for stim in stims][:5]
+calibration_probes = [probe for probe in preloaded_probes.values() if probe is not None][:3]
+calibration_samples = {'fixation': [fixation_cross], 'blank': [blank_screen], 'cue': list(modality_cues.values())}
+if calibration_words:
+    calibration_samples['word'] = calibration_words
+    calibration_samples['probe'] = calibration_probes
+present_model = calibrate(instructions, calibration_samples)
+exp.data.add_experiment_info(present_model.describe()) # Recorded in the run's data file header
+if VERBOSE:
+    print(present_model.describe())
 exp.keyboard.wait(CONTROLLER_KEY) # Wait for CONTROLLER_KEY to start
 
+# --- Setup Logging ---
+# Use subject ID and run number for log file name
+log_filename = log_dir / f"subject_{subject_id}_LRA_{run_number}.csv"
+# Use 1-based TrialNumber instead of TrialID which might be confusing
+# Rows are buffered and handed to exp.data during the ITI
+trial_log = TrialLog(exp, ["TrialNumber", "TrialOnset_ms", "Sentence", "Structure", "Modality", "StimulusDuration_ms", "KEY", "RT_ms"])
+
+def save_log_on_abort():
+    # Ensure data is saved if the run is aborted: the run's data file, plus a copy in Logs/
+    trial_log.flush()
+    exp.data.save()
+    shutil.copyfile(exp.data.fullpath, log_filename)
+
+# Trigger sync, deadline waits (escape aborts the run) and response capture
+runtime = TrialRuntime(exp, escape_key=ESCAPE_KEY, on_abort=save_log_on_abort)
+presenter = PresentScheduler(runtime, present_model)
+
 # Ready screen and wait for trigger
-stimuli.TextLine(ready_text).present()
 if not DEBUG:
-    for _ in range(NUM_TRIGGERS):  # Wait for trigger key NUM_TRIGGERS times
-        exp.keyboard.wait(TRIGGER_KEY)
+    runtime.wait_for_triggers(NUM_TRIGGERS, TRIGGER_KEY, screen=stimuli.TextLine(ready_text))
 else:
+    stimuli.TextLine(ready_text).present()
     exp.clock.wait(1000)  # Short wait in debug mode
 
-start_time = exp.clock.time
+runtime.start_clock() # Time zero of the run; block onsets are relative to it
 fixation_cross.present()
-exp.clock.wait(INITIAL_WAIT)
-
-# --- Setup Logging ---
-# Use subject ID and run number for log file name
-log_filename = log_dir / f"subject_{subject_id}_LRA_{run_number}.csv"
-# Use 1-based TrialNumber instead of TrialID which might be confusing
-exp.data_variable_names = ["TrialNumber", "TrialOnset_ms", "Sentence", "Structure", "Modality", "StimulusDuration_ms", "KEY", "RT_ms"]
+runtime.wait(INITIAL_WAIT)
 
 # --- Main Trial Loop ---
 print("Starting main trial loop...") # Added for clarity
@@ -348,56 +435,44 @@ for index, trial_data in stim_df.iterrows():
     # Use 1-based index for trial number identification and logging
     trial_id_one_based = index + 1 # This is the CURRENT trial number in the loop
 
+    # Windowed loading (memory budget): upcoming trials are loaded in the previous ITI (below);
+    # this is only a fallback if this trial was not loaded yet
+    while windowed_loading and next_trial_to_load <= index:
+        preload_trial(next_trial_to_load, stim_df.iloc[next_trial_to_load])
+        next_trial_to_load += 1
+
     # --- Wait until the target onset time for THIS ENTIRE BLOCK --- (Moved to top)
     target_onset = target_onset_times.get(trial_id_one_based, -1)
+    cue_shown = index == 0 or current_modality != previous_modality
+    # A block opening with a present() (cue or first word) starts early by its latency, so the flip lands on target
+    first_lead = present_model.lead('cue' if cue_shown else 'word') if cue_shown or current_modality == 'visual' else 0
     if target_onset > 0:
-        while exp.clock.time - start_time < target_onset:
-            # Actively wait (yields processing time)
-            exp.keyboard.check(process_control_events=True) # Check for escape key etc.
-            if exp.keyboard.check(ESCAPE_KEY): # Check again inside loop
-                 control.end(goodbye_text="Experiment aborted.", goodbye_delay=1000)
-                 sys.exit()
-            pass # Keep looping until target time is reached
+        # The rest of the previous ITI: sleeps until just before the deadline, checking for escape
+        runtime.wait_until(target_onset - first_lead)
     # -----------------------------------------------------------
 
-    # --- Timing Verification (Print AFTER initial wait) --- (Moved up)
-    actual_onset = exp.clock.time - start_time # Time block actually starts
+    block_start = exp.clock.time + first_lead # Deadline (exp.clock) of the block's first stimulus; its presents are scheduled from it
+    # Time block actually starts: replaced below by the measured onset of the block's first present (cue, or first word)
+    actual_onset = block_start - runtime.start_time
     stimulus_actual_duration_ms = -1.0 # Initialize stimulus duration for logging
 
-    delta = actual_onset - target_onset
-    warn = " !!!" if delta > 25 else "" # Adjusted warning threshold slightly
-    # Print timing info for the *current* trial block start
-    print(f"Trial {trial_id_one_based} Target: {target_onset:.2f} Actual: {actual_onset:.2f} Delta: {delta:.2f}{warn}")
-    # ----------------------------------------------------
-
     # --- Display Modality Cue and subsequent Fixation if Changed --- (Now after onset wait)
-    if index == 0 or current_modality != previous_modality:
-        print(f"Presenting cue for modality: {current_modality}") # Debug print
+    if cue_shown:
+        if VERBOSE:
+            print(f"Presenting cue for modality: {current_modality}") # Debug print
+        event_log.phase('cue')
         cue_to_present = modality_cues.get(current_modality)
         if cue_to_present:
-            cue_to_present.present()
-            # Wait for CUE_DURATION, checking for escape
-            wait_end_time = exp.clock.time + CUE_DURATION
-            while exp.clock.time < wait_end_time:
-                if exp.keyboard.check(ESCAPE_KEY):
-                    control.end(goodbye_text="Experiment aborted.", goodbye_delay=1000)
-                    sys.exit()
-                exp.clock.wait(1) # Wait 1ms to yield CPU
-
-            # Present fixation cross AFTER cue
-            fixation_cross.present()
-            # Wait for CUE_DURATION, checking for escape
-            wait_end_time = exp.clock.time + CUE_DURATION
-            while exp.clock.time < wait_end_time:
-                if exp.keyboard.check(ESCAPE_KEY):
-                    control.end(goodbye_text="Experiment aborted.", goodbye_delay=1000)
-                    sys.exit()
-                exp.clock.wait(1) # Wait 1ms to yield CPU
+            actual_onset = presenter.present_at(cue_to_present, 'cue', block_start) - runtime.start_time
+
+            # Present fixation cross AFTER cue, CUE_DURATION each (waits check for escape)
+            presenter.present_at(fixation_cross, 'fixation', block_start + CUE_DURATION)
+            runtime.wait_until_clock(block_start + 2 * CUE_DURATION)
         else:
             print(f"Warning: Could not find preloaded cue for modality '{current_modality}'")
             # Optionally, present a default (like fixation) and wait anyway
-            fixation_cross.present()
-            exp.clock.wait(CUE_DURATION) # Wait the full combined duration
+            actual_onset = presenter.present_at(fixation_cross, 'fixation', block_start) - runtime.start_time
+            runtime.wait_until_clock(block_start + CUE_DURATION) # Wait the full combined duration
     # -------------------------------------------------------------
 
     # Retrieve preloaded stimulus using the 1-based index
@@ -406,39 +481,33 @@ for index, trial_data in stim_df.iterrows():
     # Skip trial if stimulus failed to load/preload
     if current_stim_data is None:
          print(f"Skipping trial {trial_id_one_based} due to missing/failed stimulus data.")
-         exp.data.add([trial_id_one_based, actual_onset, sentence, structure, current_modality, stimulus_actual_duration_ms, "NO_STIM_DATA", -3]) # MODIFIED
+         trial_log.add([trial_id_one_based, actual_onset, sentence, structure, current_modality, stimulus_actual_duration_ms, "NO_STIM_DATA", -3]) # MODIFIED
          previous_modality = current_modality # Update modality even if skipped
          # Need to wait for the ITI duration even if skipped
          fixation_cross.present()
-         current_rest = preloaded_rest_durations[index]
-         exp.clock.wait(current_rest)
+         release_trial(trial_id_one_based)
+         load_window(index)
+         current_rest = preloaded_rest_durations[trial_id_one_based]
+         runtime.wait(current_rest)
          continue
 
     # 1. Stimulus Presentation (Starts immediately after cue/fixation or onset wait)
+    event_log.phase('sentence')
     stimulus_start_time = exp.clock.time # Log actual stimulus start time
     stimulus_end_time = 0
     if current_modality == 'visual':
         visual_stim_list = current_stim_data
+        # Word onsets are deadlines from the first word, so present() latency cannot accumulate over the sentence
+        word_deadline = max(stimulus_start_time, block_start + (2 * CUE_DURATION if cue_shown else 0))
         for i, stim in enumerate(visual_stim_list):
-            stim.present()
-            word_onset_time = exp.clock.time # Time the word appeared
-            # Wait for STIMULUS_ONTIME duration, checking for escape
-            wait_end_time = exp.clock.time + STIMULUS_ONTIME
-            while exp.clock.time < wait_end_time:
-                if exp.keyboard.check(ESCAPE_KEY):
-                    control.end(goodbye_text="Experiment aborted.", goodbye_delay=1000)
-                    sys.exit()
-                exp.clock.wait(1) # Wait 1ms to yield CPU
+            word_onset_time = presenter.present_at(stim, 'word', word_deadline) # Time the word appeared
+            if i == 0 and not cue_shown:
+                actual_onset = word_onset_time - runtime.start_time # The first word opens the block
 
             # Present blank screen for IWI_DURATION after each word (including last)
-            blank_screen.present()
-            # Wait for STIMULUS_ITI duration, checking for escape
-            wait_end_time = exp.clock.time + STIMULUS_ITI
-            while exp.clock.time < wait_end_time:
-                if exp.keyboard.check(ESCAPE_KEY):
-                    control.end(goodbye_text="Experiment aborted.", goodbye_delay=1000)
-                    sys.exit()
-                exp.clock.wait(1) # Wait 1ms to yield CPU
+            presenter.present_at(blank_screen, 'blank', word_deadline + STIMULUS_ONTIME)
+            word_deadline += STIMULUS_ONTIME + STIMULUS_ITI
+        runtime.wait_until_clock(word_deadline) # End of the last word's STIMULUS_ITI, checking for escape
 
         stimulus_end_time = exp.clock.time # End time is after last word's IWI wait
         if stimulus_start_time > 0 and stimulus_end_time > stimulus_start_time:
@@ -450,11 +519,13 @@ for index, trial_data in stim_df.iterrows():
         # Check if sentence audio is valid before proceeding
         if sentence_audio is None:
             print(f"Skipping trial {trial_id_one_based} due to missing sentence audio.")
-            exp.data.add([trial_id_one_based, actual_onset, sentence, structure, current_modality, stimulus_actual_duration_ms, "NO_SENT_AUDIO", -2]) # MODIFIED
+            trial_log.add([trial_id_one_based, actual_onset, sentence, structure, current_modality, stimulus_actual_duration_ms, "NO_SENT_AUDIO", -2]) # MODIFIED
             # Go directly to Rest duration for this trial
             blank_screen.present()
-            current_rest = preloaded_rest_durations[index] # Rest still uses 0-based index
-            exp.clock.wait(current_rest)
+            release_trial(trial_id_one_based)
+            load_window(index)
+            current_rest = preloaded_rest_durations[trial_id_one_based] # Rest durations are keyed by 1-based trial number
+            runtime.wait(current_rest)
             continue # Skip rest of trial logic
 
         # Present Sentence Audio
@@ -462,23 +533,10 @@ for index, trial_data in stim_df.iterrows():
             fixation_cross.present() # Keep fixation during audio
             audio_filename_to_play = getattr(sentence_audio, 'filename', 'N/A')
             audio_play_start_time = exp.clock.time
-            sentence_audio.play() # Start playing audio (non-blocking)
+            audio_output.play(sentence_audio, "sentence") # Start playing audio (non-blocking)
 
             # Wait for AUDIO_DURATION, checking for escape periodically
-            wait_end_time = exp.clock.time + AUDIO_DURATION
-            while exp.clock.time < wait_end_time:
-                if exp.keyboard.check(ESCAPE_KEY):
-                    sentence_audio.stop()
-                    if probe_audio: probe_audio.stop() # Stop probe too if loaded
-                    control.end(goodbye_text="Experiment aborted.", goodbye_delay=1000)
-                    sys.exit()
-                # Wait for a short interval before checking again
-                exp.clock.wait(10) # Check every 10ms
-
-            # Ensure the loop finishes close to the target time, handle potential overshoot
-            remaining_wait = wait_end_time - exp.clock.time
-            if remaining_wait > 0:
-                exp.clock.wait(remaining_wait)
+            runtime.wait(AUDIO_DURATION)
 
             sentence_audio.stop() # Stop playback immediately after AUDIO_DURATION
             stimulus_end_time = exp.clock.time # End time is right after audio stops
@@ -486,18 +544,23 @@ for index, trial_data in stim_df.iterrows():
                 stimulus_actual_duration_ms = stimulus_end_time - stimulus_start_time
         except Exception as e:
             print(f"Error presenting preloaded sentence audio for trial {trial_id_one_based}: {e}")
-            exp.data.add([trial_id_one_based, actual_onset, sentence, structure, current_modality, stimulus_actual_duration_ms, "SENT_AUDIO_ERR", -2]) # MODIFIED
+            trial_log.add([trial_id_one_based, actual_onset, sentence, structure, current_modality, stimulus_actual_duration_ms, "SENT_AUDIO_ERR", -2]) # MODIFIED
             # Go directly to Rest duration for this trial
             blank_screen.present()
-            current_rest = preloaded_rest_durations[index] # Rest still uses 0-based index
-            exp.clock.wait(current_rest)
+            release_trial(trial_id_one_based)
+            load_window(index)
+            current_rest = preloaded_rest_durations[trial_id_one_based] # Rest durations are keyed by 1-based trial number
+            runtime.wait(current_rest)
             continue # Skip rest of trial logic
 
     # 2. Post-Stimulus Fixation (SOA_PROBE)
-    exp.clock.wait(SOA_PROBE)
+    probe_deadline = exp.clock.time + SOA_PROBE
+    if current_modality != 'visual':
+        runtime.wait(SOA_PROBE) # The visual probe is presented early by its latency below
     post_stim_fixation_end_time = exp.clock.time
 
     # 3. Probe Presentation & Response Window
+    event_log.phase('probe')
     keys = None
     rt = None
     logged_key = "ERROR" # Default to error, overwrite on success
@@ -506,32 +569,22 @@ for index, trial_data in stim_df.iterrows():
 
     if current_modality == 'visual':
         # --- Visual Probe ---
-        current_probe = stimuli.TextLine(probe_word, text_size=PROBE_SIZE, text_font=PROBE_FONT)
-        current_probe.present()
-        probe_presentation_start_time = exp.clock.time
-
-        # Wait for PROBE_DURATION (presentation only), checking for ESCAPE
-        wait_end_probe_presentation = probe_presentation_start_time + PROBE_DURATION
-        escaped_during_probe = False
-        while exp.clock.time < wait_end_probe_presentation:
-            if exp.keyboard.check(ESCAPE_KEY):
-                escaped_during_probe = True
-                break
-            exp.clock.wait(1) # yield to other processes, check often
-
-        if escaped_during_probe:
-            control.end(goodbye_text="Experiment aborted during visual probe.", goodbye_delay=1000)
-            sys.exit()
-        
-        probe_presentation_end_time = exp.clock.time # Mark end of visual probe presentation
+        current_probe = preloaded_probes.get(trial_id_one_based)
+        if current_probe is None:
+            current_probe = stimuli.TextLine(probe_word, text_size=PROBE_SIZE, text_font=PROBE_FONT)
+        probe_presentation_start_time = presenter.present_at(current_probe, 'probe', probe_deadline)
+
+        # Probe shown for PROBE_DURATION (presentation only), then the fixation cross
+        # for the response window (the wait checks for ESCAPE)
+        presenter.present_at(fixation_cross, 'fixation', probe_deadline + PROBE_DURATION)
 
         # Probe presentation finished. RT starts from now.
-        # Present fixation cross during the response window.
-        fixation_cross.present()
+        probe_presentation_end_time = exp.clock.time # Mark end of visual probe presentation
         
         # Collect response during RESPONSE_DURATION
         # rt will be relative to the start of this call (i.e., from probe_presentation_end_time).
-        keys, rt = exp.keyboard.wait(keys=[LEFT_HAND_KEY, RIGHT_HAND_KEY, ESCAPE_KEY], duration=RESPONSE_DURATION)
+        event_log.phase('response')
+        keys, rt = runtime.capture_response([LEFT_HAND_KEY, RIGHT_HAND_KEY], RESPONSE_DURATION)
         
         # keys could be a key constant or None if timeout. rt is ms or None.
 
@@ -541,76 +594,50 @@ for index, trial_data in stim_df.iterrows():
 
         if probe_audio is not None:
             try:
-                probe_audio.play()
+                audio_output.play(probe_audio, "probe")
                 probe_presentation_start_time = exp.clock.time
 
-                # Wait for PROBE_DURATION (presentation only), checking for ESCAPE
-                wait_end_probe_presentation = probe_presentation_start_time + PROBE_DURATION
-                escaped_during_probe = False
-                while exp.clock.time < wait_end_probe_presentation:
-                    # Check if audio finished playing; if so, just continue waiting out PROBE_DURATION
-                    if not probe_audio.is_playing and exp.clock.time < wait_end_probe_presentation:
-                        # Audio finished early, but we wait for full PROBE_DURATION
-                        pass
-                    if exp.keyboard.check(ESCAPE_KEY):
-                        escaped_during_probe = True
-                        break
-                    exp.clock.wait(1) # yield
+                # Wait for the full PROBE_DURATION (presentation only), checking for ESCAPE
+                runtime.wait_until_clock(probe_presentation_start_time + PROBE_DURATION)
 
                 probe_audio.stop() # Ensure audio stops if it was still playing
 
-                if escaped_during_probe:
-                    control.end(goodbye_text="Experiment aborted during auditory probe.", goodbye_delay=1000)
-                    sys.exit()
-                
                 probe_presentation_end_time = exp.clock.time # Mark end of auditory probe presentation
                 
                 # Probe presentation finished. RT starts from now.
                 # Fixation cross should still be visible.
                 # Collect response during RESPONSE_DURATION
-                keys, rt = exp.keyboard.wait(keys=[LEFT_HAND_KEY, RIGHT_HAND_KEY, ESCAPE_KEY], duration=RESPONSE_DURATION)
+                event_log.phase('response')
+                keys, rt = runtime.capture_response([LEFT_HAND_KEY, RIGHT_HAND_KEY], RESPONSE_DURATION)
 
             except Exception as e:
                 print(f"Error playing probe audio for trial {trial_id_one_based}: {e}")
                 # Attempt to maintain timing integrity even if audio fails
                 # Simulate probe presentation duration
-                current_time = exp.clock.time
-                simulated_probe_end = current_time + PROBE_DURATION
-                while exp.clock.time < simulated_probe_end:
-                    if exp.keyboard.check(ESCAPE_KEY): # Still allow escape
-                        control.end(goodbye_text="Experiment aborted during audio error handling.", goodbye_delay=1000)
-                        sys.exit()
-                    exp.clock.wait(1)
+                runtime.wait(PROBE_DURATION) # Still allows escape
                 probe_presentation_end_time = exp.clock.time
                 
                 # Simulate response duration (and collect keys if any)
-                keys, rt = exp.keyboard.wait(keys=[LEFT_HAND_KEY, RIGHT_HAND_KEY, ESCAPE_KEY], duration=RESPONSE_DURATION)
+                event_log.phase('response')
+                keys, rt = runtime.capture_response([LEFT_HAND_KEY, RIGHT_HAND_KEY], RESPONSE_DURATION)
                 logged_key = "PROBE_AUDIO_ERR"
                 logged_rt = -4 # Indicate probe audio error
 
         else: # Probe audio was missing or failed to preload
             print(f"Probe audio missing for trial {trial_id_one_based}. Presenting fixation for probe duration.")
             fixation_cross.present()
-            # Wait for PROBE_DURATION (silent presentation)
-            current_time = exp.clock.time
-            simulated_probe_end = current_time + PROBE_DURATION
-            while exp.clock.time < simulated_probe_end:
-                if exp.keyboard.check(ESCAPE_KEY): # Still allow escape
-                    control.end(goodbye_text="Experiment aborted during missing audio handling.", goodbye_delay=1000)
-                    sys.exit()
-                exp.clock.wait(1)
+            # Wait for PROBE_DURATION (silent presentation), still allowing escape
+            runtime.wait(PROBE_DURATION)
             probe_presentation_end_time = exp.clock.time
 
             # Collect response during RESPONSE_DURATION
-            keys, rt = exp.keyboard.wait(keys=[LEFT_HAND_KEY, RIGHT_HAND_KEY, ESCAPE_KEY], duration=RESPONSE_DURATION)
+            event_log.phase('response')
+            keys, rt = runtime.capture_response([LEFT_HAND_KEY, RIGHT_HAND_KEY], RESPONSE_DURATION)
             logged_key = "NO_PROBE_AUDIO"
             logged_rt = -5 # Indicate missing probe audio file
 
     # --- Process Response ---
-    if keys == ESCAPE_KEY: # Check if escape was pressed during RESPONSE_DURATION
-        control.end(goodbye_text="Experiment aborted by user during response window.", goodbye_delay=1000)
-        sys.exit()
-
+    # (Escape during RESPONSE_DURATION already ended the run in runtime.capture_response)
     # RT is relative to the start of the RESPONSE_DURATION window.
     # Only update logged_key/rt if they weren't set by specific error conditions above (PROBE_AUDIO_ERR, NO_PROBE_AUDIO)
     if logged_key == "ERROR": # Default value, means no specific error was logged for key/rt yet
@@ -632,7 +659,7 @@ for index, trial_data in stim_df.iterrows():
     # Log the string representation of the key and the RT.
     # actual_onset was captured at the beginning of the trial block.
     # stimulus_actual_duration_ms was calculated after stimulus presentation or remains -1.0
-    exp.data.add([trial_id_one_based, actual_onset, sentence, structure, current_modality, stimulus_actual_duration_ms, logged_key, logged_rt])
+    trial_log.add([trial_id_one_based, actual_onset, sentence, structure, current_modality, stimulus_actual_duration_ms, logged_key, logged_rt])
 
     # Update previous modality for the next iteration AFTER processing the current trial
     previous_modality = current_modality
@@ -642,47 +669,46 @@ for index, trial_data in stim_df.iterrows():
     # the RestDurationFromCSV after RESPONSE_DURATION has occurred.
     # The target_onset_times logic correctly calculates the required wait time
     # from the end of the response window to the start of the next trial.
+    event_log.phase('iti')
     fixation_cross.present() 
 
+    # --- Timing Verification (measured onset of the block's first stimulus; printed in the ITI, off the timed path) ---
+    delta = actual_onset - target_onset
+    warn = " !!!" if delta > 25 else "" # Adjusted warning threshold slightly
+    if VERBOSE:
+        print(f"Trial {trial_id_one_based} Target: {target_onset:.2f} Actual: {actual_onset:.2f} Delta: {delta:.2f}{warn}")
+
+    release_trial(trial_id_one_based)
+    trial_log.flush()
+    event_log.flush() # Buffered .xpe events of this trial
+    load_window(index) # Before the wait for the next block's onset
+
+    # Publish the trial record to the live monitor (ITI, off the timed path)
+    if args.monitor:
+        correct = None
+        if logged_key in ('left', 'right') and 'probe' in trial_data:
+            correct = (logged_key == TRUE_KEY_LABEL) == bool(trial_data['probe'])
+        next_onset = target_onset_times.get(trial_id_one_based + 1)
+        overrun = next_onset is not None and runtime.now() > next_onset
+        monitor.publish('trial', trial=trial_id_one_based, target=target_onset, actual=actual_onset, delta=delta,
+                        modality=current_modality, condition=str(trial_data.get('condition', '')), structure=structure,
+                        key=logged_key, rt=logged_rt, correct=correct, overrun=overrun)
+
     if trial_id_one_based < num_trials: # Corrected: Use trial_id_one_based instead of next_trial_index
         # --- ITI for non-last trials ---
+        # The fixation stays up until the next block: the wait for its onset is at the top of the loop,
+        # early by the present() latency of its first stimulus (data is saved if aborted during the wait)
         target_onset_next_trial = target_onset_times.get(trial_id_one_based + 1, -1)
         if target_onset_next_trial > 0:
-            current_time_after_response_window = exp.clock.time - start_time
-            required_fixation_wait = target_onset_next_trial - current_time_after_response_window
-
-            if required_fixation_wait < 0:
+            if runtime.now() > target_onset_next_trial:
                 print(f"Warning: Trial {trial_id_one_based} block overran expected end time. Setting ITI fixation wait to 0.")
-                required_fixation_wait = 0
-            
-            wait_end_time = exp.clock.time + required_fixation_wait
-            while exp.clock.time < wait_end_time:
-                if exp.keyboard.check(ESCAPE_KEY):
-                    # Ensure data is saved if aborted during ITI
-                    # Corrected data saving on abort during ITI
-                    data_file = io.DataFile(filename=log_filename)
-                    data_file.add(exp.data)
-                    data_file.save()
-                    control.end(goodbye_text="Experiment aborted by user.", goodbye_delay=1000)
-                    sys.exit()
-                exp.clock.wait(1) # Wait 1ms to yield CPU
         else:
              print(f"Warning: Could not get target onset for next trial {trial_id_one_based + 1}. Using default ITI.")
-             default_iti = preloaded_rest_durations[index] # Use assigned rest as fallback
-             wait_end_time = exp.clock.time + default_iti
-             while exp.clock.time < wait_end_time:
-                 if exp.keyboard.check(ESCAPE_KEY):
-                     # Ensure data is saved if aborted during ITI
-                     # Corrected data saving on abort during ITI
-                     data_file = io.DataFile(filename=log_filename)
-                     data_file.add(exp.data)
-                     data_file.save()
-                     control.end(goodbye_text="Experiment aborted by user.", goodbye_delay=1000)
-                     sys.exit()
-                 exp.clock.wait(1)
+             default_iti = preloaded_rest_durations[trial_id_one_based] # Use assigned rest as fallback
+             runtime.wait(default_iti)
     else:
         # --- ITI for the LAST trial ---
-        rest_duration_from_csv = preloaded_rest_durations[index] # index is num_trials - 1 here
+        rest_duration_from_csv = preloaded_rest_durations[trial_id_one_based] # trial_id_one_based is num_trials here
         
         # ITI_proper for the last trial:
         actual_fixation_for_last_trial = rest_duration_from_csv - RESPONSE_DURATION
@@ -690,16 +716,7 @@ for index, trial_data in stim_df.iterrows():
             print(f"Warning: Last trial's configured rest duration ({rest_duration_from_csv}ms) is less than RESPONSE_DURATION ({RESPONSE_DURATION}ms). Final fixation will be 0ms.")
             actual_fixation_for_last_trial = 0
             
-        wait_end_time = exp.clock.time + actual_fixation_for_last_trial
-        while exp.clock.time < wait_end_time:
-            if exp.keyboard.check(ESCAPE_KEY):
-                # Ensure data is saved if aborted during final ITI
-                data_file = io.DataFile(filename=log_filename)
-                data_file.add(exp.data)
-                data_file.save()
-                control.end(goodbye_text="Experiment aborted by user.", goodbye_delay=1000)
-                sys.exit()
-            exp.clock.wait(1) # Wait 1ms to yield CPU
+        runtime.wait(actual_fixation_for_last_trial) # Data is saved if aborted during final ITI
         # The loop finishes, and the code proceeds to the end-of-experiment section
 
 # --- End of Main Trial Loop ---
@@ -710,7 +727,7 @@ if last_trial_target_onset > 0:
     last_trial_data = stim_df.iloc[-1]
     last_modality = last_trial_data['modality'].lower()
     last_word_count = preloaded_word_counts.get(num_trials, 0)
-    last_trial_rest_duration = preloaded_rest_durations[num_trials - 1] # Get the rest duration assigned to the last trial
+    last_trial_rest_duration = preloaded_rest_durations[num_trials] # Get the rest duration assigned to the last trial
 
     if last_modality == 'visual':
         last_trial_stim_probe_duration = (last_word_count * STIMULUS_ONTIME) + (last_word_count * STIMULUS_ITI) + SOA_PROBE + PROBE_DURATION
@@ -726,10 +743,10 @@ if last_trial_target_onset > 0:
 else:
     # Fallback if last target onset wasn't found
     print("Warning: Could not determine last trial onset time for precise final wait calculation.")
-    expected_end_of_last_trial_plus_rest = exp.clock.time - start_time # Use current time as best guess for end of activity+rest
+    expected_end_of_last_trial_plus_rest = runtime.now() # Use current time as best guess for end of activity+rest
 
 # Calculate how much of the FINAL_WAIT is actually needed *after* the last trial's rest period
-current_time_after_last_trial = exp.clock.time - start_time
+current_time_after_last_trial = runtime.now()
 # The target end time for the whole experiment is the end of the last trial's rest + the final wait buffer
 target_experiment_end_time = expected_end_of_last_trial_plus_rest + FINAL_WAIT
 required_final_wait = target_experiment_end_time - current_time_after_last_trial
@@ -738,18 +755,17 @@ if required_final_wait < 0:
     print(f"Warning: Experiment overran total expected time. Setting final wait to 0.")
     required_final_wait = 0
 
-# Wait for the calculated final duration, checking for escape
-wait_end_time = exp.clock.time + required_final_wait
-while exp.clock.time < wait_end_time:
-    if exp.keyboard.check(ESCAPE_KEY):
-        # Ensure data is saved even if aborted during final wait
-        # Corrected path concatenation for saving data on abort
-        data_file = io.DataFile(filename=log_filename)
-        data_file.add(exp.data)
-        data_file.save() # Explicitly save
-        control.end(goodbye_text="Experiment aborted by user.", goodbye_delay=1000)
-        sys.exit()
-    exp.clock.wait(1) # Wait 1ms to yield CPU
+# Wait for the calculated final duration, checking for escape (data is saved if aborted)
+runtime.wait(required_final_wait)
 
 # End Experiment
+trial_log.flush()
+if VERBOSE or windowed_loading:
+    print(stimulus_store.footprint_table())
+if VERBOSE:
+    print(audio_output.summary())
+    print(presenter.summary())
+audio_output.close()
+monitor.publish('end')
+monitor.close()
 control.end(goodbye_text="", goodbye_delay=0)
@@ -0,0 +1,222 @@
+# '''
+# Post-session processing pipeline.
+#
+# Runs the after-scan tools as one dependency graph:
+#
+#     lists      stimulus_list_generator.py verify   (duplicates, block balance, missing WAVs)
+#     schedule   schedule.py                          (run budgets, per-trial onsets)
+#     acoustics  speech_onsets.py                     (speech onsets, critical-verb onsets)
+#     durations  speech durations per stimulus folder (table, plus a plot if matplotlib is installed)
+#     store      results_store.py ingest
+#     analysis   analysis.py                          (accuracy, d', RT summary)
+#     events     export_bids_events.py                (after acoustics)
+#     design     design_matrix.py
+#
+# Each stage is a separate process; stages whose dependencies are done run in
+# parallel (--jobs at a time). A stage is skipped when the content hashes of
+# its inputs (data files, stimulus CSVs/WAVs, upstream outputs, and the tool's
+# own code with every Code/ module it imports) match its last successful run and its outputs exist. The tools
+# are themselves incremental, so a re-run after one new session only reads
+# that session. Stage output goes to postsession/logs/<stage>.log.
+#
+# Usage: python Code/postsession.py [--jobs 4] [--only events design] [--force]
+#
+# Project: Long-Range Agreement Pilot
+# '''
+
+import sys
+import ast
+import time
+import hashlib
+import argparse
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import pandas as pd
+
+from results_io import PROJECT_ROOT
+from deploy import build_manifest, load_manifest, save_manifest
+
+CODE = "Code"
+OUT_DIR = "postsession"
+STATE_PATH = PROJECT_ROOT / ".cache" / "postsession.json"
+HASH_CACHE = PROJECT_ROOT / ".cache" / "postsession_files.json"
+
+RESULTS = ["data/*.xpd", "Logs/*.csv", "events/*.xpe"]
+RUN_CSVS = ["Stimuli/**/sub_*_run_*.csv"]
+WAVS = ["Stimuli/**/wavs/*.wav", "localizer/*/sound_files/*.wav"]
+
+# name: (command (argv after the Python interpreter), dependencies, input globs, outputs), all relative to the project root.
+# The tool script and the Code/ modules it imports are added to the inputs by code_inputs().
+STAGES = {
+    'lists': ([f"{CODE}/stimulus_list_generator.py", "verify"], [], RUN_CSVS, []),
+    'schedule': ([f"{CODE}/schedule.py", "--trials_out", f"{OUT_DIR}/schedule_trials.csv"], [],
+                 RUN_CSVS, [f"{OUT_DIR}/schedule_trials.csv"]),
+    'acoustics': ([f"{CODE}/speech_onsets.py"], [],
+                  RUN_CSVS + WAVS, ["acoustics/speech_index.csv", "acoustics/trial_acoustics.csv"]),
+    'durations': ([f"{CODE}/postsession.py", "durations"], ['acoustics'],
+                  ["acoustics/speech_index.csv"], [f"{OUT_DIR}/speech_durations.csv"]),
+    'store': ([f"{CODE}/results_store.py", "ingest"], [], RESULTS + RUN_CSVS, ["results.sqlite"]),
+    'analysis': ([f"{CODE}/analysis.py", "--out", f"{OUT_DIR}/behaviour_summary.csv"], [],
+                 RESULTS + RUN_CSVS, [f"{OUT_DIR}/behaviour_summary.csv"]),
+    'events': ([f"{CODE}/export_bids_events.py"], ['acoustics'],
+               RESULTS + RUN_CSVS + ["localizer/audio/data/*.xpd", "acoustics/trial_acoustics.csv"], ["bids"]),
+    'design': ([f"{CODE}/design_matrix.py"], [], RESULTS + RUN_CSVS, ["design"]),
+}
+
+
+def code_inputs(root, script):
+    """`script` plus every Code/ module it imports, directly or through other Code/ modules."""
+    code_dir = Path(root) / CODE
+    todo, found = [Path(script).stem], set()
+    while todo:
+        module = todo.pop()
+        path = code_dir / f"{module}.py"
+        if module in found or not path.is_file():
+            continue
+        found.add(module)
+        for node in ast.walk(ast.parse(path.read_text(), str(path))):
+            if isinstance(node, ast.Import):
+                todo.extend(alias.name.split('.')[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                todo.append(node.module.split('.')[0])
+    return [f"{CODE}/{module}.py" for module in sorted(found)]
+
+
+def stage_inputs(root, patterns):
+    """Relative POSIX paths of the files matching a stage's input globs."""
+    files = set()
+    for pattern in patterns:
+        files.update(p.relative_to(root).as_posix() for p in Path(root).glob(pattern) if p.is_file())
+    return sorted(files)
+
+
+def inputs_hash(root, patterns, file_cache):
+    """Content hash of a stage's inputs (file hashes are reused while size/mtime are unchanged)."""
+    manifest, _n_hashed = build_manifest(root, stage_inputs(root, patterns), file_cache)
+    file_cache.update(manifest)
+    digest = hashlib.sha1()
+    for rel in sorted(manifest):
+        digest.update(f"{rel}\0{manifest[rel][2]}\n".encode())
+    return digest.hexdigest()
+
+
+def run_stage(root, name):
+    """Run one stage's command; returns (returncode, seconds)."""
+    command, _deps, _inputs, _outputs = STAGES[name]
+    log_path = Path(root) / OUT_DIR / "logs" / f"{name}.log"
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    with open(log_path, 'w') as log:
+        result = subprocess.run([sys.executable] + command, cwd=root, stdout=log, stderr=subprocess.STDOUT)
+    return result.returncode, time.perf_counter() - start
+
+
+def closure(names):
+    """`names` plus everything they depend on."""
+    todo, selected = list(names), set()
+    while todo:
+        name = todo.pop()
+        if name not in selected:
+            selected.add(name)
+            todo.extend(STAGES[name][1])
+    return selected
+
+
+def run_pipeline(root, names, jobs, force=False):
+    """Run the selected stages in dependency order; returns {stage: status}."""
+    state = load_manifest(STATE_PATH)
+    file_cache = load_manifest(HASH_CACHE)
+    status, hashes, running = {}, {}, {}
+    pending = [name for name in STAGES if name in names]
+    with ThreadPoolExecutor(max_workers=jobs) as executor: # each stage is its own process
+        while pending or running:
+            for name in list(pending):
+                deps = STAGES[name][1]
+                if any(status.get(d) == 'failed' or status.get(d) == 'blocked' for d in deps):
+                    status[name] = 'blocked'
+                    pending.remove(name)
+                elif all(status.get(d) in ('done', 'cached') for d in deps):
+                    pending.remove(name)
+                    # Hashed once the dependencies are done, so upstream outputs are current
+                    command, _deps, inputs, _outputs = STAGES[name]
+                    hashes[name] = inputs_hash(root, inputs + code_inputs(root, command[0]), file_cache)
+                    outputs_exist = all((Path(root) / out).exists() for out in STAGES[name][3])
+                    if not force and outputs_exist and state.get(name) == hashes[name]:
+                        status[name] = 'cached'
+                        print(f"  {name:<10} up to date")
+                    else:
+                        running[executor.submit(run_stage, root, name)] = name
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                returncode, seconds = future.result()
+                status[name] = 'done' if returncode == 0 else 'failed'
+                if returncode == 0:
+                    state[name] = hashes[name]
+                    save_manifest(state, STATE_PATH)
+                print(f"  {name:<10} {'done' if returncode == 0 else f'FAILED (exit {returncode})'} in {seconds:.1f} s"
+                      + ("" if returncode == 0 else f", see {OUT_DIR}/logs/{name}.log"))
+    save_manifest(file_cache, HASH_CACHE)
+    return status
+
+
+def speech_durations(index_csv, out_csv, out_png=None):
+    """Speech duration (offset - onset) per stimulus folder, from the speech onset index."""
+    index = pd.read_csv(index_csv)
+    index['speech_ms'] = index['speech_offset_ms'] - index['speech_onset_ms']
+    index['folder'] = index['path'].str.rsplit('/', n=1).str[0]
+    table = index.groupby('folder')['speech_ms'].describe(percentiles=[0.5])
+    table.to_csv(out_csv)
+    if out_png:
+        try:
+            import matplotlib
+            matplotlib.use("Agg")
+            import matplotlib.pyplot as plt
+        except ImportError:
+            return table
+        fig, ax = plt.subplots(figsize=(8, 4))
+        ax.hist(index['speech_ms'].dropna() / 1000.0, bins=40)
+        ax.set_xlabel("speech duration (s)")
+        ax.set_ylabel("WAVs")
+        fig.tight_layout()
+        fig.savefig(out_png)
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the post-session processing stages, skipping those whose inputs did not change.")
+    parser.add_argument("command", nargs='?', choices=["run", "durations"], default="run",
+                        help="'durations' runs only the speech-duration stage body (used by the pipeline)")
+    parser.add_argument("--only", nargs='+', choices=list(STAGES), default=None,
+                        help="Run only these stages (and what they depend on)")
+    parser.add_argument("--jobs", type=int, default=4, help="Stages run at the same time (default 4)")
+    parser.add_argument("--force", action="store_true", help="Re-run every selected stage")
+    args = parser.parse_args()
+
+    root = PROJECT_ROOT
+    if args.command == "durations":
+        index_csv = root / "acoustics" / "speech_index.csv"
+        if not index_csv.is_file():
+            print(f"Error: {index_csv} not found (run speech_onsets.py first)")
+            sys.exit(1)
+        (root / OUT_DIR).mkdir(exist_ok=True)
+        table = speech_durations(index_csv, root / OUT_DIR / "speech_durations.csv", root / OUT_DIR / "speech_durations.png")
+        print(table.to_string(float_format=lambda v: f"{v:.0f}"))
+        return
+
+    start = time.perf_counter()
+    names = closure(args.only) if args.only else set(STAGES)
+    print(f"Post-session pipeline: {len(names)} stages")
+    status = run_pipeline(root, names, args.jobs, args.force)
+    failed = sorted(name for name, s in status.items() if s in ('failed', 'blocked'))
+    print(f"Finished in {time.perf_counter() - start:.1f} s"
+          + (f"; failed or blocked: {', '.join(failed)}" if failed else ""))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# '''
+# present() latency model and deadline-based presentation.
+#
+# stimulus.present() clears the back buffer, blits the stimulus and flips the
+# display; the stimulus is on screen when present() returns. Waiting a fixed
+# duration after each present() therefore adds the blit/flip time to every
+# phase, and it accumulates over a sentence's words.
+#
+# calibrate() measures, while the instructions are on screen, the blit time
+# of each stimulus type (present(update=False): drawn to the back buffer
+# only, never shown) and the flip time (re-presenting the instructions, so
+# the screen does not change). Back-to-back presents each wait a whole
+# refresh, so the flip is timed after a random delay of up to one refresh
+# period: like a trial's present, it starts at an arbitrary phase of the
+# refresh. The model's lead for a type is its median blit plus the median
+# flip. present_at() then waits until the deadline minus that lead, so the
+# flip lands on the deadline, and returns the onset (exp.clock ms); the
+# onset errors are kept for summary().
+#
+# Project: Long-Range Agreement Pilot
+# '''
+
+import time
+import random
+
+CALIBRATION_REPEATS = 10 # present() calls measured per stimulus type
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else 0.0
+
+
+def _timed_ms(call):
+    start = time.perf_counter()
+    call()
+    return (time.perf_counter() - start) * 1000
+
+
+class PresentLatencyModel:
+    """Expected present() latency (ms, call to flip) per stimulus type."""
+
+    def __init__(self, flip_ms=0.0, blit_ms=None):
+        self.flip_ms = flip_ms
+        self.blit_ms = dict(blit_ms or {})
+
+    def lead(self, kind):
+        """How long before its deadline a `kind` stimulus must be presented."""
+        return self.blit_ms.get(kind, 0.0) + self.flip_ms
+
+    def describe(self):
+        """One-line description of the model, for the logs."""
+        kinds = ", ".join(f"{kind} {self.lead(kind):.2f}" for kind in sorted(self.blit_ms))
+        return f"present latency model (ms, blit + flip {self.flip_ms:.2f}): {kinds}"
+
+
+def calibrate(screen_stim, samples, repeats=CALIBRATION_REPEATS):
+    """Measure a PresentLatencyModel while `screen_stim` (the instructions) stays on screen.
+
+    `samples` maps a stimulus type to the (preloaded) stimuli to measure; each
+    is drawn to the back buffer only, and `screen_stim` is presented again
+    after every draw. The flip time is taken from presents of `screen_stim`
+    started a random part of a refresh period after the previous flip.
+    """
+    blits, screen_blits, screen_presents = {}, [], []
+    # Back-to-back presents: each takes one refresh period
+    frame_ms = _median([_timed_ms(screen_stim.present) for _ in range(repeats + 1)][1:])
+    for _ in range(repeats):
+        for kind, stims in samples.items():
+            for stim in stims:
+                blits.setdefault(kind, []).append(_timed_ms(lambda: stim.present(update=False)))
+        screen_blits.append(_timed_ms(lambda: screen_stim.present(update=False)))
+        screen_stim.present() # Back in step with the refresh, then wait a random part of it
+        time.sleep(random.uniform(0, frame_ms) / 1000.0)
+        screen_presents.append(_timed_ms(screen_stim.present))
+    flip_ms = max(_median(screen_presents) - _median(screen_blits), 0.0)
+    return PresentLatencyModel(flip_ms, {kind: _median(values) for kind, values in blits.items()})
+
+
+class PresentScheduler:
+    """Presents stimuli so their flip lands on a deadline (exp.clock ms)."""
+
+    def __init__(self, runtime, model):
+        self.runtime = runtime
+        self.model = model
+        self.onset_errors = {} # kind -> [ms]
+
+    def present_at(self, stim, kind, deadline):
+        """Present `stim` early by the model's lead; returns the onset (exp.clock ms)."""
+        self.runtime.wait_until_clock(deadline - self.model.lead(kind))
+        stim.present()
+        onset = self.runtime.exp.clock.time
+        self.onset_errors.setdefault(kind, []).append(onset - deadline)
+        return onset
+
+    def summary(self):
+        """Median/max onset error per stimulus type, printable."""
+        lines = []
+        for kind, errors in sorted(self.onset_errors.items()):
+            errors = sorted(errors)
+            lines.append(f"Onsets {kind}: {len(errors)} presents, error median {_median(errors):+.1f} ms, "
+                         f"range {errors[0]:+.1f}..{errors[-1]:+.1f} ms")
+        return "\n".join(lines)
@@ -0,0 +1,159 @@
+# '''
+# Readers for the files written by the Long-Range Agreement experiments.
+#
+#   data/*.xpd, Logs/*.csv        Expyriment data files (one row per trial)
+#   events/*.xpe                  Expyriment event files
+#   localizer/audio/data/*.xpd    Localizer data files
+#
+# plus helpers to find the stimulus CSV a run was presented from. Used by the
+# exporters and analysis tools; nothing here needs a display or Expyriment.
+#
+# Project: Long-Range Agreement Pilot
+# '''
+
+import io
+import re
+from pathlib import Path
+import pandas as pd
+
+PROJECT_ROOT = Path(__file__).parent.resolve().parent
+EXPERIMENT_NAME_PATTERN = re.compile(r"Sub (\w+) Run (\d+)")
+LOG_NAME_PATTERN = re.compile(r"subject_(\w+?)_LRA_(\d+)\.csv$")
+XPE_COLUMNS = ["Time", "Type", "Event", "Value", "Detail", "Detail2"]
+
+
+def file_signature(path):
+    """Cheap change detector: (size, mtime_ns) of a file."""
+    stat = Path(path).stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def read_xpd(path):
+    """Read an Expyriment data file; returns (info dict, DataFrame).
+
+    `info` holds the '#e'/'#s' header entries (e.g. 'Experiment', 'id').
+    """
+    info = {}
+    body = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('#'):
+                match = re.match(r"#[es] ([^:]+): ?(.*)", line.rstrip('\n'))
+                if match:
+                    info[match.group(1).strip()] = match.group(2).strip()
+            elif line.strip():
+                body.append(line)
+    if not body:
+        return info, pd.DataFrame()
+    df = pd.read_csv(io.StringIO("".join(body)))
+    df = df.loc[:, [c for c in df.columns if not str(c).startswith('Unnamed')]]
+    return info, df
+
+
+def read_xpe(path):
+    """Read an Expyriment event file into a DataFrame (Time in ms)."""
+    rows = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('#') or line.startswith('Time,') or not line.strip():
+                continue
+            fields = line.rstrip('\n').split(',', len(XPE_COLUMNS) - 1)
+            if not fields[0].lstrip('-').isdigit():
+                continue # e.g. WARNING lines
+            rows.append(fields + [''] * (len(XPE_COLUMNS) - len(fields)))
+    df = pd.DataFrame(rows, columns=XPE_COLUMNS)
+    df['Time'] = df['Time'].astype(int)
+    return df
+
+
+def run_identity(path, info=None):
+    """(subject_id, run_number) of a main-experiment result file, or None."""
+    match = LOG_NAME_PATTERN.search(Path(path).name)
+    if match:
+        return match.group(1), int(match.group(2))
+    if info is None:
+        info, _ = read_xpd(path)
+    match = EXPERIMENT_NAME_PATTERN.search(info.get('Experiment', ''))
+    if match:
+        return match.group(1), int(match.group(2))
+    return None
+
+
+def run_folder(subject_id, run_number, stimuli_root=None):
+    """Run folder a (subject, run) was presented from."""
+    stimuli_root = Path(stimuli_root) if stimuli_root else PROJECT_ROOT / "Stimuli"
+    if str(subject_id).lower() == 'train':
+        return stimuli_root / "training" / f"sub_train_run_{run_number}"
+    return stimuli_root / f"subject_{subject_id}" / f"sub_{subject_id}_run_{run_number}"
+
+
+def stimulus_csv(subject_id, run_number, stimuli_root=None):
+    folder = run_folder(subject_id, run_number, stimuli_root)
+    return folder / f"{folder.name}.csv"
+
+
+def read_stimulus_csv(subject_id, run_number, stimuli_root=None):
+    """Stimulus rows of a run, with the 1-based TrialNumber used in the logs."""
+    df = pd.read_csv(stimulus_csv(subject_id, run_number, stimuli_root))
+    df.insert(0, 'TrialNumber', range(1, len(df) + 1))
+    return df
+
+
+def experiment_info_flag(info, name, default=None):
+    """Boolean entry of the data file header (e.g. 'invert_hands' written by long_range.py)."""
+    value = info.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('true', '1', 'yes')
+
+
+def find_main_results(project_root=None):
+    """Main-experiment data files: data/*.xpd and Logs/*.csv."""
+    project_root = Path(project_root) if project_root else PROJECT_ROOT
+    return sorted((project_root / "data").glob("*.xpd")) + sorted((project_root / "Logs").glob("subject_*_LRA_*.csv"))
+
+
+def read_result_header(path):
+    """(info dict, number of trial rows) of a result file, without parsing the rows."""
+    info = {}
+    n_lines = 0
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('#'):
+                match = re.match(r"#[es] ([^:]+): ?(.*)", line.rstrip('\n'))
+                if match:
+                    info[match.group(1).strip()] = match.group(2).strip()
+            elif line.strip():
+                n_lines += 1
+    return info, max(n_lines - 1, 0) # The first body line is the column header
+
+
+def main_run_results(project_root=None):
+    """{(subject_id, run_number): path} of the main-experiment results, one file per run.
+
+    A run attempted several times (restarted or aborted) leaves several files;
+    the one with the most trials is kept, then the latest. Files without
+    trials or without a recognisable run are left out.
+    """
+    candidates = {}
+    for path in find_main_results(project_root):
+        info, n_rows = read_result_header(path)
+        identity = run_identity(path, info)
+        if identity is None or n_rows == 0:
+            continue
+        rank = (n_rows, path.stat().st_mtime_ns)
+        if identity not in candidates or rank > candidates[identity][0]:
+            candidates[identity] = (rank, path)
+    return {identity: path for identity, (_rank, path) in sorted(candidates.items())}
+
+
+def find_localizer_results(project_root=None):
+    project_root = Path(project_root) if project_root else PROJECT_ROOT
+    return sorted((project_root / "localizer").glob("*/data/*.xpd"))
+
+
+def matching_event_file(xpd_path):
+    """The .xpe written alongside a data/*.xpd (same stem), if present."""
+    xpd_path = Path(xpd_path)
+    xpe = xpd_path.parent.parent / "events" / (xpd_path.stem + ".xpe")
+    return xpe if xpe.is_file() else None
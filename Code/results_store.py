@@ -0,0 +1,245 @@
+# '''
+# Consolidated, indexed results store for all Long-Range Agreement sessions.
+#
+# Ingests every data/*.xpd, Logs/subject_XX_LRA_N.csv and events/*.xpe into
+# one SQLite file, with the stimulus CSV columns and the scheduled onsets
+# joined in. Files already ingested with the same size and mtime are skipped,
+# so re-ingesting after a session only reads the new files. Only one result
+# file per run is kept (the fullest, then latest, attempt); rows of files
+# that were deleted or superseded by another attempt are removed.
+#
+# Usage:
+#     python Code/results_store.py ingest
+#     python Code/results_store.py rt-by structure violation
+#     python Code/results_store.py late [--threshold 25]
+#     python Code/results_store.py sql "SELECT ..."
+#
+# Project: Long-Range Agreement Pilot
+# '''
+
+import sys
+import sqlite3
+import argparse
+from pathlib import Path
+import pandas as pd
+
+from results_io import (PROJECT_ROOT, read_xpd, read_xpe, run_identity, read_stimulus_csv,
+                        main_run_results, matching_event_file, file_signature)
+from schedule import compile_schedule
+
+DEFAULT_DB = PROJECT_ROOT / "results.sqlite"
+GROUPING_COLUMNS = ['subject_id', 'run_number', 'modality', 'condition', 'structure', 'violation',
+                    'congruency', 'interference', 'probe', 'key']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ingested_files (
+    path TEXT PRIMARY KEY,
+    kind TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    n_rows INTEGER
+);
+CREATE TABLE IF NOT EXISTS trials (
+    source TEXT,
+    subject_id TEXT,
+    run_number INTEGER,
+    trial_number INTEGER,
+    onset_ms REAL,
+    target_onset_ms REAL,
+    delta_ms REAL,
+    modality TEXT,
+    sentence TEXT,
+    stimulus_duration_ms REAL,
+    key TEXT,
+    rt_ms REAL,
+    condition TEXT,
+    structure TEXT,
+    violation TEXT,
+    congruency TEXT,
+    interference TEXT,
+    viol_loc REAL,
+    probe_word TEXT,
+    probe INTEGER,
+    rest_duration REAL
+);
+CREATE TABLE IF NOT EXISTS events (
+    source TEXT,
+    time_ms INTEGER,
+    type TEXT,
+    event TEXT,
+    value TEXT,
+    detail TEXT
+);
+CREATE INDEX IF NOT EXISTS trials_run ON trials (subject_id, run_number, trial_number);
+CREATE INDEX IF NOT EXISTS trials_condition ON trials (condition, modality);
+CREATE INDEX IF NOT EXISTS trials_structure_violation ON trials (structure, violation);
+CREATE INDEX IF NOT EXISTS trials_delta ON trials (delta_ms);
+CREATE INDEX IF NOT EXISTS trials_source ON trials (source);
+CREATE INDEX IF NOT EXISTS events_source ON events (source, time_ms);
+"""
+
+
+def connect(db_path=DEFAULT_DB):
+    con = sqlite3.connect(str(db_path))
+    con.executescript(SCHEMA)
+    return con
+
+
+def trial_rows(path, stimuli_root=None):
+    """Trial table of one result file, joined with its stimulus CSV and schedule."""
+    info, df = read_xpd(path)
+    identity = run_identity(path, info)
+    if identity is None or df.empty:
+        return pd.DataFrame()
+    subject_id, run_number = identity
+    stim_df = read_stimulus_csv(subject_id, run_number, stimuli_root)
+    schedule = compile_schedule(stim_df)
+    stim_df['target_onset_ms'] = schedule['onset'].to_numpy()
+    trials = df.merge(stim_df, on='TrialNumber', how='left', suffixes=('', '_stim'))
+    return pd.DataFrame({
+        'source': str(path),
+        'subject_id': subject_id,
+        'run_number': run_number,
+        'trial_number': trials['TrialNumber'],
+        'onset_ms': trials['TrialOnset_ms'],
+        'target_onset_ms': trials['target_onset_ms'],
+        'delta_ms': trials['TrialOnset_ms'] - trials['target_onset_ms'],
+        'modality': trials['Modality'],
+        'sentence': trials['Sentence'],
+        'stimulus_duration_ms': trials['StimulusDuration_ms'],
+        'key': trials['KEY'],
+        'rt_ms': pd.to_numeric(trials['RT_ms'], errors='coerce'),
+        'condition': trials.get('condition'),
+        'structure': trials.get('structure'),
+        'violation': trials.get('violation'),
+        'congruency': trials.get('congruency'),
+        'interference': trials.get('interference'),
+        'viol_loc': trials.get('viol_loc'),
+        'probe_word': trials.get('probe_word'),
+        'probe': trials['probe'].astype('Int64') if 'probe' in trials.columns else None,
+        'rest_duration': trials.get('rest_duration'),
+    })
+
+
+def event_rows(path):
+    xpe = read_xpe(path)
+    return pd.DataFrame({
+        'source': str(path),
+        'time_ms': xpe['Time'],
+        'type': xpe['Type'],
+        'event': xpe['Event'],
+        'value': xpe['Value'],
+        'detail': xpe['Detail'],
+    })
+
+
+def _replace_source(con, table, path, rows):
+    con.execute(f"DELETE FROM {table} WHERE source = ?", (str(path),))
+    if not rows.empty:
+        rows.to_sql(table, con, if_exists='append', index=False)
+
+
+def ingest(con, project_root=PROJECT_ROOT, stimuli_root=None, force=False):
+    """Load new or changed result files; returns the number of files ingested."""
+    known = {row[0]: (row[1], row[2]) for row in con.execute("SELECT path, size, mtime_ns FROM ingested_files")}
+    sources = []
+    for path in main_run_results(project_root).values():
+        sources.append(('trials', path))
+        xpe = matching_event_file(path)
+        if xpe:
+            sources.append(('events', xpe))
+
+    # Drop what came from files that are gone or no longer the kept attempt of their run
+    current = {str(path) for _kind, path in sources}
+    stale = [(path,) for path in known if path not in current]
+    if stale:
+        with con:
+            con.executemany("DELETE FROM trials WHERE source = ?", stale)
+            con.executemany("DELETE FROM events WHERE source = ?", stale)
+            con.executemany("DELETE FROM ingested_files WHERE path = ?", stale)
+        print(f"Removed {len(stale)} deleted or superseded file(s) from the store")
+
+    n_ingested = 0
+    for kind, path in sources:
+        size, mtime_ns = file_signature(path)
+        if not force and known.get(str(path)) == (size, mtime_ns):
+            continue
+        try:
+            rows = trial_rows(path, stimuli_root) if kind == 'trials' else event_rows(path)
+        except (OSError, KeyError, ValueError) as e:
+            print(f"Warning: Could not ingest {path}: {e}")
+            continue
+        with con:
+            _replace_source(con, kind, path, rows)
+            con.execute("INSERT OR REPLACE INTO ingested_files VALUES (?, ?, ?, ?, ?)",
+                        (str(path), kind, size, mtime_ns, len(rows)))
+        n_ingested += 1
+    return n_ingested
+
+
+# --- Query API ---
+
+def query(con, sql, params=()):
+    return pd.read_sql_query(sql, con, params=params)
+
+
+def rt_by(con, *factors, answered_only=True):
+    """Trial count, mean/min/max RT grouped by the given trial columns."""
+    for factor in factors:
+        if factor not in GROUPING_COLUMNS:
+            raise ValueError(f"Cannot group by '{factor}'. Expected one of: {', '.join(GROUPING_COLUMNS)}")
+    columns = ", ".join(factors)
+    where = "WHERE rt_ms >= 0 AND key IN ('left', 'right')" if answered_only else ""
+    select = f"{columns}, " if factors else ""
+    group = f"GROUP BY {columns} ORDER BY {columns}" if factors else ""
+    return query(con, f"SELECT {select}COUNT(*) AS n, AVG(rt_ms) AS mean_rt_ms, MIN(rt_ms) AS min_rt_ms, "
+                      f"MAX(rt_ms) AS max_rt_ms FROM trials {where} {group}")
+
+
+def late_trials(con, threshold_ms=25):
+    """Trials whose block started more than `threshold_ms` after its target onset."""
+    return query(con, "SELECT subject_id, run_number, trial_number, modality, condition, target_onset_ms, onset_ms, delta_ms "
+                      "FROM trials WHERE delta_ms > ? ORDER BY delta_ms DESC", (threshold_ms,))
+
+
+def run_trials(con, subject_id, run_number):
+    return query(con, "SELECT * FROM trials WHERE subject_id = ? AND run_number = ? ORDER BY trial_number",
+                 (str(subject_id), int(run_number)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Indexed store of all session results.")
+    parser.add_argument("--db", type=str, default=str(DEFAULT_DB), help=f"SQLite file (default {DEFAULT_DB.name} in the project root)")
+    parser.add_argument("--project_root", type=str, default=str(PROJECT_ROOT))
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_ingest = sub.add_parser("ingest", help="Load new or changed result files")
+    p_ingest.add_argument("--force", action="store_true", help="Re-ingest every file")
+    p_rt = sub.add_parser("rt-by", help="RT summary grouped by trial columns")
+    p_rt.add_argument("factors", nargs='*', help=f"Any of: {', '.join(GROUPING_COLUMNS)}")
+    p_late = sub.add_parser("late", help="Trials with onset delta above a threshold")
+    p_late.add_argument("--threshold", type=float, default=25, help="ms (default 25)")
+    p_sql = sub.add_parser("sql", help="Run an arbitrary SQL query")
+    p_sql.add_argument("statement")
+    args = parser.parse_args()
+
+    con = connect(args.db)
+    if args.command == "ingest":
+        n = ingest(con, Path(args.project_root), force=args.force)
+        total = con.execute("SELECT COUNT(*) FROM trials").fetchone()[0]
+        print(f"Ingested {n} new/changed files; store holds {total} trials")
+        return
+    try:
+        if args.command == "rt-by":
+            result = rt_by(con, *args.factors)
+        elif args.command == "late":
+            result = late_trials(con, args.threshold)
+        else:
+            result = query(con, args.statement)
+    except (ValueError, sqlite3.Error, pd.errors.DatabaseError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    print(result.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
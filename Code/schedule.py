@@ -0,0 +1,188 @@
+# '''
+# Timing model and schedule compiler for the Long-Range Agreement experiment.
+#
+# long_range.py imports its timing parameters and its block onsets from here,
+# so the schedule printed by this tool is the one the experiment runs.
+#
+# As a script, compiles every run folder under Stimuli/ in one vectorized pass
+# and reports expected durations and overruns against the run budgets:
+#
+#     python Code/schedule.py [Stimuli] [--trials_out onsets.csv]
+#
+# Project: Long-Range Agreement Pilot
+# '''
+
+import re
+import sys
+import time
+import argparse
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# Timing Parameters (modify as needed)
+INITIAL_WAIT = 2000             # ms, Wait time after instructions before first trigger/trial
+FINAL_WAIT = 10000              # ms, Wait time at the end of the experiment
+STIMULUS_ONTIME = 200           # ms, Duration each word is shown (visual) (like params.stimulus_ontime)
+STIMULUS_ITI = 200              # ms, Duration of the inter-stimulus interval (like params.stimulus_iti)
+SOA_PROBE = 1000                # ms, Fixation duration AFTER sentence BEFORE probe for both modalities (added to last ITI for integer reasons...)
+CUE_DURATION = 1000             # ms, Duration of the input modality cues (visual/auditory)
+PROBE_DURATION = 1000           # ms, Duration of the probe (based on 'Neural Populations' paper)
+RESPONSE_DURATION = 2000        # ms, Within rest period, how long to wait for a response AFTER probe
+AUDIO_DURATION = 4000           # ms, Duration of the audio stimulus (like params.audio_duration)
+
+# Run budgets from the README (ms)
+TRAINING_BUDGET = 130000
+MAIN_RUN_BUDGET = 478000
+
+WORD_PATTERN = r"[\w'-]+|[.,!?;:]" # Words and punctuation, as presented one by one
+RUN_CSV_PATTERN = re.compile(r"sub_(train|\d{2})_run_(\d+)\.csv$", re.IGNORECASE)
+
+
+def split_words(sentence):
+    """Split a sentence into the units shown one at a time in visual trials."""
+    return re.findall(WORD_PATTERN, sentence.rstrip('.'))
+
+
+def word_counts(stim_df):
+    """Number of presented words per trial (0 for auditory trials)."""
+    counts = stim_df['sentence'].str.rstrip('.').str.findall(WORD_PATTERN).str.len().to_numpy()
+    return np.where(stim_df['modality'].str.lower().to_numpy() == 'visual', counts, 0)
+
+
+def run_budget(subject_id):
+    return TRAINING_BUDGET if str(subject_id).lower() == 'train' else MAIN_RUN_BUDGET
+
+
+def compile_schedule(stim_df, run_ids=None):
+    """Per-trial, per-phase target onsets (ms from scanner sync) for one or many runs.
+
+    `stim_df` holds the rows of a run CSV, or the concatenated rows of several
+    runs with `run_ids` giving the run of each row (rows of a run contiguous
+    and in presentation order). Everything is computed with array operations.
+    """
+    n = len(stim_df)
+    if run_ids is None:
+        run_ids = np.zeros(n, dtype=int)
+    run_ids = np.asarray(run_ids)
+    modality = stim_df['modality'].str.lower().to_numpy()
+    is_visual = modality == 'visual'
+    n_words = word_counts(stim_df)
+    rest = stim_df['rest_duration'].to_numpy(dtype=float) * 1000
+
+    first_of_run = np.ones(n, dtype=bool)
+    first_of_run[1:] = run_ids[1:] != run_ids[:-1]
+    cue_shown = first_of_run.copy()
+    cue_shown[1:] |= modality[1:] != modality[:-1]
+
+    stim_duration = np.where(is_visual, n_words * (STIMULUS_ONTIME + STIMULUS_ITI), AUDIO_DURATION)
+    stim_probe = stim_duration + SOA_PROBE + PROBE_DURATION
+    block = cue_shown * CUE_DURATION + stim_probe + rest
+
+    # Exclusive cumulative sum restarted at every run boundary
+    cum = np.cumsum(block)
+    before = cum - block
+    run_start = np.maximum.accumulate(np.where(first_of_run, np.arange(n), 0))
+    onset = INITIAL_WAIT + before - before[run_start]
+
+    # Cue and fixation each last CUE_DURATION when the modality changes
+    stim_onset = onset + cue_shown * 2 * CUE_DURATION
+    probe_onset = stim_onset + stim_duration + SOA_PROBE
+    response_onset = probe_onset + PROBE_DURATION
+    response_end = response_onset + RESPONSE_DURATION
+    next_onset = onset + block
+
+    return pd.DataFrame({
+        'run': run_ids,
+        'trial_number': np.arange(n) - run_start + 1,
+        'modality': modality,
+        'word_count': n_words,
+        'cue_shown': cue_shown,
+        'onset': onset,
+        'stim_onset': stim_onset,
+        'stim_duration': stim_duration,
+        'probe_onset': probe_onset,
+        'response_onset': response_onset,
+        'response_end': response_end,
+        'rest_ms': rest,
+        'next_onset': next_onset,
+        'overrun_ms': np.maximum(response_end - next_onset, 0),
+    })
+
+
+def expected_total_duration(schedule_df):
+    """End of the last trial's rest plus FINAL_WAIT, per run (ms)."""
+    return schedule_df.groupby('run', sort=False)['next_onset'].last() + FINAL_WAIT
+
+
+def find_run_csvs(stimuli_root):
+    """All run CSVs under `stimuli_root`, as (subject_id, run_number, path)."""
+    runs = []
+    for csv_path in sorted(Path(stimuli_root).glob('**/*.csv')):
+        match = RUN_CSV_PATTERN.match(csv_path.name)
+        if match:
+            runs.append((match.group(1), int(match.group(2)), csv_path))
+    return runs
+
+
+def compile_all(stimuli_root):
+    """Compile every run under `stimuli_root`; returns (runs summary, trials)."""
+    runs = find_run_csvs(stimuli_root)
+    frames = []
+    for i, (subject_id, run_number, csv_path) in enumerate(runs):
+        df = pd.read_csv(csv_path, usecols=['sentence', 'modality', 'rest_duration'])
+        df['run'] = i
+        frames.append(df)
+    if not frames:
+        return pd.DataFrame(), pd.DataFrame()
+    all_trials = pd.concat(frames, ignore_index=True)
+    trials = compile_schedule(all_trials, all_trials['run'].to_numpy())
+
+    summary = pd.DataFrame(runs, columns=['subject_id', 'run_number', 'csv_path'])
+    summary['n_trials'] = trials.groupby('run').size().to_numpy()
+    summary['expected_ms'] = expected_total_duration(trials).to_numpy()
+    summary['budget_ms'] = [run_budget(s) for s in summary['subject_id']]
+    summary['over_budget_ms'] = summary['expected_ms'] - summary['budget_ms']
+    summary['trial_overruns'] = (trials['overrun_ms'] > 0).groupby(trials['run']).sum().to_numpy()
+
+    trials.insert(0, 'subject_id', summary['subject_id'].to_numpy()[trials['run']])
+    trials.insert(1, 'run_number', summary['run_number'].to_numpy()[trials['run']])
+    return summary, trials.drop(columns='run')
+
+
+def main():
+    script_dir = Path(__file__).parent.resolve()
+    parser = argparse.ArgumentParser(description="Compile the trial schedule of every run and check run budgets.")
+    parser.add_argument("stimuli_root", nargs='?', default=str(script_dir.parent / "Stimuli"),
+                        help="Folder searched recursively for sub_XX_run_Y.csv files (default: ../Stimuli)")
+    parser.add_argument("--trials_out", type=str, default=None,
+                        help="Optional CSV path for the per-trial, per-phase onsets of every run")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    summary, trials = compile_all(args.stimuli_root)
+    elapsed = time.perf_counter() - start
+    if summary.empty:
+        print(f"Error: No run CSV found under {args.stimuli_root}")
+        sys.exit(1)
+
+    for row in summary.itertuples():
+        flag = ""
+        if row.over_budget_ms != 0:
+            flag += f" !!! {row.over_budget_ms / 1000.0:+.2f} s vs budget"
+        if row.trial_overruns:
+            flag += f" !!! {row.trial_overruns} trial(s) overrun"
+        print(f"sub_{row.subject_id}_run_{row.run_number}: {row.n_trials} trials, "
+              f"expected {row.expected_ms / 1000.0:.2f} s (budget {row.budget_ms / 1000.0:.0f} s){flag}")
+    print(f"Compiled {len(summary)} runs / {len(trials)} trials in {elapsed * 1000:.1f} ms")
+
+    if args.trials_out:
+        trials.to_csv(args.trials_out, index=False)
+        print(f"Per-trial onsets written to {args.trials_out}")
+
+    if (summary['over_budget_ms'] != 0).any() or summary['trial_overruns'].any():
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+# '''
+# Speech onset/offset index of every stimulus WAV.
+#
+# Scans Stimuli/**/wavs/*.wav and localizer/audio/sound_files/*.wav. Each file
+# is memory-mapped, cut into FRAME_MS frames and its RMS energy envelope (dB)
+# computed in one array operation; speech onset/offset are the first/last
+# frames more than THRESHOLD_DB above the file's floor and within
+# RANGE_DB of its peak, held for MIN_SPEECH_FRAMES consecutive frames (so
+# clicks are ignored). Files are analysed in a process pool and the results
+# are kept in
+#
+#     acoustics/speech_index.csv    one row per WAV (path relative to the project root)
+#     acoustics/envelopes.npz       the frame envelopes, keyed by the same path
+#     acoustics/trial_acoustics.csv one row per auditory trial (subject, run, trial),
+#                                   with the estimated onset of the critical verb
+#
+# Only files whose size/mtime changed since the last run are re-analysed.
+# The critical verb is word viol_loc (violation trials) or the v1 word; its
+# onset is interpolated between speech onset and offset in proportion to the
+# letters preceding it in the sentence.
+#
+# Usage: python Code/speech_onsets.py [--jobs N] [--force]
+#
+# Project: Long-Range Agreement Pilot
+# '''
+
+import os
+import sys
+import struct
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from results_io import PROJECT_ROOT, file_signature
+from schedule import split_words, find_run_csvs
+
+ACOUSTICS_DIR = PROJECT_ROOT / "acoustics"
+FRAME_MS = 5             # envelope resolution
+THRESHOLD_DB = 15.0      # above the noise floor (10th percentile frame)
+RANGE_DB = 40.0          # below the loudest frame
+MIN_SPEECH_FRAMES = 4    # consecutive frames (20 ms) needed to count as speech
+INDEX_COLUMNS = ['path', 'size', 'mtime_ns', 'sample_rate', 'n_channels', 'duration_ms',
+                 'speech_onset_ms', 'speech_offset_ms', 'peak_db', 'floor_db']
+
+
+def wav_layout(path):
+    """(data offset, n_frames, n_channels, sample_rate, dtype) from a RIFF/WAVE header."""
+    with open(path, 'rb') as f:
+        riff, _size, wave_id = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave_id != b'WAVE':
+            raise ValueError("not a RIFF/WAVE file")
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError("no data chunk")
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                fmt = struct.unpack('<HHIIHH', f.read(16))
+                f.seek(chunk_size - 16 + (chunk_size & 1), 1)
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError("data chunk before fmt chunk")
+                format_tag, n_channels, sample_rate, _byte_rate, block_align, bits = fmt
+                dtype = {(1, 16): '<i2', (1, 32): '<i4', (3, 32): '<f4', (0xFFFE, 16): '<i2'}.get((format_tag, bits))
+                if dtype is None:
+                    raise ValueError(f"unsupported sample format (tag {format_tag}, {bits} bits)")
+                return f.tell(), chunk_size // block_align, n_channels, sample_rate, dtype
+            else:
+                f.seek(chunk_size + (chunk_size & 1), 1)
+
+
+def frame_envelope(path, frame_ms=FRAME_MS):
+    """RMS envelope (dB re full scale) of a WAV in frame_ms frames, plus its sample rate and channel count."""
+    offset, n_frames, n_channels, sample_rate, dtype = wav_layout(path)
+    samples = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(n_frames, n_channels))
+    frame_len = max(1, int(round(sample_rate * frame_ms / 1000.0)))
+    n_env = n_frames // frame_len
+    full_scale = 1.0 if dtype == '<f4' else float(np.iinfo(dtype).max)
+    frames = samples[:n_env * frame_len].reshape(n_env, frame_len, n_channels).astype(np.float32) / full_scale
+    rms = np.sqrt((frames ** 2).mean(axis=(1, 2)))
+    return 20.0 * np.log10(np.maximum(rms, 1e-6)), sample_rate, n_channels, 1000.0 * n_frames / sample_rate
+
+
+def speech_bounds(envelope_db, frame_ms=FRAME_MS):
+    """(onset_ms, offset_ms, peak_db, floor_db) of the speech in an envelope; NaN if silent."""
+    if len(envelope_db) == 0:
+        return np.nan, np.nan, np.nan, np.nan
+    peak = float(envelope_db.max())
+    floor = float(np.percentile(envelope_db, 10))
+    threshold = max(floor + THRESHOLD_DB, peak - RANGE_DB)
+    active = envelope_db > threshold
+    # Frames that start a run of MIN_SPEECH_FRAMES active frames
+    held = np.convolve(active, np.ones(MIN_SPEECH_FRAMES, dtype=int), mode='valid') == MIN_SPEECH_FRAMES
+    starts = np.flatnonzero(held)
+    if peak - floor < THRESHOLD_DB or len(starts) == 0:
+        return np.nan, np.nan, peak, floor
+    onset = starts[0] * frame_ms
+    offset = (starts[-1] + MIN_SPEECH_FRAMES) * frame_ms
+    return float(onset), float(offset), peak, floor
+
+
+def analyse_file(task):
+    """Worker: index row and envelope of one WAV (error string instead on failure)."""
+    path, rel_path = task
+    try:
+        envelope, sample_rate, n_channels, duration = frame_envelope(path)
+        onset, offset, peak, floor = speech_bounds(envelope)
+        size, mtime_ns = file_signature(path)
+        row = [rel_path, size, mtime_ns, sample_rate, n_channels, duration, onset, offset, peak, floor]
+        return row, envelope.astype(np.float32), None
+    except (OSError, ValueError) as e:
+        return None, None, f"{rel_path}: {e}"
+
+
+def find_wavs(project_root=PROJECT_ROOT):
+    project_root = Path(project_root)
+    return sorted((project_root / "Stimuli").glob("**/wavs/*.wav")) + sorted((project_root / "localizer").glob("*/sound_files/*.wav"))
+
+
+def load_index(out_dir=ACOUSTICS_DIR):
+    """(index DataFrame, {path: envelope}) from a previous run, or empty ones."""
+    index_path = Path(out_dir) / "speech_index.csv"
+    envelope_path = Path(out_dir) / "envelopes.npz"
+    if not index_path.is_file():
+        return pd.DataFrame(columns=INDEX_COLUMNS), {}
+    index = pd.read_csv(index_path)
+    envelopes = {}
+    if envelope_path.is_file():
+        with np.load(envelope_path, allow_pickle=False) as data:
+            envelopes = {key: data[key] for key in data.files}
+    return index, envelopes
+
+
+def update_index(project_root=PROJECT_ROOT, out_dir=ACOUSTICS_DIR, jobs=None, force=False):
+    """Analyse new/changed WAVs; returns (index, envelopes, n_analysed, errors)."""
+    project_root = Path(project_root)
+    index, envelopes = (pd.DataFrame(columns=INDEX_COLUMNS), {}) if force else load_index(out_dir)
+    known = {row.path: (row.size, row.mtime_ns) for row in index.itertuples(index=False)}
+
+    wavs = {p.relative_to(project_root).as_posix(): p for p in find_wavs(project_root)}
+    todo = [(str(path), rel) for rel, path in wavs.items()
+            if known.get(rel) != tuple(file_signature(path)) or rel not in envelopes]
+    errors = []
+    new_rows = []
+    if todo:
+        jobs = max(1, min(jobs or os.cpu_count() or 1, len(todo)))
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            for row, envelope, error in pool.map(analyse_file, todo, chunksize=max(1, len(todo) // (4 * jobs))):
+                if error:
+                    errors.append(error)
+                    continue
+                new_rows.append(row)
+                envelopes[row[0]] = envelope
+    updated = {row[0] for row in new_rows}
+    # Keep rows of unchanged files that still exist
+    index = index[index['path'].isin(wavs.keys()) & ~index['path'].isin(updated)]
+    if new_rows:
+        index = pd.concat([index, pd.DataFrame(new_rows, columns=INDEX_COLUMNS)], ignore_index=True)
+    index = index.sort_values('path').reset_index(drop=True)
+    envelopes = {path: envelopes[path] for path in index['path'] if path in envelopes}
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    index.to_csv(out_dir / "speech_index.csv", index=False, float_format="%.1f")
+    np.savez(out_dir / "envelopes.npz", **envelopes)
+    return index, envelopes, len(new_rows), errors
+
+
+def critical_word_index(row):
+    """0-based position of the critical verb: viol_loc (1-based) or the v1 word."""
+    words = split_words(str(row['sentence']))
+    if pd.notna(row.get('viol_loc')):
+        return int(row['viol_loc']) - 1
+    v1 = str(row.get('v1', '')).casefold()
+    matches = [i for i, w in enumerate(words) if w.casefold() == v1]
+    return matches[0] if matches else None
+
+
+def critical_onset(sentence, word_index, onset_ms, offset_ms):
+    """Onset of word `word_index`, interpolated by the letters before it in the sentence."""
+    if word_index is None or np.isnan(onset_ms) or np.isnan(offset_ms):
+        return np.nan
+    letters = np.array([sum(ch.isalpha() for ch in w) for w in split_words(sentence)], dtype=float)
+    if word_index >= len(letters) or letters.sum() == 0:
+        return np.nan
+    return onset_ms + letters[:word_index].sum() / letters.sum() * (offset_ms - onset_ms)
+
+
+def trial_acoustics(index, project_root=PROJECT_ROOT):
+    """Speech and critical-verb onsets of every auditory trial of every run CSV."""
+    project_root = Path(project_root)
+    by_path = index.set_index('path')
+    rows = []
+    for subject_id, run_number, csv_path in find_run_csvs(project_root / "Stimuli"):
+        stim_df = pd.read_csv(csv_path)
+        auditory = stim_df[stim_df['modality'].str.lower() == 'auditory']
+        for trial_number, row in auditory.iterrows():
+            rel = (csv_path.parent / "wavs" / f"{row['trial']}.wav").relative_to(project_root).as_posix()
+            if rel not in by_path.index:
+                continue
+            wav = by_path.loc[rel]
+            word_index = critical_word_index(row)
+            rows.append({
+                'subject_id': subject_id,
+                'run_number': int(run_number),
+                'trial_number': trial_number + 1,
+                'trial': row['trial'],
+                'wav': rel,
+                'speech_onset_ms': wav['speech_onset_ms'],
+                'speech_offset_ms': wav['speech_offset_ms'],
+                'critical_word': int(word_index) + 1 if word_index is not None else None,
+                'critical_onset_ms': critical_onset(row['sentence'], word_index, wav['speech_onset_ms'], wav['speech_offset_ms']),
+            })
+    trials = pd.DataFrame(rows)
+    if not trials.empty:
+        trials['critical_word'] = trials['critical_word'].astype('Int64')
+    return trials
+
+
+def load_trial_acoustics(out_dir=ACOUSTICS_DIR):
+    """Per-trial acoustic onsets for joining on (subject_id, run_number, trial_number); None if not built."""
+    path = Path(out_dir) / "trial_acoustics.csv"
+    if not path.is_file():
+        return None
+    return pd.read_csv(path, dtype={'subject_id': str})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index speech onset/offset of every stimulus WAV.")
+    parser.add_argument("--project_root", type=str, default=str(PROJECT_ROOT))
+    parser.add_argument("--out", type=str, default=None, help="Output folder (default: <project_root>/acoustics)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument("--force", action="store_true", help="Re-analyse every file")
+    args = parser.parse_args()
+
+    project_root = Path(args.project_root).resolve()
+    out_dir = Path(args.out) if args.out else project_root / "acoustics"
+    index, _envelopes, n_analysed, errors = update_index(project_root, out_dir, args.jobs, args.force)
+    for error in errors:
+        print(f"Error: {error}")
+    trials = trial_acoustics(index, project_root)
+    trials.to_csv(out_dir / "trial_acoustics.csv", index=False, float_format="%.1f")
+    silent = index['speech_onset_ms'].isna().sum()
+    print(f"{len(index)} WAVs indexed ({n_analysed} analysed, {len(index) - n_analysed} unchanged"
+          + (f", {silent} without detectable speech" if silent else "") + f"); {len(trials)} auditory trials")
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+# '''
+# Constraint-based generator and verifier of sub_XX_run_Y stimulus lists.
+#
+# generate: builds run folders (CSV, sentences/*.txt, wavs/) for new subjects
+#   from the item bank (every unique sentence already in Stimuli/, or a CSV
+#   given with --item_bank). Each modality block reproduces the design cell
+#   counts of a template run (condition x structure x violation x
+#   interference), probe truth is balanced 50/50 per block, rest durations are
+#   a permutation of the template's (same run length), and a hash index of
+#   the sentences guarantees no sentence is repeated within a subject.
+#   Recordings are copied from the item bank when one exists; anything that
+#   still needs recording is listed.
+#
+# verify: checks every subject folder under Stimuli/ (duplicate sentences
+#   across a subject's runs, block balance, missing WAVs and, with
+#   --probe_tolerance, probe balance).
+#   Per-run results are cached by file signature, so only changed runs are
+#   re-read.
+#
+# Usage:
+#     python Code/stimulus_list_generator.py generate --subjects 4-20 [--seed 0]
+#     python Code/stimulus_list_generator.py verify
+#
+# Project: Long-Range Agreement Pilot
+# '''
+
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+from pathlib import Path
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+
+from schedule import split_words, find_run_csvs
+from results_io import PROJECT_ROOT, file_signature
+
+CELL_COLUMNS = ['condition', 'structure', 'violation', 'interference']
+ITEM_COLUMNS = ['condition', 'structure', 'violation', 'congruency', 'interference', 'viol_loc',
+                'n1_number', 'n2_number', 'v1_number', 'n1', 'n2', 'v1', 'sentence']
+RUN_COLUMNS = ['trial'] + ITEM_COLUMNS + ['modality', 'probe_word', 'probe', 'rest_duration']
+DEFAULT_TEMPLATE = PROJECT_ROOT / "Stimuli" / "subject_01" / "sub_01_run_1" / "sub_01_run_1.csv"
+VERIFY_CACHE = PROJECT_ROOT / ".cache" / "stimulus_lists.json"
+
+
+def sentence_key(sentence):
+    """Hash index key of a sentence (case and spacing insensitive)."""
+    normalized = " ".join(str(sentence).casefold().split())
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def modality_blocks(df):
+    """Block number (0, 1, ...) of each row: a new block starts at every modality change."""
+    modality = df['modality'].str.lower()
+    return (modality != modality.shift()).cumsum().to_numpy() - 1
+
+
+# --- Item bank ---
+
+def build_item_bank(stimuli_root, item_bank_csv=None):
+    """Unique items (one row per sentence) plus the recordings already available.
+
+    Returns (items, probe_wavs) where items has the ITEM_COLUMNS plus
+    'key', 'tts_text' and 'sentence_wav', and probe_wavs maps a lowercase
+    probe word to an existing recording of it.
+    """
+    rows = []
+    probe_wavs = {}
+    for _subject_id, _run_number, csv_path in find_run_csvs(stimuli_root):
+        df = pd.read_csv(csv_path)
+        run_dir = csv_path.parent
+        for row in df.itertuples(index=False):
+            item = {c: getattr(row, c) for c in ITEM_COLUMNS if hasattr(row, c)}
+            txt = run_dir / "sentences" / f"{row.trial}.txt"
+            wav = run_dir / "wavs" / f"{row.trial}.wav"
+            item['tts_text'] = txt.read_text(encoding='utf-8').strip() if txt.is_file() else row.sentence
+            item['sentence_wav'] = str(wav) if wav.is_file() else None
+            rows.append(item)
+            probe_wav = run_dir / "wavs" / f"{row.trial}_probe.wav"
+            if probe_wav.is_file():
+                probe_wavs.setdefault(str(row.probe_word).casefold(), str(probe_wav))
+    if item_bank_csv:
+        extra = pd.read_csv(item_bank_csv)
+        if 'tts_text' not in extra.columns:
+            extra['tts_text'] = extra['sentence']
+        extra['sentence_wav'] = None
+        rows.extend(extra.to_dict('records'))
+    items = pd.DataFrame(rows)
+    items['key'] = items['sentence'].map(sentence_key)
+    # One row per sentence, preferring an occurrence that has a recording
+    items = items.sort_values('sentence_wav', na_position='last', kind='stable').drop_duplicates('key')
+    return items.reset_index(drop=True), probe_wavs
+
+
+def block_quota(template_csv):
+    """Design cell counts of one modality block of the template run."""
+    template = pd.read_csv(template_csv)
+    first_block = template[modality_blocks(template) == 0]
+    return first_block.groupby(CELL_COLUMNS).size().to_dict(), template['rest_duration'].to_numpy()
+
+
+# --- Generation ---
+
+def choose_probe(sentence, probe_true, vocabulary, probe_wavs, auditory, rng):
+    """A word of the sentence (true probe) or of the vocabulary but not the sentence (false probe)."""
+    words = [w for w in split_words(sentence) if w.isalpha() or "'" in w or "-" in w]
+    in_sentence = {w.casefold() for w in words}
+    candidates = words if probe_true else [w for w in vocabulary if w.casefold() not in in_sentence]
+    if auditory:
+        recorded = [w for w in candidates if w.casefold() in probe_wavs]
+        candidates = recorded or candidates
+    return candidates[rng.integers(len(candidates))]
+
+
+def generate_subject(subject_id, items, probe_wavs, quota, rests, n_runs, rng):
+    """Run DataFrames (with 'tts_text'/'sentence_wav' columns) for one subject."""
+    cells = {cell: group.index.to_numpy() for cell, group in items.groupby(CELL_COLUMNS)}
+    has_wav = items['sentence_wav'].notna().to_numpy()
+    vocabulary = sorted({w for s in items['sentence'] for w in split_words(s) if w.isalpha()})
+    used = set() # Sentence hash index for this subject
+    runs = []
+    for run in range(n_runs):
+        # Alternate which modality comes first across runs
+        block_modalities = ['auditory', 'visual'] if run % 2 == 0 else ['visual', 'auditory']
+        run_rows = []
+        for modality in block_modalities:
+            block_rows = []
+            for cell, count in quota.items():
+                pool = [i for i in cells.get(cell, []) if items.at[i, 'key'] not in used]
+                if modality == 'auditory':
+                    # Items that already have a recording first, random within each group
+                    pool = sorted(pool, key=lambda i: (not has_wav[i], rng.random()))
+                else:
+                    pool = list(rng.permutation(pool))
+                if len(pool) < count:
+                    raise ValueError(f"Item bank exhausted for cell {cell} (subject {subject_id}, run {run + 1})")
+                for i in pool[:count]:
+                    used.add(items.at[i, 'key'])
+                    block_rows.append(i)
+            block = items.loc[block_rows].copy()
+            block = block.iloc[rng.permutation(len(block))]
+            block['modality'] = modality
+            n = len(block)
+            block['probe'] = rng.permutation(np.arange(n) < n // 2)
+            block['probe_word'] = [choose_probe(s, p, vocabulary, probe_wavs, modality == 'auditory', rng)
+                                   for s, p in zip(block['sentence'], block['probe'])]
+            run_rows.append(block)
+        run_df = pd.concat(run_rows, ignore_index=True)
+        run_df['trial'] = [f"trial_{i + 1}" for i in range(len(run_df))]
+        run_df['rest_duration'] = rng.permutation(rests)[:len(run_df)]
+        runs.append(run_df)
+    return runs
+
+
+def write_run(run_df, run_dir, probe_wavs):
+    """Write CSV, sentences/*.txt and copy known recordings; returns missing recordings."""
+    run_dir.mkdir(parents=True, exist_ok=True)
+    run_df[[c for c in RUN_COLUMNS if c in run_df.columns]].to_csv(run_dir / f"{run_dir.name}.csv", index=False)
+    missing = []
+    auditory = run_df[run_df['modality'] == 'auditory']
+    if auditory.empty:
+        return missing
+    (run_dir / "sentences").mkdir(exist_ok=True)
+    (run_dir / "wavs").mkdir(exist_ok=True)
+    for row in auditory.itertuples(index=False):
+        (run_dir / "sentences" / f"{row.trial}.txt").write_text(row.tts_text, encoding='utf-8')
+        if row.sentence_wav:
+            shutil.copy2(row.sentence_wav, run_dir / "wavs" / f"{row.trial}.wav")
+        else:
+            missing.append(f"{row.trial}.wav: {row.sentence}")
+        probe_wav = probe_wavs.get(str(row.probe_word).casefold())
+        if probe_wav:
+            shutil.copy2(probe_wav, run_dir / "wavs" / f"{row.trial}_probe.wav")
+        else:
+            missing.append(f"{row.trial}_probe.wav: {row.probe_word}")
+    return missing
+
+
+def parse_subjects(spec):
+    """'4-20' or '4,5,9' -> [4, ..., 20]."""
+    subjects = []
+    for part in spec.split(','):
+        if '-' in part:
+            lo, hi = part.split('-')
+            subjects.extend(range(int(lo), int(hi) + 1))
+        elif part.strip():
+            subjects.append(int(part))
+    return subjects
+
+
+# --- Verification ---
+
+def verify_run(csv_path, quota, probe_tolerance=None):
+    """Checks that only depend on one run; JSON-serialisable for the cache."""
+    df = pd.read_csv(csv_path)
+    problems = []
+    blocks = modality_blocks(df)
+    for b in np.unique(blocks):
+        block = df[blocks == b]
+        counts = block.groupby(CELL_COLUMNS).size().to_dict()
+        if quota and len(block) == sum(quota.values()) and counts != quota:
+            problems.append(f"block {b + 1} ({block['modality'].iloc[0]}) does not match the design cell counts")
+        n_true = int(block['probe'].sum())
+        if probe_tolerance is not None and abs(n_true - len(block) / 2) > probe_tolerance:
+            problems.append(f"block {b + 1} has {n_true}/{len(block)} true probes")
+    duplicates = df[df.duplicated('sentence', keep=False)]['sentence'].unique().tolist()
+    problems.extend(f"sentence repeated within run: {s}" for s in duplicates)
+    for row in df[df['modality'].str.lower() == 'auditory'].itertuples(index=False):
+        for name in (f"{row.trial}.wav", f"{row.trial}_probe.wav"):
+            if not (csv_path.parent / "wavs" / name).is_file():
+                problems.append(f"missing wavs/{name}")
+    return {'keys': [sentence_key(s) for s in df['sentence']], 'sentences': df['sentence'].tolist(), 'problems': problems}
+
+
+def verify_tree(stimuli_root, quota, probe_tolerance=None, cache_path=VERIFY_CACHE):
+    """Verify every run; returns {subject_id: [problem, ...]}."""
+    cache = json.loads(Path(cache_path).read_text()) if Path(cache_path).is_file() else {}
+    new_cache = {}
+    by_subject = defaultdict(list)
+    n_checked = 0
+    quota_key = json.dumps(sorted((list(k), v) for k, v in quota.items())) if quota else None
+    for subject_id, run_number, csv_path in find_run_csvs(stimuli_root):
+        signature = [file_signature(csv_path), quota_key, probe_tolerance]
+        entry = cache.get(str(csv_path))
+        if entry is None or entry['signature'] != signature:
+            entry = {'signature': signature, 'result': verify_run(csv_path, quota, probe_tolerance)}
+            n_checked += 1
+        new_cache[str(csv_path)] = entry
+        by_subject[subject_id].append((run_number, entry['result']))
+
+    report = {}
+    for subject_id, runs in by_subject.items():
+        problems = [f"run {run}: {p}" for run, result in runs for p in result['problems']]
+        seen = {}
+        for run, result in runs:
+            for key, sentence in zip(result['keys'], result['sentences']):
+                if key in seen and seen[key] != run:
+                    problems.append(f"sentence in runs {seen[key]} and {run}: {sentence}")
+                seen.setdefault(key, run)
+        report[subject_id] = problems
+    Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+    Path(cache_path).write_text(json.dumps(new_cache))
+    return report, n_checked
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate and verify balanced stimulus lists.")
+    parser.add_argument("--stimuli_root", type=str, default=str(PROJECT_ROOT / "Stimuli"))
+    parser.add_argument("--template", type=str, default=str(DEFAULT_TEMPLATE),
+                        help="Run CSV whose block design and rest durations are reproduced")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_gen = sub.add_parser("generate", help="Write run folders for new subjects")
+    p_gen.add_argument("--subjects", required=True, help="Subject numbers, e.g. '4-20' or '4,7'")
+    p_gen.add_argument("--runs", type=int, default=6, help="Runs per subject (default 6)")
+    p_gen.add_argument("--seed", type=int, default=None, help="Base seed; subject N uses seed + N")
+    p_gen.add_argument("--item_bank", type=str, default=None, help="Extra items CSV (ITEM_COLUMNS, optional tts_text)")
+    p_gen.add_argument("--overwrite", action="store_true", help="Replace existing subject folders")
+    p_verify = sub.add_parser("verify", help="Check every subject under the stimuli root")
+    p_verify.add_argument("--probe_tolerance", type=float, default=None,
+                          help="Also flag blocks whose true-probe count is further than this from half")
+    args = parser.parse_args()
+
+    stimuli_root = Path(args.stimuli_root)
+    quota, rests = block_quota(args.template)
+
+    if args.command == "verify":
+        report, n_checked = verify_tree(stimuli_root, quota, args.probe_tolerance)
+        n_problems = 0
+        for subject_id in sorted(report):
+            problems = report[subject_id]
+            n_problems += len(problems)
+            print(f"subject {subject_id}: {'OK' if not problems else f'{len(problems)} problem(s)'}")
+            for p in problems:
+                print(f"  {p}")
+        print(f"{len(report)} subjects verified ({n_checked} runs re-read)")
+        sys.exit(1 if n_problems else 0)
+
+    items, probe_wavs = build_item_bank(stimuli_root, args.item_bank)
+    print(f"Item bank: {len(items)} unique sentences, {items['sentence_wav'].notna().sum()} recorded, "
+          f"{len(probe_wavs)} recorded probe words")
+    for subject in parse_subjects(args.subjects):
+        subject_id = f"{subject:02d}"
+        subject_dir = stimuli_root / f"subject_{subject_id}"
+        if subject_dir.exists() and not args.overwrite:
+            print(f"Skipping subject {subject_id}: {subject_dir} exists (use --overwrite)")
+            continue
+        rng = np.random.default_rng(None if args.seed is None else args.seed + subject)
+        try:
+            runs = generate_subject(subject_id, items, probe_wavs, quota, rests, args.runs, rng)
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        missing = []
+        for run_number, run_df in enumerate(runs, start=1):
+            missing += write_run(run_df, subject_dir / f"sub_{subject_id}_run_{run_number}", probe_wavs)
+        print(f"subject {subject_id}: {len(runs)} runs written to {subject_dir}"
+              + (f", {len(missing)} recording(s) still needed" if missing else ""))
+        for m in missing:
+            print(f"  needs recording: {m}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+# '''
+# Lossless compressed stimulus packs.
+#
+# A pack (wavs.pack, a zip archive) holds the WAVs of one run folder or of a
+# whole subject folder. Each distinct WAV (by SHA-1, so a probe recorded once
+# and copied into many runs is stored once) is kept as its header bytes plus
+# its PCM samples, delta-coded along time and LZMA-compressed; index.json maps
+# the WAV paths (relative to the pack's folder) to the entries. Decoding
+# restores the original file byte for byte, which is checked against the
+# SHA-1.
+#
+#     python Code/stimulus_pack.py build [--per subject|run]   # writes Stimuli/.../wavs.pack
+#     python Code/stimulus_pack.py verify
+#     python Code/stimulus_pack.py playback Stimuli/subject_01/sub_01_run_1   # needs Expyriment
+#
+# long_range.py uses a pack when the run folder (or its subject folder) has
+# one: PackDecoder decodes the run's entries in a thread pool (LZMA and numpy
+# release the GIL) from the moment the script starts, and the preload takes
+# the decoded WAV bytes from it instead of reading wavs/. A WAV still on disk
+# whose size or SHA-1 differs from its pack entry (edited after the build)
+# is loaded from the file instead, with a warning. Decoded bytes are handed
+# over once and not kept by the decoder. With a memory budget (windowed
+# loading), nothing is decoded ahead: each WAV is decoded when a trial in the
+# load window acquires it, so the pack is never resident as a whole.
+#
+# Project: Long-Range Agreement Pilot
+# '''
+
+import os
+import sys
+import json
+import lzma
+import time
+import base64
+import hashlib
+import zipfile
+import argparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+
+from schedule import find_run_csvs
+from speech_onsets import wav_layout
+
+PACK_NAME = "wavs.pack"
+INDEX_NAME = "index.json"
+LZMA_PRESET = 6
+DELTA_DTYPES = ('<i2', '<i4') # Integer PCM is delta-coded; float PCM is compressed as is
+
+
+def encode_wav(path):
+    """(entry metadata, compressed payload) of one WAV file."""
+    raw = Path(path).read_bytes()
+    offset, n_frames, n_channels, _rate, dtype = wav_layout(path)
+    n_bytes = n_frames * n_channels * np.dtype(dtype).itemsize
+    pcm = raw[offset:offset + n_bytes]
+    if dtype in DELTA_DTYPES:
+        samples = np.frombuffer(pcm, dtype=dtype).reshape(-1, n_channels)
+        pcm = np.diff(samples, axis=0, prepend=np.zeros((1, n_channels), dtype=dtype)).tobytes() # Wraps around, like the decoder
+    meta = {
+        'sha1': hashlib.sha1(raw).hexdigest(),
+        'size': len(raw),
+        'dtype': dtype,
+        'channels': n_channels,
+        'delta': dtype in DELTA_DTYPES,
+        'head': base64.b64encode(raw[:offset]).decode('ascii'),
+        'tail': base64.b64encode(raw[offset + n_bytes:]).decode('ascii'),
+    }
+    return meta, lzma.compress(pcm, preset=LZMA_PRESET)
+
+
+def decode_entry(meta, payload):
+    """Original WAV bytes of a pack entry (raises ValueError if they do not match the SHA-1)."""
+    pcm = lzma.decompress(payload)
+    if meta['delta']:
+        deltas = np.frombuffer(pcm, dtype=meta['dtype']).reshape(-1, meta['channels'])
+        pcm = np.cumsum(deltas, axis=0, dtype=meta['dtype']).tobytes()
+    data = base64.b64decode(meta['head']) + pcm + base64.b64decode(meta['tail'])
+    if hashlib.sha1(data).hexdigest() != meta['sha1']:
+        raise ValueError(f"pack entry {meta['sha1']} does not decode to the original file")
+    return data
+
+
+def read_index(pack_path):
+    """{'files': {relpath: sha1}, 'entries': {sha1: meta}} of a pack."""
+    with zipfile.ZipFile(pack_path) as z:
+        return json.loads(z.read(INDEX_NAME))
+
+
+def find_pack(run_folder):
+    """The pack covering a run folder (in the run folder or its subject folder), or None."""
+    for folder in (Path(run_folder), Path(run_folder).parent):
+        if (folder / PACK_NAME).is_file():
+            return folder / PACK_NAME
+    return None
+
+
+def pack_folders(stimuli_root, per):
+    """{pack folder: [wav paths]} for every run folder with a wavs/ subfolder."""
+    folders = {}
+    for _subject, _run, csv_path in find_run_csvs(stimuli_root):
+        wavs = sorted((csv_path.parent / "wavs").glob("*.wav"))
+        if wavs:
+            folder = csv_path.parent if per == "run" else csv_path.parent.parent
+            folders.setdefault(folder, []).extend(wavs)
+    return folders
+
+
+def _encode_job(path):
+    return str(path), encode_wav(path)
+
+
+def build_pack(folder, wavs, executor):
+    """Write folder/wavs.pack from `wavs`; returns (n files, n entries, wav bytes, pack bytes)."""
+    index = {'files': {}, 'entries': {}}
+    tmp = Path(folder) / (PACK_NAME + ".tmp")
+    with zipfile.ZipFile(tmp, 'w', compression=zipfile.ZIP_STORED) as z:
+        for path, (meta, payload) in executor.map(_encode_job, wavs, chunksize=8):
+            rel = Path(path).relative_to(folder).as_posix()
+            index['files'][rel] = meta['sha1']
+            if meta['sha1'] not in index['entries']:
+                index['entries'][meta['sha1']] = meta
+                z.writestr(meta['sha1'], payload)
+        z.writestr(INDEX_NAME, json.dumps(index))
+    os.replace(tmp, Path(folder) / PACK_NAME)
+    wav_bytes = sum(os.path.getsize(p) for p in wavs)
+    return len(index['files']), len(index['entries']), wav_bytes, os.path.getsize(Path(folder) / PACK_NAME)
+
+
+class PackDecoder:
+    """Decodes the WAVs of one run from its pack in background threads."""
+
+    def __init__(self, pack_path, run_folder, jobs=None, eager=True):
+        self.pack_path = Path(pack_path)
+        self.folder = self.pack_path.parent
+        index = read_index(pack_path)
+        prefix = Path(run_folder).resolve().relative_to(self.folder.resolve()).as_posix()
+        prefix = "" if prefix == "." else prefix + "/"
+        self.files = {rel: sha1 for rel, sha1 in index['files'].items() if rel.startswith(prefix)}
+        self.entries = {sha1: index['entries'][sha1] for sha1 in set(self.files.values())}
+        self._checked = {} # rel -> whether the pack entry may be used for it
+        self._start = time.perf_counter()
+        self._executor = ThreadPoolExecutor(max_workers=jobs or os.cpu_count())
+        self.eager = eager # Decode every entry now (else only on get())
+        self._futures = {sha1: self._executor.submit(self._decode, self.entries[sha1])
+                         for sha1 in sorted(self.entries)} if eager else {}
+        self.decode_seconds = None
+
+    def _decode(self, meta):
+        with zipfile.ZipFile(self.pack_path) as z:
+            payload = z.read(meta['sha1'])
+        return decode_entry(meta, payload)
+
+    def _rel(self, path):
+        try:
+            return Path(path).resolve().relative_to(self.folder.resolve()).as_posix()
+        except ValueError:
+            return None
+
+    def _matches_disk(self, path, rel):
+        """False if `path` exists on disk with other content than its pack entry."""
+        path = Path(path)
+        if not path.is_file():
+            return True
+        meta = self.entries[self.files[rel]]
+        if os.path.getsize(path) == meta['size'] and hashlib.sha1(path.read_bytes()).hexdigest() == meta['sha1']:
+            return True
+        print(f"Warning: {path} differs from its copy in {self.pack_path}; loading the file (rebuild the pack)")
+        return False
+
+    def has(self, path):
+        """Whether `path` is taken from the pack (packed, and not changed on disk since the build)."""
+        rel = self._rel(path)
+        if rel not in self.files:
+            return False
+        if rel not in self._checked:
+            self._checked[rel] = self._matches_disk(path, rel)
+        return self._checked[rel]
+
+    def key(self, path):
+        """Content key of a packed WAV (the SHA-1 of the original file, as StimulusStore uses)."""
+        return self.files[self._rel(path)]
+
+    def get(self, path):
+        """Decoded WAV bytes of `path` (waits for its entry if it is still being decoded).
+
+        The decoder drops its reference once the bytes are handed over; asking
+        again (e.g. after the stimulus was released) decodes the entry anew.
+        """
+        sha1 = self.key(path)
+        future = self._futures.pop(sha1, None)
+        if future is None:
+            return self._decode(self.entries[sha1])
+        return future.result()
+
+    def wait(self):
+        """Wait for every entry; returns the wall time of the whole decode in seconds."""
+        for future in list(self._futures.values()):
+            future.result()
+        if self.decode_seconds is None:
+            self.decode_seconds = time.perf_counter() - self._start
+            self._executor.shutdown()
+        return self.decode_seconds
+
+    def summary(self):
+        if not self.eager:
+            return (f"Stimulus pack {self.pack_path.name}: {len(self.files)} WAVs ({len(self.entries)} distinct) "
+                    f"decoded on demand")
+        return (f"Stimulus pack {self.pack_path.name}: {len(self.files)} WAVs ({len(self.entries)} distinct) "
+                f"decoded in {self.wait():.2f} s")
+
+
+class NullPack:
+    """Stands in for PackDecoder when the run has no pack."""
+
+    def has(self, path):
+        return False
+
+    def wait(self):
+        return 0.0
+
+    def summary(self):
+        return "Stimulus pack: none (WAVs loaded from wavs/)"
+
+
+def open_pack(run_folder, jobs=None, eager=True):
+    """PackDecoder for the run's pack (decoding starts now if eager), or a NullPack."""
+    pack_path = find_pack(run_folder)
+    return PackDecoder(pack_path, run_folder, jobs, eager) if pack_path else NullPack()
+
+
+def verify_pack(pack_path):
+    """Problems found decoding every entry of a pack and comparing with the WAVs still on disk."""
+    index = read_index(pack_path)
+    problems = []
+    with zipfile.ZipFile(pack_path) as z:
+        decoded = {}
+        for sha1, meta in index['entries'].items():
+            try:
+                decoded[sha1] = decode_entry(meta, z.read(sha1))
+            except (ValueError, KeyError, lzma.LZMAError) as e:
+                problems.append(f"{sha1}: {e}")
+    for rel, sha1 in index['files'].items():
+        wav = Path(pack_path).parent / rel
+        if wav.is_file() and sha1 in decoded and wav.read_bytes() != decoded[sha1]:
+            problems.append(f"{rel}: differs from the packed copy (re-run build)")
+    return problems
+
+
+def check_playback(run_folder):
+    """Problems playing, stopping and releasing a run's packed WAVs through Expyriment.
+
+    Runs the real Audio.play()/stop()/unload() on PackedAudio objects from
+    the StimulusStore, as long_range.py does, on dummy SDL drivers.
+    """
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    from expyriment import control, design
+    from stimulus_store import StimulusStore
+    control.set_develop_mode(True)
+    control.defaults.event_logging = 0
+    control.defaults.opengl = 0 # The dummy video driver has no OpenGL
+    exp = control.initialize(design.Experiment(name="Stimulus pack playback check"))
+    decoder = PackDecoder(find_pack(run_folder), run_folder)
+    store = StimulusStore()
+    problems = []
+    for rel in sorted(decoder.files):
+        path = decoder.folder / rel
+        if not decoder.has(path):
+            continue
+        try:
+            stim = store.acquire_audio_data(decoder.key(path), lambda: decoder.get(path), path.name)
+            stim.play()
+            exp.clock.wait(10)
+            stim.stop()
+            store.release(stim) # unload() stops it again
+        except Exception as e:
+            problems.append(f"{rel}: {type(e).__name__}: {e}")
+    control.end(goodbye_text="", goodbye_delay=0, fast_quit=True)
+    return problems
+
+
+def main():
+    script_dir = Path(__file__).parent.resolve()
+    parser = argparse.ArgumentParser(description="Build or verify lossless compressed WAV packs.")
+    parser.add_argument("command", choices=["build", "verify", "playback"])
+    parser.add_argument("stimuli_root", nargs='?', default=str(script_dir.parent / "Stimuli"),
+                        help="Folder searched recursively for run folders (default: ../Stimuli); for playback, one run folder")
+    parser.add_argument("--per", choices=["subject", "run"], default="subject",
+                        help="One pack per subject folder (shared WAVs stored once) or per run folder")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Worker processes")
+    args = parser.parse_args()
+
+    if args.command == "playback":
+        if find_pack(args.stimuli_root) is None:
+            print(f"Error: No {PACK_NAME} covering {args.stimuli_root}")
+            sys.exit(1)
+        problems = check_playback(args.stimuli_root)
+        print(f"Playback of packed WAVs in {args.stimuli_root}: {'OK' if not problems else f'{len(problems)} problem(s)'}")
+        for problem in problems[:10]:
+            print(f"    {problem}")
+        if problems:
+            sys.exit(2)
+        return
+
+    if args.command == "verify":
+        packs = sorted(Path(args.stimuli_root).glob(f"**/{PACK_NAME}"))
+        if not packs:
+            print(f"Error: No {PACK_NAME} under {args.stimuli_root}")
+            sys.exit(1)
+        failed = 0
+        for pack_path in packs:
+            problems = verify_pack(pack_path)
+            failed += bool(problems)
+            print(f"{pack_path}: {'OK' if not problems else f'{len(problems)} problem(s)'}")
+            for problem in problems[:10]:
+                print(f"    {problem}")
+        if failed:
+            sys.exit(2)
+        return
+
+    folders = pack_folders(args.stimuli_root, args.per)
+    if not folders:
+        print(f"Error: No run folder with wavs/ under {args.stimuli_root}")
+        sys.exit(1)
+    start = time.perf_counter()
+    total_wav = total_pack = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        for folder, wavs in sorted(folders.items()):
+            n_files, n_entries, wav_bytes, pack_bytes = build_pack(folder, wavs, executor)
+            total_wav += wav_bytes
+            total_pack += pack_bytes
+            print(f"{folder / PACK_NAME}: {n_files} WAVs ({n_entries} distinct), "
+                  f"{wav_bytes / 1e6:.1f} MB -> {pack_bytes / 1e6:.1f} MB")
+    print(f"Packed {total_wav / 1e6:.1f} MB of WAVs into {total_pack / 1e6:.1f} MB "
+          f"({100.0 * total_pack / max(total_wav, 1):.0f}%) in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+# '''
+# Content-addressed stimulus store for the Long-Range Agreement experiment.
+#
+# Audio files are keyed by the SHA-1 of their bytes and text stimuli by their
+# (word, font, size) tuple, so a probe WAV or a word that appears in many
+# trials is loaded and preloaded once and shared by every trial using it.
+# Each acquire() increments a reference count; release() decrements it and
+# unloads the stimulus when no trial needs it anymore.
+#
+# The store also estimates the memory each preloaded stimulus occupies
+# (decoded samples for audio, RGBA pixels for surfaces/textures), so the
+# resident footprint can be reported per stimulus type and compared with a
+# memory budget.
+#
+# WAVs from a stimulus pack (see stimulus_pack.py) are acquired from their
+# decoded bytes as PackedAudio, under the same content key as the file; the
+# bytes are dropped once the mixer Sound is built and no sample copy is kept,
+# so PackedAudio can only seek back to the start (which stop() does).
+#
+# Project: Long-Range Agreement Pilot
+# '''
+
+import io
+import hashlib
+from pathlib import Path
+import pygame
+from expyriment import stimuli
+
+BYTES_PER_PIXEL = 4  # RGBA surface / OpenGL texture
+
+
+def audio_key(path):
+    """Content key of an audio file (SHA-1 of its bytes)."""
+    with open(path, 'rb') as f:
+        return "audio:" + hashlib.sha1(f.read()).hexdigest()
+
+
+def text_key(word, text_size, text_font):
+    """Content key of a text stimulus (word/font/size tuple)."""
+    payload = f"{word}\0{Path(text_font).name if text_font else ''}\0{text_size}"
+    return "text:" + hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def footprint_bytes(stim):
+    """Estimated memory of a preloaded stimulus (decoded audio or RGBA pixels)."""
+    if isinstance(stim, stimuli.Audio):
+        sound = stim._file # pygame Sound once preloaded
+        mixer = pygame.mixer.get_init()
+        if sound is None or mixer is None:
+            return 0
+        frequency, sample_format, channels = mixer
+        n_bytes = int(round(sound.get_length() * frequency)) * channels * (abs(sample_format) // 8)
+        sound_array = getattr(stim, '_sound_array', None) # Audio.preload() keeps a sample copy for seeking
+        return n_bytes + (sound_array.nbytes if sound_array is not None else 0)
+    width, height = stim.surface_size
+    return width * height * BYTES_PER_PIXEL
+
+
+class PackedAudio(stimuli.Audio):
+    """Audio stimulus played from WAV bytes in memory instead of a file."""
+
+    def __init__(self, filename, data):
+        # Audio.__init__ insists on a file on disk; set up the same state without it
+        stimuli.Audio.__bases__[0].__init__(self, filename)
+        self._filename = filename
+        self._data = data
+        self._file = None
+        self._is_preloaded = False
+        self._channel = None
+        self._is_paused = False
+        self._start_position = 0
+        self._start_time = 0
+        self._paused_time = 0
+
+    def preload(self):
+        if not self._is_preloaded:
+            if self._data is None:
+                raise RuntimeError(f"{self._filename} was unloaded; acquire it from the pack again")
+            self._file = pygame.mixer.Sound(file=io.BytesIO(self._data))
+            self._length = self._file.get_length()
+            self._sound_array = None # No seeking: no second copy of the samples
+            self._data = None
+            self._is_preloaded = True
+        return 0
+
+    def seek(self, time):
+        """Only rewinding to the start is supported (Audio.stop() and unload() seek to 0)."""
+        if time != 0:
+            raise NotImplementedError(f"{self._filename}: packed audio can only seek to the start")
+        if self._is_preloaded:
+            self._file.stop()
+        self._start_position = 0
+        self._start_time = 0
+        self._paused_time = 0
+        self._is_paused = False
+
+
+def megabytes(n_bytes):
+    return n_bytes / (1024.0 * 1024.0)
+
+
+class StimulusStore:
+    """Shares preloaded stimuli between trials, with reference counts."""
+
+    def __init__(self):
+        self._entries = {}      # key -> [stimulus, refcount]
+        self._keys_by_id = {}   # id(stimulus) -> key, for release(stimulus)
+        self._path_keys = {}    # resolved path -> key, avoids re-hashing a file
+        self.requests = 0       # Total acquire() calls (i.e. trial occurrences)
+        self._bytes = {}        # key -> estimated footprint of the loaded stimulus
+        self._static = {}       # kind -> [count, bytes] of stimuli preloaded outside the store
+        self.resident_bytes = 0 # Current estimated footprint (store + static)
+        self.peak_bytes = 0
+        self.largest = {}       # kind -> (bytes, description) of the largest stimulus seen
+
+    def _record(self, kind, n_bytes, description):
+        self.resident_bytes += n_bytes
+        self.peak_bytes = max(self.peak_bytes, self.resident_bytes)
+        if n_bytes > self.largest.get(kind, (-1, None))[0]:
+            self.largest[kind] = (n_bytes, description)
+
+    def _acquire(self, key, factory, description=""):
+        self.requests += 1
+        entry = self._entries.get(key)
+        if entry is None:
+            stim = factory()
+            stim.preload()
+            entry = [stim, 0]
+            self._entries[key] = entry
+            self._keys_by_id[id(stim)] = key
+            self._bytes[key] = footprint_bytes(stim)
+            self._record(key.split(":", 1)[0], self._bytes[key], description)
+        entry[1] += 1
+        return entry[0]
+
+    def account(self, stim, kind):
+        """Count a stimulus preloaded outside the store (fixation, pictures...) in the footprint."""
+        n_bytes = footprint_bytes(stim)
+        count = self._static.setdefault(kind, [0, 0])
+        count[0] += 1
+        count[1] += n_bytes
+        self._record(kind, n_bytes, kind)
+
+    def acquire_audio(self, path):
+        """Return a preloaded Audio for `path`, shared by identical files."""
+        path = Path(path).resolve()
+        key = self._path_keys.get(path)
+        if key is None:
+            key = audio_key(path)
+            self._path_keys[path] = key
+        return self._acquire(key, lambda: stimuli.Audio(str(path)), path.name)
+
+    def acquire_audio_data(self, sha1, data_factory, name):
+        """Return a preloaded PackedAudio for WAV bytes with SHA-1 `sha1` (data_factory() called only if new)."""
+        return self._acquire("audio:" + sha1, lambda: PackedAudio(name, data_factory()), name)
+
+    def acquire_text(self, word, text_size, text_font):
+        """Return a preloaded TextLine, shared by identical word/font/size."""
+        key = text_key(word, text_size, text_font)
+        return self._acquire(key, lambda: stimuli.TextLine(word, text_size=text_size, text_font=text_font), word)
+
+    def release(self, stim):
+        """Drop one reference to `stim`; unload it once nothing uses it."""
+        if stim is None:
+            return
+        key = self._keys_by_id.get(id(stim))
+        if key is None:
+            return # Not owned by the store
+        entry = self._entries[key]
+        entry[1] -= 1
+        if entry[1] <= 0:
+            entry[0].unload()
+            del self._entries[key]
+            del self._keys_by_id[id(stim)]
+            self.resident_bytes -= self._bytes.pop(key)
+
+    def release_all(self, stims):
+        for stim in stims:
+            self.release(stim)
+
+    def refcount(self, stim):
+        key = self._keys_by_id.get(id(stim))
+        return self._entries[key][1] if key is not None else 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def summary(self):
+        """One-line description of how much sharing the store achieved."""
+        n_audio = sum(1 for k in self._entries if k.startswith("audio:"))
+        n_text = len(self._entries) - n_audio
+        return (f"Stimulus store: {len(self._entries)} unique stimuli "
+                f"({n_audio} audio, {n_text} text) for {self.requests} trial uses")
+
+    def footprint_table(self):
+        """Resident memory per stimulus type, as a printable table."""
+        rows = {}
+        for key, n_bytes in self._bytes.items():
+            kind = key.split(":", 1)[0]
+            count = rows.setdefault(kind, [0, 0])
+            count[0] += 1
+            count[1] += n_bytes
+        for kind, (n, n_bytes) in self._static.items():
+            count = rows.setdefault(kind, [0, 0])
+            count[0] += n
+            count[1] += n_bytes
+        lines = [f"{'type':<12}{'count':>7}{'MB':>10}  largest"]
+        for kind in sorted(rows):
+            n, n_bytes = rows[kind]
+            largest_bytes, largest_name = self.largest.get(kind, (0, ""))
+            lines.append(f"{kind:<12}{n:>7}{megabytes(n_bytes):>10.2f}  {largest_name} ({megabytes(largest_bytes):.2f} MB)")
+        lines.append(f"{'total':<12}{sum(n for n, _b in rows.values()):>7}{megabytes(self.resident_bytes):>10.2f}"
+                     f"  (peak {megabytes(self.peak_bytes):.2f} MB)")
+        return "\n".join(lines)
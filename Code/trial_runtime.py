@@ -0,0 +1,134 @@
+# '''
+# Trial runtime shared by the main experiment (long_range.py) and the
+# localizer scripts (localizer/audio/biling_localizer_*.py).
+#
+# TrialRuntime wraps the timing-critical parts of a run: scanner trigger
+# sync, deadline waits (sleep in short chunks while polling the escape key,
+# then spin for the last SPIN_MARGIN ms), response capture and abort
+# handling. TrialLog buffers data rows and hands them to exp.data when
+# flushed (during a rest period or at the end of the run). load_trial_table
+# reads a paradigm's CSV and checks it against the columns that paradigm
+# needs.
+#
+# Scripts outside Code/ add this folder to sys.path before importing.
+#
+# Project: Long-Range Agreement Pilot
+# '''
+
+import sys
+import time
+import pandas as pd
+from expyriment import control, misc
+
+SPIN_MARGIN = 2    # ms before a deadline at which sleeping stops and spinning starts
+SLEEP_CHUNK = 20   # ms, longest single sleep (bounds the escape key latency)
+TRIGGER_KEY = misc.constants.K_t
+ESCAPE_KEY = misc.constants.K_ESCAPE
+
+
+def load_trial_table(csv_path, required_columns):
+    """Read a paradigm's trial CSV; exits with an error if a required column is missing."""
+    try:
+        table = pd.read_csv(csv_path)
+    except (OSError, pd.errors.ParserError) as e:
+        print(f"Error: Could not read trial table {csv_path}: {e}")
+        sys.exit(1)
+    missing = [col for col in required_columns if col not in table.columns]
+    if missing:
+        print(f"Error: Trial table missing required columns: {missing} in {csv_path}")
+        sys.exit(1)
+    return table
+
+
+def preload_all(stims):
+    """Preload every stimulus ahead of the run; returns how many were preloaded."""
+    n = 0
+    for stim in stims:
+        if stim is not None:
+            stim.preload()
+            n += 1
+    return n
+
+
+class TrialLog:
+    """Buffered data rows, handed to exp.data on flush()."""
+
+    def __init__(self, exp, columns):
+        self.exp = exp
+        self.exp.data_variable_names = list(columns)
+        self.rows = []
+
+    def add(self, row):
+        self.rows.append(row)
+
+    def flush(self):
+        for row in self.rows:
+            self.exp.data.add(row)
+        self.rows = []
+
+
+class TrialRuntime:
+    """Trigger sync, deadline waits and response capture for one run."""
+
+    def __init__(self, exp, escape_key=ESCAPE_KEY, on_abort=None):
+        self.exp = exp
+        self.escape_key = escape_key
+        self.on_abort = on_abort # Called before the experiment ends on escape (e.g. to save data)
+        self.start_time = None
+
+    def abort(self, goodbye_text="Experiment aborted."):
+        try:
+            if self.on_abort is not None:
+                self.on_abort()
+        except Exception as e:
+            print(f"Error: Could not save the data on abort: {e}")
+        finally:
+            # The experiment is ended (and its files saved) even if on_abort fails
+            control.end(goodbye_text=goodbye_text, goodbye_delay=1000)
+            sys.exit()
+
+    def check_escape(self):
+        if self.exp.keyboard.check(self.escape_key):
+            self.abort()
+
+    def wait_for_triggers(self, n_triggers, key=TRIGGER_KEY, screen=None):
+        """Show `screen` (if given) and wait for `n_triggers` scanner triggers."""
+        if screen is not None:
+            screen.present()
+        for _ in range(n_triggers):
+            self.exp.keyboard.wait(key)
+
+    def start_clock(self):
+        """Mark time zero of the run (deadlines passed to wait_until are relative to it)."""
+        self.start_time = self.exp.clock.time
+        return self.start_time
+
+    def now(self):
+        """Time since start_clock(), in ms."""
+        return self.exp.clock.time - self.start_time
+
+    def wait_until_clock(self, deadline):
+        """Wait until exp.clock reaches `deadline` (ms); returns the lateness in ms."""
+        remaining = deadline - self.exp.clock.time
+        while remaining > SPIN_MARGIN:
+            time.sleep(min(remaining - SPIN_MARGIN, SLEEP_CHUNK) / 1000.0)
+            self.check_escape()
+            remaining = deadline - self.exp.clock.time
+        while self.exp.clock.time < deadline:
+            pass
+        return self.exp.clock.time - deadline
+
+    def wait_until(self, deadline):
+        """Wait until `deadline` ms after start_clock(); returns the lateness in ms."""
+        return self.wait_until_clock(self.start_time + deadline)
+
+    def wait(self, duration):
+        """Wait `duration` ms from now."""
+        return self.wait_until_clock(self.exp.clock.time + duration)
+
+    def capture_response(self, keys, duration):
+        """Wait up to `duration` ms for one of `keys`; returns (key, rt) or (None, None)."""
+        key, rt = self.exp.keyboard.wait(keys=list(keys) + [self.escape_key], duration=duration)
+        if key == self.escape_key:
+            self.abort("Experiment aborted by user during response window.")
+        return key, rt
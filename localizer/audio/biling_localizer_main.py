@@ -2,13 +2,15 @@
 # updated: <2016-02-04 Esther LIN>
 # -*- coding: utf-8 -*-
 
-import pandas as pd
-import os.path as op
 import sys
-import expyriment
-from expyriment import design, control, stimuli, io, misc
+from pathlib import Path
+from expyriment import design, control, stimuli, misc
 import pygame
 
+# Shared trial runtime (trigger sync, deadline waits, buffered logging) lives in Code/
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "Code"))
+from trial_runtime import TrialRuntime, TrialLog, load_trial_table, preload_all
+
 pygame.init()
 
 
@@ -43,26 +45,25 @@ MAX_RESPONSE_DURATION = 1000  # need to be less than (900 + min ITI)
 control.initialize(exp)
 
 ## load the stimuli table into a block of trials
-stim_tbl = pd.read_csv(stimuli_table)
+LOCALIZER_COLUMNS = ["subj", "nbloc", "langue", "sent_onset", "sent_dur", "fname"]
+NUM_TRIGGERS = 3  # scanner triggers to wait for before the run starts
+stim_tbl = load_trial_table(stimuli_table, LOCALIZER_COLUMNS)
 
 block = design.Block(name="block1")
 
 trial_items = []
 
-for (i, stim_info) in stim_tbl.iterrows():
+for stim_info in stim_tbl.itertuples(index=False):
     trial = design.Trial()
     trial.set_factor("subj", stim_info.subj)
     trial.set_factor("nbloc", stim_info.nbloc)
     trial.set_factor("langue", stim_info.langue)
     trial.set_factor("sent_onset", stim_info.sent_onset)
     trial.set_factor("sent_dur", stim_info.sent_dur)
-    trial.set_factor("stims", stim_info.fname)    
-    
-
+    trial.set_factor("stims", stim_info.fname)
 
-    sound_fnames = [str("./sound_files/"+stim_info['fname'])]
+    sound_fnames = [str("./sound_files/" + stim_info.fname)]
     trial_items.append(sound_fnames)
-    # transform the strings into surfaces to be blit on the screen
     for w in sound_fnames:
         stim = stimuli.Audio(w)
         trial.add_stimulus(stim)
@@ -70,8 +71,11 @@ for (i, stim_info) in stim_tbl.iterrows():
 
 exp.add_block(block)  # note that there is only one block in this experiment
 
-exp.data_variable_names = ["subj", "nbloc", "langue", "sent_onset", 
-                           "real_sentence_onset_before","real_sentence_onset_after","sent_dur","filename"]
+# Preload every sentence now, so nothing is read from disk between onsets
+preload_all(stim for trial in block.trials for stim in trial.stimuli)
+
+trial_log = TrialLog(exp, ["subj", "nbloc", "langue", "sent_onset",
+           "real_sentence_onset_before", "real_sentence_onset_after", "onset_error", "sent_dur", "filename"])
 
 ### A few useful objects and functions 
 
@@ -97,49 +101,33 @@ def clear_screen():
     exp.screen.clear()
     exp.screen.update()
 
-
-def wait_for_MRI_synchro():
-    fixcrossGreen.present(clear=True, update=True)
-    exp.keyboard.wait_char('t')
-    
-
-
-def wait_until(clock, time):
-    # busy loop wait
-    while (clock.time < time):
-        pass
-
 ############ MAIN LOOP
 
 control.start(exp)
+runtime = TrialRuntime(exp, on_abort=trial_log.flush)
 
 
 for block in exp.blocks:
-    wait_for_MRI_synchro()
-    wait_for_MRI_synchro()
-    wait_for_MRI_synchro()
+    runtime.wait_for_triggers(NUM_TRIGGERS, screen=fixcrossGreen)
     clear_screen()
 
     # present the fixation cross
-    fixcrossGrey.present()    
-    
-    clock = expyriment.misc.Clock()
+    fixcrossGrey.present()
 
-    for itrial, trial in enumerate(block.trials):
-        #print "Trial: #"+itrial
-        for stim in trial.stimuli:
-            stim.preload()
+    runtime.start_clock()
 
+    for itrial, trial in enumerate(block.trials):
+        stim = trial.stimuli[0]
         # present the sentence
-        wait_until(clock, trial.get_factor("sent_onset"))
-        real_sentence_onset_before = clock.time
-        stim.present()        
-        real_sentence_onset_after = clock.time
-        
-        io.Keyboard.process_control_keys()
+        onset_error = runtime.wait_until(trial.get_factor("sent_onset"))
+        real_sentence_onset_before = runtime.now()
+        stim.present()
+        real_sentence_onset_after = runtime.now()
 
-        exp.data.add([trial.get_factor("subj"), trial.get_factor('nbloc'),
-                      trial.get_factor('langue'), trial.get_factor('sent_onset'), 
-                      real_sentence_onset_before,real_sentence_onset_after,trial.get_factor('sent_dur')," ".join(trial_items[itrial])])
+        trial_log.add([trial.get_factor("subj"), trial.get_factor('nbloc'),
+                       trial.get_factor('langue'), trial.get_factor('sent_onset'),
+                       real_sentence_onset_before, real_sentence_onset_after,
+                       onset_error, trial.get_factor('sent_dur'), " ".join(trial_items[itrial])])
 
+trial_log.flush()
 control.end()
@@ -1,154 +1,205 @@
-import pandas as pd
+# '''
+# Generates the audio localizer stimulus tables (long-range_localizer_subN.csv).
+#
+# Each subject gets 16 mini-blocks of 3 sentences alternating French / Wolof
+# (Chinese "ch" items excluded), sampled without replacement within a block
+# from the sentences listed in the source CSVs. Onsets start at 1.5 s; within
+# a block the next sentence starts 1.3 s after the previous one ends, and 8 s
+# separate blocks. A final silent row pads the run to --run_length_ms.
+#
+# Every fname is checked against the sound_files folder and its sent_dur
+# against the WAV length. Each subject has its own seed (--seed + subject
+# number, --seed defaults to 0), so regenerating a cohort is reproducible;
+# subjects are generated in parallel. Tables are written to generated/ (not to
+# the stim/ source pool) and existing tables are only replaced with
+# --overwrite.
+#
+# Usage:
+#     python generate_long-range_localizer_csvs.py --subjects 4-20 [--seed 0] [--source stim] [--out generated] [--overwrite]
+#
+# Project: Long-Range Agreement Pilot
+# '''
+
 import os
-import random
-
-def create_custom_localizer_csvs():
-    # --- Configuration ---
-    source_stim_folder = "/home/avalazem/Desktop/Work/Single_Word_Processing_Stage/Long_Range_Agreement/Christophe_Localizer/audio-language_localizer/stim"
-    output_csv_folder = "/home/avalazem/Desktop/Work/Single_Word_Processing_Stage/Long_Range_Agreement/Christophe_Localizer/lang_localizer/long-range_stim"
-    
-    num_subjects_to_generate = 3
-    subject_id_start = 1
-    
-    num_blocks = 16
-    trials_per_block = 3
-    initial_onset_ms = 1500
-    inter_block_interval_ms = 8000 # Interval after a block's last trial, before next block's first trial
-
-    # --- 1. Load and Process Initial Stimuli Data ---
-    fname_sent_durations_initial = {}
-    print(f"Scanning source CSVs in: {source_stim_folder}")
-    try:
-        if not os.path.isdir(source_stim_folder):
-            print(f"Error: Source stimulus folder not found at {source_stim_folder}")
-            return
-
-        for filename in os.listdir(source_stim_folder):
-            if filename.lower().endswith(".csv"):
-                file_path = os.path.join(source_stim_folder, filename)
-                try:
-                    df_temp = pd.read_csv(file_path)
-                    if "fname" in df_temp.columns and "sent_dur" in df_temp.columns:
-                        for _index, row in df_temp.iterrows():
-                            fname = row["fname"]
-                            sent_dur = row["sent_dur"]
-                            if pd.notna(fname) and pd.notna(sent_dur):
-                                if fname not in fname_sent_durations_initial:
-                                    try:
-                                        fname_sent_durations_initial[fname] = int(sent_dur)
-                                    except ValueError:
-                                        print(f"  Warning: Could not convert sent_dur \'{sent_dur}\' to int for fname \'{fname}\' in {filename}. Skipping.")
-                                # No verification for differing durations here, just take the first.
-                    else:
-                        print(f"  Skipping {filename}: missing 'fname' or 'sent_dur' column.")
-                except Exception as e:
-                    print(f"  Error processing file {filename}: {e}")
-    except Exception as e:
-        print(f"Error listing source stimulus directory: {e}")
-        return
-        
-    print(f"Initial unique fnames loaded: {len(fname_sent_durations_initial)}")
-
-    # --- 2. Filter Stimuli ---
-    fname_sent_durations_filtered = {
-        fname: dur
-        for fname, dur in fname_sent_durations_initial.items()
-        if not fname.startswith("ch")
-    }
-    print(f"Fnames after removing 'ch' prefix: {len(fname_sent_durations_filtered)}")
-
-    fr_stimuli_pool = []  # List of (fname, sent_dur)
-    wol_stimuli_pool = [] # List of (fname, sent_dur)
-
-    for fname, dur in fname_sent_durations_filtered.items():
-        if fname.lower().startswith("fr_"):
-            fr_stimuli_pool.append((fname, dur))
-        elif fname.lower().startswith("wol"):
-            wol_stimuli_pool.append((fname, dur))
-            
-    random.shuffle(fr_stimuli_pool) # Shuffle once initially
-    random.shuffle(wol_stimuli_pool)
-    
-    print(f"French stimuli available: {len(fr_stimuli_pool)}")
-    print(f"Wolof stimuli available: {len(wol_stimuli_pool)}")
-
-    if not os.path.exists(output_csv_folder):
-        os.makedirs(output_csv_folder)
-        print(f"Created output directory: {output_csv_folder}")
-
-    # --- 3. Generate New CSV Files ---
-    # fr_needed_per_subject and wol_needed_per_subject are not strictly needed upfront
-    # if we are sampling per block and allowing reuse across blocks.
-
-    for s_offset in range(num_subjects_to_generate):
-        subj_id = subject_id_start + s_offset
-        all_trials_for_subject = []
-        current_onset_tracker = initial_onset_ms # This will be the onset for the first trial
-        
-        print(f"\nGenerating CSV for Subject ID: {subj_id}")
-
-        # Removed pre-creation of subject_fr_set and subject_wol_set
-        # Stimuli will be selected on a per-block basis.
-
-        for block_idx in range(num_blocks):
-            is_fr_block = block_idx % 2 == 0
-            lang_for_block = "fr" if is_fr_block else "wol"
-            
-            # print(f"  Block {block_idx} ({lang_for_block})")
-
-            stimuli_for_this_block = []
-            pool_to_use_for_block = fr_stimuli_pool if is_fr_block else wol_stimuli_pool
-
-            if not pool_to_use_for_block:
-                print(f"  FATAL ERROR: Stimulus pool for language '{lang_for_block}' is empty. Cannot generate block {block_idx} for Subject {subj_id}.")
-                # This is a critical error; consider how to handle. Maybe skip subject or stop.
-                # For now, if a pool is empty, subsequent blocks of this lang will also fail.
-                break # Break from generating blocks for this subject if a language pool is empty
-
-            if len(pool_to_use_for_block) < trials_per_block:
-                print(f"  Warning: Stimulus pool for language '{lang_for_block}' ({len(pool_to_use_for_block)} items) is smaller than trials_per_block ({trials_per_block}). Duplicates within block {block_idx} for Subject {subj_id} are unavoidable.")
-                # Sample with replacement if not enough unique stimuli for the block
-                stimuli_for_this_block = random.choices(pool_to_use_for_block, k=trials_per_block)
-            else:
-                # Sample without replacement, ensuring unique stimuli within this block
-                stimuli_for_this_block = random.sample(pool_to_use_for_block, trials_per_block)
-            
-            if len(stimuli_for_this_block) < trials_per_block:
-                 print(f"    FATAL: Could not select enough stimuli for Subject {subj_id}, Block {block_idx}. Required {trials_per_block}, got {len(stimuli_for_this_block)}. Skipping rest of this subject's generation.")
-                 # This indicates a problem even with random.choices or if pool_to_use_for_block was empty initially.
-                 all_trials_for_subject = [] # Clear any partial data for this subject
-                 break # Stop processing this subject
-
-            for trial_in_block_idx, (selected_fname, selected_sent_dur) in enumerate(stimuli_for_this_block):
-                global_trial_num = block_idx * trials_per_block + trial_in_block_idx + 1
-                
-                all_trials_for_subject.append({
-                    "subj": subj_id,
-                    "ntrial": global_trial_num,
-                    "nbloc": block_idx,
-                    "langue": lang_for_block,
-                    "sent_dur": selected_sent_dur,
-                    "fname": selected_fname,
-                    "sent_onset": int(current_onset_tracker) # This is the onset for the current trial
-                })
-
-                # Update current_onset_tracker for the *next* trial:
-                current_onset_tracker += selected_sent_dur # Add the duration of the current stimulus
-
-                if trial_in_block_idx == trials_per_block - 1: # If this was the last trial in the block
-                    # Add the inter-block interval
-                    current_onset_tracker += inter_block_interval_ms
-                else: # If not the last trial in the block
-                    # Add the fixed intra-block ITI
-                    current_onset_tracker += 1300
-            
-        if all_trials_for_subject: # Check if any trials were actually generated for this subject
-            df_output = pd.DataFrame(all_trials_for_subject)
-            output_filename = os.path.join(output_csv_folder, f"long-range_localizer_subj{subj_id}.csv")
-            df_output.to_csv(output_filename, index=False)
-            print(f"  Successfully generated: {output_filename}")
-        else:
-            print(f"  No trial data generated for Subject {subj_id}.")
+import sys
+import wave
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+HERE = Path(__file__).resolve().parent
+NUM_BLOCKS = 16
+TRIALS_PER_BLOCK = 3
+INITIAL_ONSET = 1500      # ms
+WITHIN_BLOCK_ITI = 1300   # ms, end of a sentence to the next sentence in the block
+INTER_BLOCK_INTERVAL = 8000  # ms, after a block's last trial, before next block's first trial
+RUN_LENGTH = 320000       # ms, the final silent row pads the run to this length
+SILENT_FNAME = "silent-1sec.wav"
+SILENT_GAP = 5            # ms between the last sentence and the silent row
+DURATION_TOLERANCE = 50   # ms allowed between sent_dur and the WAV length
+LANGUAGES = ("fr", "wol")
+DEFAULT_SEED = 0
+
+
+def sound_file_index(sound_dir):
+    """{fname: duration_ms} of every WAV in the sound_files folder (headers only)."""
+    index = {}
+    for path in Path(sound_dir).glob("*.wav"):
+        with wave.open(str(path), 'rb') as w:
+            index[path.name] = 1000.0 * w.getnframes() / w.getframerate()
+    return index
+
+
+def load_pools(source_dir, sound_index):
+    """Sentences available per language as {langue: DataFrame(fname, sent_dur)}.
+
+    Rows whose fname is not in sound_files, or whose sent_dur is longer than
+    the recording, are dropped with a warning.
+    """
+    frames = []
+    for csv_path in sorted(Path(source_dir).glob("*.csv")):
+        df = pd.read_csv(csv_path)
+        if not {'fname', 'sent_dur'} <= set(df.columns):
+            print(f"  Skipping {csv_path.name}: missing 'fname' or 'sent_dur' column.")
+            continue
+        frames.append(df[['fname', 'sent_dur']].dropna())
+    if not frames:
+        return None
+    stims = pd.concat(frames, ignore_index=True)
+    stims['sent_dur'] = pd.to_numeric(stims['sent_dur'], errors='coerce')
+
+    conflicting = stims.groupby('fname')['sent_dur'].nunique()
+    for fname in conflicting[conflicting > 1].index:
+        if fname != SILENT_FNAME:
+            print(f"  Warning: Several sent_dur values for {fname}; using the first.")
+    stims = stims.drop_duplicates('fname').dropna()
+    stims['sent_dur'] = stims['sent_dur'].astype(int)
+
+    stims['langue'] = np.select([stims['fname'].str.lower().str.startswith("fr_"),
+                                 stims['fname'].str.lower().str.startswith("wol")], list(LANGUAGES), default='')
+    stims = stims[stims['langue'] != '']
+
+    wav_ms = stims['fname'].map(sound_index)
+    missing = wav_ms.isna()
+    for fname in stims.loc[missing, 'fname']:
+        print(f"  Warning: {fname} not found in sound_files; excluded.")
+    too_long = ~missing & (stims['sent_dur'] > wav_ms + DURATION_TOLERANCE)
+    for fname, dur, ms in zip(stims.loc[too_long, 'fname'], stims.loc[too_long, 'sent_dur'], wav_ms[too_long]):
+        print(f"  Warning: sent_dur {dur} ms of {fname} exceeds its recording ({ms:.0f} ms); excluded.")
+    stims = stims[~missing & ~too_long]
+    return {lang: stims[stims['langue'] == lang].reset_index(drop=True) for lang in LANGUAGES}
+
+
+def generate_subject(subj_id, pools, seed, run_length=RUN_LENGTH):
+    """Stimulus table of one subject."""
+    rng = np.random.default_rng(seed + subj_id)
+    langue = np.array(LANGUAGES)[np.arange(NUM_BLOCKS) % 2]
+    fnames = np.empty((NUM_BLOCKS, TRIALS_PER_BLOCK), dtype=object)
+    durs = np.empty((NUM_BLOCKS, TRIALS_PER_BLOCK), dtype=int)
+    for lang in LANGUAGES:
+        pool = pools[lang]
+        blocks = np.flatnonzero(langue == lang)
+        # Sampling without replacement within each block: first columns of a random permutation per block
+        picks = rng.random((len(blocks), len(pool))).argsort(axis=1)[:, :TRIALS_PER_BLOCK]
+        fnames[blocks] = pool['fname'].to_numpy()[picks]
+        durs[blocks] = pool['sent_dur'].to_numpy()[picks]
+
+    sent_dur = durs.ravel()
+    gap = np.full((NUM_BLOCKS, TRIALS_PER_BLOCK), WITHIN_BLOCK_ITI)
+    gap[:, -1] = INTER_BLOCK_INTERVAL
+    step = sent_dur + gap.ravel()
+    onset = INITIAL_ONSET + np.cumsum(step) - step
+
+    table = pd.DataFrame({
+        "subj": subj_id,
+        "ntrial": np.arange(1, len(onset) + 1),
+        "nbloc": np.repeat(np.arange(NUM_BLOCKS), TRIALS_PER_BLOCK),
+        "langue": np.repeat(langue, TRIALS_PER_BLOCK),
+        "sent_dur": sent_dur,
+        "fname": fnames.ravel(),
+        "sent_onset": onset,
+    })
+    if run_length:
+        # Silent row so the run lasts at least run_length (duration rounded up to whole seconds)
+        silent_onset = int(onset[-1] + sent_dur[-1] + SILENT_GAP)
+        silent_dur = int(np.ceil(max(run_length - silent_onset, 0) / 1000.0) * 1000)
+        table.loc[len(table)] = [subj_id, len(table) + 1, NUM_BLOCKS, "", silent_dur, SILENT_FNAME, silent_onset]
+    return table
+
+
+def write_subject(task):
+    """Worker: generate and write one subject's CSV."""
+    subj_id, pools, seed, run_length, out_dir = task
+    table = generate_subject(subj_id, pools, seed, run_length)
+    output_filename = Path(out_dir) / f"long-range_localizer_sub{subj_id}.csv"
+    table.to_csv(output_filename, index=False)
+    return output_filename, table['sent_onset'].iloc[-1] + table['sent_dur'].iloc[-1]
+
+
+def parse_subjects(spec):
+    """'1-20' or '1,4,9' -> [1, ..., 20]."""
+    subjects = []
+    for part in spec.split(','):
+        if '-' in part:
+            lo, hi = part.split('-')
+            subjects.extend(range(int(lo), int(hi) + 1))
+        elif part.strip():
+            subjects.append(int(part))
+    return subjects
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the audio localizer stimulus CSVs.")
+    parser.add_argument("--subjects", type=str, default="1-3", help="Subject numbers, e.g. '1-20' or '4,7' (default 1-3)")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help=f"Base seed; subject N uses seed + N (default {DEFAULT_SEED})")
+    parser.add_argument("--source", type=str, default=str(HERE / "stim"), help="Folder of CSVs with fname and sent_dur columns")
+    parser.add_argument("--sound_files", type=str, default=str(HERE / "sound_files"), help="Folder of the WAVs")
+    parser.add_argument("--out", type=str, default=str(HERE / "generated"), help="Output folder (default: generated/, kept apart from the source pool)")
+    parser.add_argument("--overwrite", action="store_true", help="Replace existing tables in the output folder")
+    parser.add_argument("--run_length_ms", type=int, default=RUN_LENGTH, help=f"Pad each run with silence to this length (default {RUN_LENGTH}, 0 for none)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Worker processes")
+    args = parser.parse_args()
+
+    for folder in (args.source, args.sound_files):
+        if not os.path.isdir(folder):
+            print(f"Error: Folder not found at {folder}")
+            sys.exit(1)
+
+    sound_index = sound_file_index(args.sound_files)
+    print(f"Scanning source CSVs in: {args.source}")
+    pools = load_pools(args.source, sound_index)
+    if pools is None:
+        print(f"Error: No CSV with 'fname' and 'sent_dur' columns in {args.source}")
+        sys.exit(1)
+    for lang in LANGUAGES:
+        print(f"{lang} stimuli available: {len(pools[lang])}")
+        if len(pools[lang]) < TRIALS_PER_BLOCK:
+            print(f"Error: Stimulus pool for language '{lang}' is smaller than trials_per_block ({TRIALS_PER_BLOCK}).")
+            sys.exit(1)
+    if SILENT_FNAME not in sound_index and args.run_length_ms:
+        print(f"Warning: {SILENT_FNAME} not found in sound_files.")
+
+    subjects = parse_subjects(args.subjects)
+    existing = [f"long-range_localizer_sub{subj_id}.csv" for subj_id in subjects
+                if (Path(args.out) / f"long-range_localizer_sub{subj_id}.csv").exists()]
+    if existing and not args.overwrite:
+        print(f"Error: {', '.join(existing)} already exist in {args.out} (use --overwrite to replace them)")
+        sys.exit(1)
+    if Path(args.out).resolve() == Path(args.source).resolve():
+        print("Warning: Writing into the source folder; later runs will read these tables as part of the pool.")
+
+    os.makedirs(args.out, exist_ok=True)
+    tasks = [(subj_id, pools, args.seed, args.run_length_ms, args.out) for subj_id in subjects]
+    if args.jobs and args.jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            results = list(executor.map(write_subject, tasks))
+    else:
+        results = [write_subject(task) for task in tasks]
+    for output_filename, end_ms in results:
+        print(f"  Generated: {output_filename} ({end_ms / 1000.0:.1f} s)")
+
 
 if __name__ == "__main__":
-    create_custom_localizer_csvs()
+    main()